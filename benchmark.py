@@ -0,0 +1,485 @@
+"""Замеры клиента на локальной заглушке Bot API (fake_bot_api.FakeBotAPI).
+
+    python benchmark.py [--sections ingest,send,...] [--output result.json] [--compare baseline.json]
+
+Разделы: приём пачек update (ingest), приём фото с getFile и скачиванием (photos),
+задержка приёма через getUpdates и webhook (latency), отправка через очередь с
+задержкой и 429 (send), открытие чата на json и sqlite (chat_open), холодный
+запуск окна (startup) и автоответчик (auto_responder). У каждого раздела —
+rss_mb процесса после него.
+
+Результат печатается в stdout одним JSON-объектом (и пишется в --output). С --compare
+к нему добавляется сравнение всех числовых метрик с прошлым результатом, например
+с замером предыдущего коммита.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QCoreApplication, QEventLoop, QTimer
+from PyQt5.QtWidgets import QApplication
+
+import bot_engine
+import one_file
+from fake_bot_api import FakeBotAPI
+
+SECTIONS = ("ingest", "photos", "latency", "send", "chat_open", "startup", "auto_responder")
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50': round(statistics.median(samples), 3),
+        'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'max': round(samples[-1], 3),
+    }
+
+
+def rss_mb():
+    """Текущий RSS процесса; без /proc — пиковый"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS — байты
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_commit():
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_for(signal, timeout_ms=5000):
+    """Крутит цикл событий Qt, пока не придёт сигнал; возвращает его аргументы или None"""
+    loop = QEventLoop()
+    received = []
+
+    def on_signal(*args):
+        received.append(args)
+        loop.quit()
+
+    signal.connect(on_signal)
+    QTimer.singleShot(timeout_ms, loop.quit)
+    loop.exec_()
+    signal.disconnect(on_signal)
+    return received[0] if received else None
+
+
+def run_until(predicate, timeout=60):
+    """Крутит цикл событий Qt, пока predicate() не станет истинным; False по таймауту"""
+    app = QCoreApplication.instance()
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        app.processEvents(QEventLoop.AllEvents)
+        # Короткий сон отдаёт GIL потокам движка
+        time.sleep(0.001)
+    return True
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_ingest(updates=5000, burst=500, interval=0.0, chats=50):
+    """Пропускная способность приёма: пачки update по шаблону заглушки до сигналов new_messages"""
+    server = FakeBotAPI().start()
+    received = {}
+    batches = []
+
+    def on_messages(events):
+        now = time.perf_counter()
+        batches.append(len(events))
+        for event in events:
+            # Текст пачки — "message <update_id>": по нему находим время появления update на сервере
+            received[int(one_file.message_text(event['message']).rsplit(" ", 1)[1])] = now
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        db = bot_engine.open_database(db_path=data_dir)
+        worker = one_file.BotWorker("TEST", db, api_url=server.url)
+        worker.new_messages.connect(on_messages)
+        worker.start()
+        try:
+            server.push_text(1, "warmup 0")
+            run_until(lambda: received)
+            received.clear()
+            batches.clear()
+            pattern = [(interval if i else 0, burst) for i in range(max(1, updates // burst))]
+            total = sum(count for _, count in pattern)
+            start = time.perf_counter()
+            server.play_bursts(pattern, chats)
+            if not run_until(lambda: len(received) >= total):
+                raise RuntimeError(f"ingest: only {len(received)} of {total} updates arrived")
+            elapsed = time.perf_counter() - start
+        finally:
+            worker.stop()
+            server.stop()
+            db.close()
+    latencies = [(received[update_id] - server.pushed_at[update_id]) * 1000 for update_id in received]
+    return {'ingest': {
+        'updates': total, 'burst': burst, 'interval_ms': interval * 1000, 'chats': chats,
+        'seconds': round(elapsed, 3), 'updates_per_s': round(total / elapsed, 1), 'batches': len(batches),
+        'latency_ms': percentiles(latencies), 'rss_mb': rss_mb(),
+    }}
+
+
+def bench_photos(photos=200, size_kb=64, latency_ms=5, chats=20):
+    """Приём фото: update, getFile и скачивание файла до сигнала photo_ready"""
+    server = FakeBotAPI().start()
+    server.set_latency(file=latency_ms / 1000)
+    ready = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        db = bot_engine.open_database(db_path=data_dir)
+        worker = one_file.BotWorker("TEST", db, api_url=server.url)
+        worker.photo_ready.connect(lambda chat_id, path: ready.append(path))
+        worker.start()
+        try:
+            data = os.urandom(size_kb * 1024)
+            start = time.perf_counter()
+            for i in range(photos):
+                server.push_photo(1000 + i % chats, f"photo{i}", data)
+            if not run_until(lambda: len(ready) >= photos):
+                raise RuntimeError(f"photos: only {len(ready)} of {photos} photos downloaded")
+            elapsed = time.perf_counter() - start
+        finally:
+            worker.stop()
+            server.stop()
+            db.close()
+    return {'photos': {
+        'photos': photos, 'size_kb': size_kb, 'file_latency_ms': latency_ms,
+        'seconds': round(elapsed, 3), 'photos_per_s': round(photos / elapsed, 1),
+        'mb_per_s': round(photos * size_kb / 1024 / elapsed, 2), 'rss_mb': rss_mb(),
+    }}
+
+
+def bench_receive_latency(messages=50, webhook=False):
+    """Время от появления update на сервере до сигнала new_messages в GUI-потоке.
+
+    С webhook=True заглушка сама доставляет update POST-запросом на встроенный сервер клиента.
+    """
+    server = FakeBotAPI().start()
+    options = None
+    if webhook:
+        port = free_port()
+        options = {'url': f"http://127.0.0.1:{port}{bot_engine.WEBHOOK_PATH}", 'host': '127.0.0.1', 'port': port}
+    with tempfile.TemporaryDirectory() as data_dir:
+        db = bot_engine.open_database(db_path=data_dir)
+        worker = one_file.BotWorker("TEST", db, api_url=server.url, webhook=options)
+        worker.start()
+        latencies = []
+        try:
+            # Первый запрос устанавливает соединение, его в замер не включаем
+            server.push_text(1, "warmup")
+            wait_for(worker.new_messages)
+            for i in range(messages):
+                start = time.perf_counter()
+                server.push_text(1, f"message {i}")
+                if wait_for(worker.new_messages) is None:
+                    raise RuntimeError("no new_messages signal within timeout")
+                latencies.append((time.perf_counter() - start) * 1000)
+        finally:
+            worker.stop()
+            server.stop()
+            db.close()
+    return {'webhook' if webhook else 'polling': percentiles(latencies)}
+
+
+def bench_send(messages=150, photos=10, chats=50, latency_ms=20, floods=5):
+    """Пропускная способность очереди отправки при задержке ответа и нескольких 429 подряд"""
+    server = FakeBotAPI().start()
+    server.set_latency(send=latency_ms / 1000)
+    server.inject_flood(floods, retry_after=1)
+    finished = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        db = bot_engine.open_database(db_path=data_dir)
+        worker = one_file.BotWorker("TEST", db, api_url=server.url)
+        worker.send_finished.connect(lambda chat_id, ok, error: finished.append(ok))
+        worker.start()
+        try:
+            photo_path = os.path.join(data_dir, "photo.jpg")
+            with open(photo_path, 'wb') as f:
+                f.write(os.urandom(64 * 1024))
+            start = time.perf_counter()
+            for i in range(messages):
+                worker.send_message(1000 + i % chats, f"reply {i}")
+            for i in range(photos):
+                worker.send_file(1000 + i % chats, photo_path)
+            total = messages + photos
+            if not run_until(lambda: len(finished) >= total, timeout=120):
+                raise RuntimeError(f"send: only {len(finished)} of {total} sends finished")
+            elapsed = time.perf_counter() - start
+        finally:
+            worker.stop()
+            server.stop()
+            db.close()
+    return {'send': {
+        'messages': messages, 'photos': photos, 'chats': chats, 'send_latency_ms': latency_ms,
+        'floods_served': server.floods_served, 'failed': finished.count(False),
+        'seconds': round(elapsed, 3), 'sends_per_s': round(total / elapsed, 1),
+        'global_limit_per_s': bot_engine.GLOBAL_SEND_RATE, 'rss_mb': rss_mb(),
+    }}
+
+
+def fill_database(db, chats, messages, rng):
+    words = ["hello", "world", "photo", "meeting", "tomorrow", "thanks", "see", "you", "later", "ok"]
+    with db.batch():
+        for c in range(chats):
+            chat_id = 1000 + c
+            db.save_chat({'id': chat_id, 'first_name': f"User{c}", 'last_name': "", 'username': f"user{c}",
+                          'type': 'private'})
+            for i in range(messages):
+                text = " ".join(rng.choice(words) for _ in range(rng.randint(2, 30)))
+                db.save_message(chat_id, text, i % 3 == 0)
+
+
+def bench_chat_open(chats=100, messages=200, samples=50):
+    """Открытие чата как в load_chat: страница из хранилища, модель ленты, раскладка и отрисовка.
+
+    cold — первое открытие после запуска (хранилище читается с диска), warm — повторное.
+    """
+    rng = random.Random(1)
+    app = QCoreApplication.instance()
+    results = {'chats': chats, 'messages_per_chat': messages}
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as data_dir:
+            db = bot_engine.open_database(backend, data_dir)
+            fill_database(db, chats, messages, rng)
+            db.close()
+
+            db = bot_engine.open_database(backend, data_dir)
+            view = one_file.MessageListView()
+            model = one_file.MessageListModel()
+            delegate = one_file.MessageDelegate(view, one_file.STYLES['Light'], 1.0)
+            view.setModel(model)
+            view.setItemDelegate(delegate)
+            view.resize(820, 700)
+            view.show()
+            app.processEvents()
+            chat_ids = [str(1000 + c) for c in rng.sample(range(chats), min(samples, chats))]
+            timings = {'cold': [], 'warm': []}
+            reads = {'cold': [], 'warm': []}
+            for phase in ("cold", "warm"):
+                for chat_id in chat_ids:
+                    start = time.perf_counter()
+                    page = db.get_messages(chat_id, limit=bot_engine.HISTORY_PAGE_SIZE)
+                    read = time.perf_counter()
+                    model.set_messages(page)
+                    view.enable_auto_scroll()
+                    view.scrollToBottom()
+                    app.processEvents()
+                    view.viewport().repaint()
+                    end = time.perf_counter()
+                    reads[phase].append((read - start) * 1000)
+                    timings[phase].append((end - start) * 1000)
+            view.close()
+            delegate.photo_loader.stop()
+            db.close()
+        results[backend] = {phase: {'open_ms': percentiles(timings[phase]), 'read_ms': percentiles(reads[phase])}
+                            for phase in timings}
+    results['rss_mb'] = rss_mb()
+    return {'chat_open': results}
+
+
+def bench_startup(chats=1000, runs=5):
+    """Холодный запуск окна (one_file.py) в отдельном процессе: фазы startup_mark до первой отрисовки.
+
+    Настройки Qt берутся из временного XDG_CONFIG_HOME, данные — из временного каталога
+    со снимком списка чатов, поэтому настоящий профиль пользователя не затрагивается.
+    """
+    server = FakeBotAPI().start()
+    phases = {}
+    wall = []
+    with tempfile.TemporaryDirectory() as root:
+        data_dir = os.path.join(root, bot_engine.DATA_DIR)
+        db = bot_engine.open_database(db_path=data_dir)
+        fill_database(db, chats, 3, random.Random(2))
+        summaries = db.get_summaries()
+        model = one_file.ChatListModel()
+        model.set_chats({cid: {'chat': data, 'summary': summaries.get(cid) or bot_engine.summarize_messages([])}
+                         for cid, data in db.get_chats().items()})
+        one_file.save_chat_snapshot(os.path.join(data_dir, one_file.CHAT_SNAPSHOT_FILE), "json",
+                                    model.snapshot(one_file.CHAT_SNAPSHOT_ROWS))
+        db.close()
+
+        config_dir = os.path.join(root, "config", "PyTelegram")
+        os.makedirs(config_dir)
+        with open(os.path.join(config_dir, "Config.conf"), 'w') as f:
+            f.write(f"[General]\nbot_token=123:bench\nstorage=json\napi_url={server.url}\n")
+        env = dict(os.environ, XDG_CONFIG_HOME=os.path.join(root, "config"), TELEGRAM_CLIENT_TIMING="1",
+                   QT_QPA_PLATFORM="offscreen")
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "one_file.py")
+        try:
+            for _ in range(runs):
+                start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, script], cwd=root, env=env, text=True,
+                                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                try:
+                    for line in process.stdout:
+                        if line.startswith("Startup: "):
+                            wall.append((time.perf_counter() - start) * 1000)
+                            for part in line[len("Startup: "):].split(", "):
+                                name, ms, _ = part.rsplit(" ", 2)
+                                phases.setdefault(name, []).append(float(ms))
+                            break
+                finally:
+                    process.kill()
+                    process.wait()
+        finally:
+            server.stop()
+    if not wall:
+        raise RuntimeError("startup: the window never reported its startup phases")
+    return {'startup': {
+        'chats': chats, 'runs': runs,
+        'phases_ms': {name: round(statistics.median(values), 1) for name, values in phases.items()},
+        'process_to_report_ms': percentiles(wall),
+    }}
+
+
+def make_rules(count, vocabulary, rng):
+    """Смесь правил автоответчика: 60% ключевых слов, 20% префиксов, 20% регулярок"""
+    rules = []
+    for i in range(count):
+        word = vocabulary[i % len(vocabulary)]
+        kind = ('keyword', 'keyword', 'keyword', 'prefix', 'regex')[i % 5]
+        pattern = rf"{word}\d{{2,}}" if kind == 'regex' else f"{word} {rng.choice(vocabulary)}" if i % 2 else word
+        rules.append({'type': kind, 'pattern': pattern, 'reply': f"reply {i}", 'cooldown': 0})
+    return rules
+
+
+def bench_auto_responder(rules=2000, messages=5000):
+    """Стоимость проверки одного входящего сообщения по всем правилам автоответчика"""
+    rng = random.Random(1)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(5000)]
+    texts = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 25))) for _ in range(messages)]
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        for count in (10, rules):
+            path = os.path.join(data_dir, f"rules_{count}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(make_rules(count, vocabulary, rng), f)
+            start = time.perf_counter()
+            responder = bot_engine.AutoResponder(path)
+            compile_ms = (time.perf_counter() - start) * 1000
+            samples = []
+            hits = 0
+            for text in texts:
+                start = time.perf_counter()
+                hits += responder.reply(1, text) is not None
+                samples.append((time.perf_counter() - start) * 1e6)
+            results[str(count)] = {'load_ms': round(compile_ms, 1), 'hit_rate': round(hits / len(texts), 3),
+                                   'match_us': percentiles(samples)}
+    return {'auto_responder': {'messages': messages, 'rules': results}}
+
+
+def flatten(results, prefix=""):
+    """{'a': {'b': 1}} -> {'a.b': 1}; только числовые значения"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(baseline, current):
+    """Изменение каждой общей числовой метрики в процентах относительно baseline"""
+    old, new = flatten(baseline), flatten(current)
+    changes = {}
+    for key in sorted(old.keys() & new.keys()):
+        if key == 'timestamp':
+            continue
+        change = round((new[key] - old[key]) / old[key] * 100, 1) if old[key] else None
+        changes[key] = {'baseline': old[key], 'current': new[key], 'change_pct': change}
+    return {'baseline_commit': baseline.get('commit'), 'metrics': changes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sections', default=",".join(SECTIONS), help="через запятую: " + ", ".join(SECTIONS))
+    parser.add_argument('--updates', type=int, default=5000, help="ingest: сколько update")
+    parser.add_argument('--burst', type=int, default=500, help="ingest: размер пачки")
+    parser.add_argument('--interval-ms', type=float, default=0, help="ingest: пауза между пачками")
+    parser.add_argument('--photos', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50, help="latency: сколько update по одному")
+    parser.add_argument('--sends', type=int, default=150)
+    parser.add_argument('--send-latency-ms', type=float, default=20)
+    parser.add_argument('--floods', type=int, default=5, help="send: сколько ответов 429 подряд")
+    parser.add_argument('--startup-chats', type=int, default=1000)
+    parser.add_argument('--startup-runs', type=int, default=5)
+    parser.add_argument('--rules', type=int, default=2000)
+    parser.add_argument('--output', help="записать результат ещё и в этот файл")
+    parser.add_argument('--compare', help="JSON прошлого замера для сравнения")
+    args = parser.parse_args()
+    sections = [name.strip() for name in args.sections.split(",") if name.strip()]
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error(f"unknown sections: {', '.join(sorted(unknown))}")
+
+    # QApplication, а не QCoreApplication: замер открытия чата рисует виджеты
+    app = QApplication(sys.argv[:1])
+    results = {'timestamp': time.time(), 'commit': git_commit(), 'python': platform.python_version(),
+               'platform': platform.platform()}
+    if "ingest" in sections:
+        results.update(bench_ingest(args.updates, args.burst, args.interval_ms / 1000))
+    if "photos" in sections:
+        results.update(bench_photos(args.photos))
+    if "latency" in sections:
+        latency = {'messages': args.messages}
+        latency.update(bench_receive_latency(args.messages))
+        latency.update(bench_receive_latency(args.messages, webhook=True))
+        results['receive_latency_ms'] = latency
+    if "send" in sections:
+        results.update(bench_send(args.sends, latency_ms=args.send_latency_ms, floods=args.floods))
+    if "chat_open" in sections:
+        results.update(bench_chat_open())
+    if "startup" in sections:
+        results.update(bench_startup(args.startup_chats, args.startup_runs))
+    if "auto_responder" in sections:
+        results.update(bench_auto_responder(args.rules))
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            results['compare'] = compare(json.load(f), results)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
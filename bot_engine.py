@@ -0,0 +1,2766 @@
+"""Движок бота без Qt: хранилище, приём update, очередь отправки и автоответчик.
+
+Используется GUI (one_file.py) и работает сам по себе как демон:
+
+    python bot_engine.py --token TOKEN [--data-dir DIR] [--storage json|sqlite]
+    python one_file.py --headless --token TOKEN ...
+"""
+import argparse
+import asyncio
+import hashlib
+import heapq
+import hmac
+import json
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# aiohttp импортируется в сетевых методах, а не здесь: это самый тяжёлый импорт (~0.2 с),
+# а хранилищу и GUI при старте он не нужен — его подгружает поток движка
+
+
+# Каталог данных по умолчанию (относительно рабочего каталога)
+DATA_DIR = "telegram_bot_data"
+# Журнал очереди отправки в каталоге данных
+SEND_QUEUE_FILE = "send_queue.jsonl"
+
+# История хранится целиком; в память кэша попадают только последние сообщения чата
+CACHED_MESSAGES_PER_CHAT = 500
+# Сколько сообщений подгружается за раз при открытии чата и прокрутке вверх
+HISTORY_PAGE_SIZE = 50
+# Журнал чата переписывается, когда в нём набирается столько мёртвых записей (удаления и удалённые)
+COMPACT_THRESHOLD = 1000
+# Журнал сводок: по строке на изменённую сводку чата; переписывается, когда строк становится
+# вдвое больше, чем чатов, но не чаще чем раз в SUMMARIES_COMPACT_MIN строк
+SUMMARIES_FILE = "summaries.jsonl"
+SUMMARIES_COMPACT_MIN = 1000
+
+message_id_lock = threading.Lock()
+last_message_id = 0
+
+def next_message_id(timestamp):
+    """Уникальный возрастающий id: время в миллисекундах, а при совпадении — следующее число"""
+    global last_message_id
+    with message_id_lock:
+        last_message_id = max(int(timestamp * 1000), last_message_id + 1)
+        return last_message_id
+
+
+def is_older(msg, message_id):
+    """Сообщение создано раньше сообщения message_id: id растут вместе со временем"""
+    msg_id = msg.get('id')
+    return isinstance(msg_id, (int, float)) and isinstance(message_id, (int, float)) and msg_id < message_id
+
+# Размер блока для потокового чтения и записи файлов
+FILE_CHUNK_SIZE = 64 * 1024
+
+def cache_photo(photos_dir, source_path):
+    """Копирует фото в кэш под хэшем содержимого, читая файл блоками"""
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    photo_path = os.path.join(photos_dir, f"{digest.hexdigest()[:32]}.jpg")
+    # Одинаковые фото хранятся один раз
+    if not os.path.exists(photo_path):
+        shutil.copyfile(source_path, photo_path)
+    return photo_path
+
+
+def build_message(photos_dir, message, is_outgoing, msg_type="text", file_path=None, file_name=None, photo_file=None,
+                  photo_path=None, file_id=None):
+    """Собирает запись сообщения для хранилища"""
+    current_time = datetime.now()
+    msg_obj = {
+        'id': next_message_id(current_time.timestamp()),
+        'text': message,
+        'out': is_outgoing,
+        'time': current_time.strftime("%H:%M"),
+        'type': msg_type,
+        'timestamp': current_time.timestamp()
+    }
+    
+    if not message and msg_type == 'photo':
+        msg_obj['text'] = "🖼️ Photo"
+    elif not message and msg_type == 'document':
+        msg_obj['text'] = "📎 File"
+    
+    if file_path: 
+        msg_obj['file_path'] = file_path
+    if file_name: 
+        msg_obj['file_name'] = file_name
+    if photo_file:
+        photo_path = cache_photo(photos_dir, photo_file)
+    if photo_path:
+        # Файл может ещё скачиваться: до его появления сообщение показывается заглушкой
+        msg_obj['photo_id'] = os.path.splitext(os.path.basename(photo_path))[0]
+        msg_obj['photo_path'] = photo_path
+    if file_id:
+        # По file_id фото можно скачать заново, если загрузка не удалась или была прервана
+        msg_obj['file_id'] = file_id
+    return msg_obj
+
+
+def normalize_message(msg):
+    """Дополняет записи старого формата недостающими полями"""
+    if 'type' not in msg:
+        msg['type'] = 'text'
+    if 'text' not in msg:
+        msg['text'] = ''
+    if 'time' not in msg:
+        if 'timestamp' in msg:
+            try:
+                dt = datetime.fromtimestamp(msg['timestamp'])
+                msg['time'] = dt.strftime("%H:%M")
+            except:
+                msg['time'] = '00:00'
+        else:
+            msg['time'] = '00:00'
+    if 'out' not in msg:
+        msg['out'] = False
+    return msg
+
+
+def message_text(msg):
+    """Текст пузыря; для сообщений без текста — подпись по типу"""
+    text = msg.get('text', '')
+    if text:
+        return text
+    msg_type = msg.get('type', 'text')
+    if msg_type == 'photo':
+        return "🖼️ Photo"
+    if msg_type == 'document':
+        return "📎 File"
+    return "Message"
+
+
+# Длина превью последнего сообщения в списке чатов
+CHAT_PREVIEW_LENGTH = 30
+
+def set_summary_last(summary, msg):
+    """Превью последнего сообщения в сводке; msg=None — сообщений в чате не осталось"""
+    if msg is None:
+        summary['last_text'], summary['last_time'], summary['last_timestamp'] = '', '', 0
+        return summary
+    text = message_text(msg)
+    if len(text) > CHAT_PREVIEW_LENGTH:
+        text = text[:CHAT_PREVIEW_LENGTH - 3] + "..."
+    summary['last_text'] = text
+    summary['last_time'] = msg.get('time', '')
+    summary['last_timestamp'] = msg.get('timestamp', 0)
+    return summary
+
+
+def is_unread(summary, msg):
+    """Входящее сообщение новее отметки прочтения"""
+    return not msg.get('out', False) and not msg.get('read', False) and msg.get('timestamp', 0) > summary['read_timestamp']
+
+
+def update_summary(summary, msg):
+    """Учитывает новое сообщение в сводке чата"""
+    set_summary_last(summary, msg)
+    summary['total'] += 1
+    if msg.get('out', False):
+        summary['outgoing'] += 1
+    elif is_unread(summary, msg):
+        summary['unread'] += 1
+    return summary
+
+
+def remove_from_summary(summary, msg):
+    """Вычитает удалённое сообщение из счётчиков сводки; превью обновляется отдельно"""
+    summary['total'] = max(0, summary['total'] - 1)
+    if msg.get('out', False):
+        summary['outgoing'] = max(0, summary['outgoing'] - 1)
+    elif is_unread(summary, msg):
+        summary['unread'] = max(0, summary['unread'] - 1)
+    return summary
+
+
+def summarize_messages(messages, read_timestamp=0):
+    """Сводка чата для строки списка: превью, время, непрочитанные и счётчики.
+
+    Непрочитанными считаются входящие сообщения новее read_timestamp.
+    """
+    summary = {'last_text': '', 'last_time': '', 'last_timestamp': 0, 'unread': 0, 'total': 0, 'outgoing': 0,
+               'read_timestamp': read_timestamp}
+    for msg in messages:
+        update_summary(summary, normalize_message(msg))
+    return summary
+
+
+def mark_summary_read(summary, read_timestamp=None):
+    """Отмечает прочитанными все сообщения до read_timestamp (по умолчанию — до последнего)"""
+    if read_timestamp is None:
+        read_timestamp = summary['last_timestamp']
+    summary['read_timestamp'] = max(summary['read_timestamp'], read_timestamp)
+    summary['unread'] = 0
+    return summary
+
+
+def chat_title(chat_id, chat_data):
+    """Имя чата: имя и фамилия, иначе username, иначе id"""
+    name = f"{chat_data.get('first_name', '')} {chat_data.get('last_name', '')}".strip()
+    if not name:
+        name = chat_data.get('username', '') or str(chat_id)
+    return name
+
+
+# Сколько результатов возвращает поиск, среди скольких самых новых совпадений они ранжируются
+# и после скольких удалений индекс пересобирается
+SEARCH_LIMIT = 50
+SEARCH_CANDIDATES = 1000
+SEARCH_REBUILD_DELETED = 10000
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    """Слова текста в нижнем регистре для поискового индекса"""
+    return SEARCH_TOKEN_RE.findall(text.lower()) if text else []
+
+
+def search_terms_query(terms):
+    """Запрос FTS5: все слова обязательны, каждое ищется по префиксу"""
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+class SearchIndex:
+    """Инвертированный индекс в памяти: слово -> номера документов.
+
+    Документ — сообщение (chat_id, message_id) или имя чата (chat_id, None).
+    Списки вхождений хранятся в array('I'), удалённые документы помечаются None
+    и вычищаются пересборкой. Новые слова копятся в new_words и вливаются
+    в отсортированный words пачкой, чтобы поиск по префиксу шёл через bisect.
+    """
+    def __init__(self):
+        self.docs = []
+        self.keys = {}
+        self.postings = {}
+        self.words = []
+        self.new_words = []
+        self.deleted = 0
+
+    def add(self, chat_id, message_id, text, timestamp=0):
+        key = (str(chat_id), message_id)
+        if key in self.keys:
+            if self.docs[self.keys[key]][2] == text:
+                return
+            self.remove(*key)
+        doc = len(self.docs)
+        self.docs.append((key[0], message_id, text, timestamp))
+        self.keys[key] = doc
+        for word in set(tokenize(text)):
+            postings = self.postings.get(word)
+            if postings is None:
+                postings = self.postings[word] = array('I')
+                self.new_words.append(word)
+            postings.append(doc)
+        if len(self.new_words) > 1000:
+            self.merge_words()
+
+    def remove(self, chat_id, message_id):
+        doc = self.keys.pop((str(chat_id), message_id), None)
+        if doc is None:
+            return
+        self.docs[doc] = None
+        self.deleted += 1
+        if self.deleted >= SEARCH_REBUILD_DELETED and self.deleted * 2 > len(self.docs):
+            self.rebuild()
+
+    def remove_chat(self, chat_id):
+        """Удаляет сообщения чата, оставляя его имя"""
+        chat_id = str(chat_id)
+        for key in [key for key in self.keys if key[0] == chat_id and key[1] is not None]:
+            self.remove(*key)
+
+    def rebuild(self):
+        docs = [doc for doc in self.docs if doc is not None]
+        self.__init__()
+        for doc in docs:
+            self.add(*doc)
+        self.merge_words()
+
+    def merge_words(self):
+        self.words = sorted(self.words + self.new_words)
+        self.new_words = []
+
+    def prefix_words(self, term):
+        start = bisect_left(self.words, term)
+        end = bisect_left(self.words, term + "\U0010ffff")
+        return self.words[start:end] + [word for word in self.new_words if word.startswith(term)]
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Документы, где каждое слово запроса — префикс какого-то слова документа.
+
+        Вес слова — idf (редкие слова важнее), полное совпадение весит вдвое больше префикса;
+        при равном весе выше более новые. Имена чатов идут раньше сообщений.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        total = len(self.keys) or 1
+        per_term = []
+        for term in set(terms):
+            weights = {}
+            for word in self.prefix_words(term):
+                postings = self.postings[word]
+                weight = math.log(1 + total / len(postings)) * (2 if word == term else 1)
+                for doc in postings:
+                    if weights.get(doc, 0) < weight:
+                        weights[doc] = weight
+            if not weights:
+                return []
+            per_term.append(weights)
+        # Пересечение начинаем с самого редкого слова
+        per_term.sort(key=len)
+        scores = per_term[0]
+        for weights in per_term[1:]:
+            scores = {doc: score + weights[doc] for doc, score in scores.items() if doc in weights}
+        docs = self.docs
+        top = heapq.nlargest(limit, (doc for doc in scores if docs[doc] is not None),
+                             key=lambda doc: (docs[doc][1] is None, scores[doc], docs[doc][3]))
+        return [{'chat_id': docs[doc][0], 'message_id': docs[doc][1], 'text': docs[doc][2],
+                 'timestamp': docs[doc][3]} for doc in top]
+
+
+# Сколько последних update_id помнит дедупликатор; на диск они попадают вместе с пакетом сообщений
+PROCESSED_WINDOW = 1000
+
+class UpdateDeduplicator:
+    """Ограниченное множество обработанных update_id: кольцевой буфер + set"""
+    def __init__(self, window=PROCESSED_WINDOW):
+        self.recent = deque(maxlen=window)
+        self.seen = set()
+        self.high_water = 0
+        self.loaded_high_water = 0
+        self.unsaved = []
+        self.lock = threading.Lock()
+
+    def load(self, update_ids, high_water=0):
+        with self.lock:
+            for update_id in sorted(int(u) for u in update_ids):
+                self._add(update_id)
+            self.high_water = max(self.high_water, int(high_water))
+            self.loaded_high_water = self.high_water
+
+    def _add(self, update_id):
+        if len(self.recent) == self.recent.maxlen:
+            self.seen.discard(self.recent[0])
+        self.recent.append(update_id)
+        self.seen.add(update_id)
+        self.high_water = max(self.high_water, update_id)
+
+    def is_processed(self, update_id):
+        # update_id растут монотонно, поэтому всё, что старше окна, уже обработано
+        if update_id in self.seen:
+            return True
+        return len(self.recent) == self.recent.maxlen and update_id < self.recent[0]
+
+    def mark_processed(self, update_id):
+        """Возвращает True, если update_id ещё не встречался"""
+        with self.lock:
+            if update_id in self.seen:
+                return False
+            self._add(update_id)
+            self.unsaved.append(update_id)
+            return True
+
+    def take_unsaved(self):
+        with self.lock:
+            ids, self.unsaved = self.unsaved, []
+            return ids
+
+    def restore_unsaved(self, ids):
+        """Возвращает id, которые не удалось записать"""
+        with self.lock:
+            self.unsaved = ids + self.unsaved
+
+    def state(self):
+        """Окно для сохранения без id, ещё не переданных на запись: их сообщения могут быть не записаны"""
+        with self.lock:
+            unsaved = set(self.unsaved)
+            recent = [update_id for update_id in self.recent if update_id not in unsaved]
+            return {'high_water': max([self.loaded_high_water] + recent), 'recent': recent}
+
+
+def remove_send_queue(db_path):
+    """Удаляет журнал очереди отправки, чтобы старые задания не ушли через новый токен"""
+    for path in (os.path.join(db_path, SEND_QUEUE_FILE), os.path.join(db_path, SEND_QUEUE_FILE + ".tmp")):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def merge_chat(existing, chat_data):
+    """Дополняет сохранённые данные чата непустыми полями из chat_data"""
+    for key, value in chat_data.items():
+        if key not in existing or not existing[key]:
+            existing[key] = value
+    return existing
+
+
+class Database:
+    def __init__(self, db_path=DATA_DIR):
+        self.db_path = db_path
+        # Своя блокировка у каждого хранилища: боты в многоботовом режиме не ждут друг друга
+        self.mutex = threading.Lock()
+        self.messages_dir = os.path.join(db_path, "messages")
+        self.log_garbage = {}
+        # Где остановилась последняя страница чата: листание вверх продолжает чтение с этого места
+        self.log_cursors = {}
+        self.summaries = {}
+        self.summary_records = 0
+        self.search_index = None
+        self.search_ready = threading.Event()
+        self.processed = UpdateDeduplicator()
+        if not os.path.exists(db_path):
+            os.makedirs(db_path)
+        self.init_database()
+    
+    def init_database(self):
+        for file in ["chats.json", "processed.json", "photos_cache", "messages"]:
+            path = os.path.join(self.db_path, file)
+            if file in ("photos_cache", "messages"):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+            else:
+                if not os.path.exists(path):
+                    with open(path, 'w', encoding='utf-8') as f:
+                        json.dump({}, f)
+        self.migrate_legacy_messages()
+        self.load_processed()
+        self.load_summaries()
+
+    def load_summaries(self):
+        """Читает журнал сводок; старый summaries.json переносит в него, а при первом запуске
+        строит сводки по журналам сообщений"""
+        path = os.path.join(self.db_path, SUMMARIES_FILE)
+        legacy_path = os.path.join(self.db_path, "summaries.json")
+        self.mutex.acquire()
+        try:
+            if os.path.exists(path):
+                self.summaries = {}
+                self.summary_records = 0
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # Недописанная строка после аварийного завершения
+                            continue
+                        self.summaries[record['chat_id']] = record['summary']
+                        self.summary_records += 1
+            else:
+                if os.path.exists(legacy_path):
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        self.summaries = json.load(f)
+                else:
+                    self.summaries = {cid: summarize_messages(self._read_log(cid)) for cid in self.message_chat_ids()}
+                self._compact_summaries()
+                if os.path.exists(legacy_path):
+                    os.remove(legacy_path)
+        except Exception as e:
+            print(f"Error loading summaries: {e}")
+        finally:
+            self.mutex.release()
+
+    def _save_summaries(self, chat_ids):
+        """Дописывает в журнал сводки изменённых чатов, не трогая остальные"""
+        with open(os.path.join(self.db_path, SUMMARIES_FILE), 'a', encoding='utf-8') as f:
+            for chat_id in chat_ids:
+                f.write(json.dumps({'chat_id': chat_id, 'summary': self.summaries[chat_id]}) + "\n")
+        self.summary_records += len(chat_ids)
+        if self.summary_records >= max(SUMMARIES_COMPACT_MIN, 2 * len(self.summaries)):
+            self._compact_summaries()
+
+    def _compact_summaries(self):
+        path = os.path.join(self.db_path, SUMMARIES_FILE)
+        with open(path + ".tmp", 'w', encoding='utf-8') as f:
+            for chat_id, summary in self.summaries.items():
+                f.write(json.dumps({'chat_id': chat_id, 'summary': summary}) + "\n")
+        os.replace(path + ".tmp", path)
+        self.summary_records = len(self.summaries)
+
+    def _add_to_summary(self, chat_id, messages):
+        summary = self.summaries.get(chat_id) or summarize_messages([])
+        for msg in messages:
+            update_summary(summary, msg)
+        self.summaries[chat_id] = summary
+
+    def _remove_from_summary(self, chat_id, message_id):
+        """Вычитает сообщение из сводки до записи его удаления. Журнал читается с конца только
+        до самого сообщения и до последнего из оставшихся — оно становится превью"""
+        removed = newest = None
+        scan = self._scan_log_back(chat_id)
+        try:
+            for _, msg in scan:
+                if msg.get('id') == message_id:
+                    removed = msg
+                elif newest is None:
+                    newest = msg
+                if removed is not None and newest is not None:
+                    break
+        finally:
+            scan.close()
+        if removed is None:
+            return
+        summary = self.summaries.get(chat_id) or summarize_messages([])
+        remove_from_summary(summary, normalize_message(removed))
+        set_summary_last(summary, newest and normalize_message(newest))
+        self.summaries[chat_id] = summary
+        self._save_summaries([chat_id])
+
+    def _clear_summary(self, chat_id):
+        read_timestamp = self.summaries.get(chat_id, {}).get('read_timestamp', 0)
+        self.summaries[chat_id] = summarize_messages([], read_timestamp)
+        self._save_summaries([chat_id])
+
+    def start_search_index(self):
+        """Строит индекс поиска в фоновом потоке сразу после открытия хранилища"""
+        threading.Thread(target=self.build_search_index, daemon=True).start()
+
+    def build_search_index(self):
+        """Строит индекс по чату за раз, отпуская блокировку между чатами, чтобы запись не ждала
+        всю сборку. Индекс подключается сразу, поэтому новые сообщения попадают в него и во время
+        сборки; повторное добавление того же сообщения индекс пропускает.
+        У каждой сборки своё событие готовности: брошенная сборка не будит тех, кто ждёт следующую"""
+        self.mutex.acquire()
+        try:
+            if self.search_index is not None:
+                return
+            index = self.search_index = SearchIndex()
+            ready = self.search_ready = threading.Event()
+        finally:
+            self.mutex.release()
+        try:
+            self.mutex.acquire()
+            try:
+                with open(os.path.join(self.db_path, "chats.json"), 'r', encoding='utf-8') as f:
+                    for cid, chat_data in json.load(f).items():
+                        index.add(cid, None, chat_title(cid, chat_data))
+                chat_ids = self.message_chat_ids()
+            finally:
+                self.mutex.release()
+            for cid in chat_ids:
+                self.mutex.acquire()
+                try:
+                    # clear_all_data сбрасывает индекс — тогда эта сборка уже не нужна
+                    if self.search_index is not index:
+                        return
+                    for msg in self._read_log(cid):
+                        index.add(cid, msg.get('id'), msg.get('text', ''), msg.get('timestamp', 0))
+                finally:
+                    self.mutex.release()
+            self.mutex.acquire()
+            try:
+                index.merge_words()
+            finally:
+                self.mutex.release()
+        except Exception as e:
+            print(f"Error building search index: {e}")
+        finally:
+            ready.set()
+
+    def _index_messages(self, chat_id, messages):
+        if self.search_index is not None:
+            for msg in messages:
+                self.search_index.add(chat_id, msg.get('id'), msg.get('text', ''), msg.get('timestamp', 0))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Ищет по индексу; если он ещё строится — дожидается сборки"""
+        if self.search_index is None:
+            self.build_search_index()
+        while True:
+            ready = self.search_ready
+            ready.wait()
+            self.mutex.acquire()
+            try:
+                # Пока ждали, индекс сбросили и начали собирать заново — ждём уже новую сборку
+                if self.search_ready is not ready:
+                    continue
+                if self.search_index is None:
+                    return []
+                return self.search_index.search(query, limit)
+            except Exception as e:
+                print(f"Error searching messages: {e}")
+                return []
+            finally:
+                self.mutex.release()
+
+    def load_processed(self):
+        try:
+            with open(os.path.join(self.db_path, "processed.json"), 'r') as f:
+                data = json.load(f)
+            if 'recent' in data:
+                self.processed.load(data['recent'], data.get('high_water', 0))
+            else:
+                # Старый формат: {"<update_id>": true, ...}
+                self.processed.load(data.keys())
+        except Exception as e:
+            print(f"Error loading processed updates: {e}")
+
+    def migrate_legacy_messages(self):
+        """Переносит старый messages.json в журналы по чатам"""
+        path = os.path.join(self.db_path, "messages.json")
+        if not os.path.exists(path):
+            return
+        self.mutex.acquire()
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for chat_id, messages in data.items():
+                with open(self.log_path(chat_id), 'w', encoding='utf-8') as f:
+                    for msg in messages:
+                        f.write(json.dumps(msg) + "\n")
+            os.replace(path, path + ".migrated")
+        except Exception as e:
+            print(f"Error migrating messages: {e}")
+        finally:
+            self.mutex.release()
+
+    def log_path(self, chat_id):
+        return os.path.join(self.messages_dir, f"{chat_id}.jsonl")
+
+    def _read_log(self, chat_id):
+        chat_id = str(chat_id)
+        path = self.log_path(chat_id)
+        messages = []
+        garbage = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийного завершения
+                        continue
+                    if record.get('op') == 'delete':
+                        live = len(messages)
+                        messages = [msg for msg in messages if msg.get('id') != record.get('id')]
+                        garbage += 1 + live - len(messages)
+                    else:
+                        messages.append(record)
+        self.log_garbage[chat_id] = garbage
+        return messages
+
+    def _scan_log_back(self, chat_id, end=None, deleted=None):
+        """Живые сообщения журнала от конца к началу вместе со смещением их строки.
+
+        Запись-удаление стоит в журнале позже удалённого сообщения, поэтому при чтении с конца
+        её id попадает в deleted раньше, чем встретится само сообщение.
+        """
+        path = self.log_path(chat_id)
+        if not os.path.exists(path):
+            return
+        deleted = set() if deleted is None else deleted
+        with open(path, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END) if end is None else end
+            rest = b""
+            while pos > 0:
+                size = min(FILE_CHUNK_SIZE, pos)
+                pos -= size
+                f.seek(pos)
+                lines = (f.read(size) + rest).split(b"\n")
+                # Первая строка блока может начинаться в предыдущем блоке
+                rest = lines.pop(0)
+                starts = []
+                start = pos + len(rest) + 1
+                for line in lines:
+                    starts.append(start)
+                    start += len(line) + 1
+                for start, line in zip(reversed(starts), reversed(lines)):
+                    msg = self._live_record(line, deleted)
+                    if msg is not None:
+                        yield start, msg
+            msg = self._live_record(rest, deleted)
+            if msg is not None:
+                yield 0, msg
+
+    def _live_record(self, line, deleted):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # Недописанная строка после аварийного завершения
+            return None
+        if record.get('op') == 'delete':
+            deleted.add(record.get('id'))
+            return None
+        if record.get('id') in deleted:
+            return None
+        return record
+
+    def _read_page(self, chat_id, before_id, limit):
+        """Последние limit сообщений старше before_id, прочитанные с конца журнала"""
+        path = self.log_path(chat_id)
+        if not os.path.exists(path):
+            return []
+        size = os.path.getsize(path)
+        end, deleted = None, set()
+        cursor = self.log_cursors.get(chat_id)
+        if before_id is not None and cursor and cursor[0] == before_id and cursor[3] <= size:
+            # Курсор указывает на строку before_id: с неё читаем дальше, даже если сообщение уже удалено
+            _, end, deleted, cursor_size = cursor
+            deleted = set(deleted)
+            if size > cursor_size:
+                # Удаления, дописанные после прошлой страницы, могут относиться к более старым сообщениям
+                with open(path, 'rb') as f:
+                    f.seek(cursor_size)
+                    for line in f:
+                        self._live_record(line, deleted)
+        found = before_id is None or end is not None
+        page = []
+        scan = self._scan_log_back(chat_id, end, deleted)
+        try:
+            for start, msg in scan:
+                if not found:
+                    if msg.get('id') == before_id:
+                        found = True
+                        continue
+                    # Сообщения before_id уже нет (удалено, а журнал мог быть сжат) —
+                    # страница начинается с ближайшего более старого
+                    if not is_older(msg, before_id):
+                        continue
+                    found = True
+                page.append(msg)
+                if len(page) == limit:
+                    self.log_cursors[chat_id] = (msg.get('id'), start, deleted, size)
+                    break
+        finally:
+            scan.close()
+        page.reverse()
+        return page
+
+    def _append_log(self, chat_id, records):
+        chat_id = str(chat_id)
+        # Мусор прошлых запусков досчитается при следующем полном чтении журнала
+        self.log_garbage.setdefault(chat_id, 0)
+        with open(self.log_path(chat_id), 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        # Удаление делает мёртвыми и саму запись-удаление, и удалённое сообщение
+        self.log_garbage[chat_id] += 2 * sum(1 for record in records if record.get('op') == 'delete')
+        if self.log_garbage[chat_id] >= COMPACT_THRESHOLD:
+            self._compact_log(chat_id)
+
+    def _compact_log(self, chat_id):
+        chat_id = str(chat_id)
+        messages = self._read_log(chat_id)
+        path = self.log_path(chat_id)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for msg in messages:
+                f.write(json.dumps(msg) + "\n")
+        os.replace(tmp_path, path)
+        self.log_garbage[chat_id] = 0
+        self.log_cursors.pop(chat_id, None)
+
+    def message_chat_ids(self):
+        """Список чатов, для которых есть журнал сообщений"""
+        return [file[:-len(".jsonl")] for file in os.listdir(self.messages_dir) if file.endswith(".jsonl")]
+
+    def compact(self):
+        """Переписывает журналы всех чатов, убирая удалённые сообщения"""
+        self.mutex.acquire()
+        try:
+            for chat_id in self.message_chat_ids():
+                self._compact_log(chat_id)
+        except Exception as e:
+            print(f"Error compacting messages: {e}")
+        finally:
+            self.mutex.release()
+    
+    def save_message(self, chat_id, message, is_outgoing, msg_type="text", file_path=None, file_name=None, photo_file=None,
+                     photo_path=None, file_id=None):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            msg_obj = build_message(os.path.join(self.db_path, "photos_cache"), message, is_outgoing,
+                                    msg_type, file_path, file_name, photo_file, photo_path, file_id)
+            self._append_log(chat_id, [msg_obj])
+            self._add_to_summary(chat_id, [msg_obj])
+            self._save_summaries([chat_id])
+            self._index_messages(chat_id, [msg_obj])
+            return msg_obj
+        except Exception as e:
+            print(f"Error saving message: {e}")
+        finally:
+            self.mutex.release()
+
+    def get_messages(self, chat_id, before_id=None, limit=None):
+        """Последние limit сообщений чата (все при limit=None), старше сообщения before_id"""
+        self.mutex.acquire()
+        try:
+            if limit:
+                # Страница читается с конца журнала, не разбирая всю историю
+                messages = self._read_page(str(chat_id), before_id, limit)
+            else:
+                messages = self._read_log(chat_id)
+                if before_id is not None:
+                    end = next((i for i, msg in enumerate(messages) if msg.get('id') == before_id), None)
+                    if end is None:
+                        end = sum(1 for msg in messages if is_older(msg, before_id))
+                    messages = messages[:end]
+            for msg in messages:
+                normalize_message(msg)
+            return messages
+        except:
+            return []
+        finally:
+            self.mutex.release()
+
+    def delete_message(self, chat_id, message_id):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            if os.path.exists(self.log_path(chat_id)):
+                self._remove_from_summary(chat_id, message_id)
+                self._append_log(chat_id, [{'op': 'delete', 'id': message_id}])
+                if self.search_index is not None:
+                    self.search_index.remove(chat_id, message_id)
+                return True
+            return False
+        except:
+            return False
+        finally:
+            self.mutex.release()
+
+    def clear_chat(self, chat_id):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            path = self.log_path(chat_id)
+            if os.path.exists(path):
+                open(path, 'w', encoding='utf-8').close()
+                self.log_garbage[chat_id] = 0
+                self.log_cursors.pop(chat_id, None)
+                self._clear_summary(chat_id)
+                if self.search_index is not None:
+                    self.search_index.remove_chat(chat_id)
+                return True
+            return False
+        except:
+            return False
+        finally:
+            self.mutex.release()
+
+    def append_messages(self, chat_id, messages):
+        """Дописывает готовые записи сообщений в журнал чата"""
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            self._append_log(chat_id, messages)
+            self._add_to_summary(chat_id, messages)
+            self._save_summaries([chat_id])
+            self._index_messages(chat_id, messages)
+        except Exception as e:
+            print(f"Error saving messages: {e}")
+        finally:
+            self.mutex.release()
+
+    def save_chat(self, chat_data):
+        self.save_chats([chat_data])
+
+    def save_chats(self, chats):
+        self.mutex.acquire()
+        try:
+            self._save_chats(chats)
+        except Exception as e:
+            print(f"Error saving chat: {e}")
+        finally:
+            self.mutex.release()
+
+    def _save_chats(self, chats):
+        path = os.path.join(self.db_path, "chats.json")
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        for chat_data in chats:
+            cid = str(chat_data['id'])
+            if cid not in data:
+                data[cid] = chat_data
+            else:
+                merge_chat(data[cid], chat_data)
+            if self.search_index is not None:
+                self.search_index.add(cid, None, chat_title(cid, data[cid]))
+        
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+    def write_batch(self, chats, messages, processed=()):
+        """Записывает пакет: один раз chats.json, по одному дописыванию на чат и, после сообщений,
+        processed.json. Записанные чаты убираются из messages, так что после ошибки в нём остаётся
+        только незаписанное"""
+        self.mutex.acquire()
+        try:
+            if chats:
+                self._save_chats(chats)
+            written = []
+            try:
+                for chat_id in list(messages):
+                    chat_messages = messages[chat_id]
+                    self._append_log(chat_id, chat_messages)
+                    del messages[chat_id]
+                    written.append(str(chat_id))
+                    self._add_to_summary(str(chat_id), chat_messages)
+                    self._index_messages(str(chat_id), chat_messages)
+            finally:
+                if written:
+                    self._save_summaries(written)
+            if processed:
+                self._save_processed()
+        finally:
+            self.mutex.release()
+            
+    def get_chats(self):
+        self.mutex.acquire()
+        try:
+            with open(os.path.join(self.db_path, "chats.json"), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            for cid, chat_data in data.items():
+                if 'id' not in chat_data:
+                    chat_data['id'] = cid
+            return data
+        except:
+            return {}
+        finally:
+            self.mutex.release()
+
+    def get_summaries(self):
+        self.mutex.acquire()
+        try:
+            return {cid: dict(summary) for cid, summary in self.summaries.items()}
+        finally:
+            self.mutex.release()
+
+    def get_summary(self, chat_id):
+        self.mutex.acquire()
+        try:
+            return dict(self.summaries.get(str(chat_id)) or summarize_messages([]))
+        finally:
+            self.mutex.release()
+
+    def mark_read(self, chat_id, read_timestamp=None):
+        self.mutex.acquire()
+        try:
+            # Сводки может ещё не быть, если сообщения чата пока лежат в кэше и не записаны
+            summary = self.summaries.setdefault(str(chat_id), summarize_messages([]))
+            if summary['unread'] or read_timestamp is not None:
+                mark_summary_read(summary, read_timestamp)
+                self._save_summaries([str(chat_id)])
+        except Exception as e:
+            print(f"Error saving summaries: {e}")
+        finally:
+            self.mutex.release()
+
+    def is_processed(self, update_id):
+        return self.processed.is_processed(update_id)
+
+    def mark_processed(self, update_id):
+        self.processed.mark_processed(update_id)
+
+    def flush_processed(self):
+        """Сохраняет окно обработанных update_id в processed.json"""
+        ids = self.processed.take_unsaved()
+        if not ids:
+            return
+        try:
+            self._save_processed()
+        except Exception as e:
+            print(f"Error saving processed updates: {e}")
+            self.processed.restore_unsaved(ids)
+
+    def _save_processed(self):
+        path = os.path.join(self.db_path, "processed.json")
+        with open(path + ".tmp", 'w') as f:
+            json.dump(self.processed.state(), f)
+        os.replace(path + ".tmp", path)
+
+    def clear_all_data(self):
+        """Очистка всех данных при выходе из аккаунта"""
+        self.mutex.acquire()
+        try:
+
+            for file in ["chats.json", "processed.json"]:
+                path = os.path.join(self.db_path, file)
+                if os.path.exists(path):
+                    with open(path, 'w', encoding='utf-8') as f:
+                        json.dump({}, f)
+            open(os.path.join(self.db_path, SUMMARIES_FILE), 'w', encoding='utf-8').close()
+            self.summary_records = 0
+
+            if os.path.exists(self.messages_dir):
+                for file in os.listdir(self.messages_dir):
+                    try:
+                        os.remove(os.path.join(self.messages_dir, file))
+                    except:
+                        pass
+            self.log_garbage.clear()
+            self.log_cursors.clear()
+            self.summaries = {}
+            self.search_index = None
+            self.processed = UpdateDeduplicator()
+            remove_send_queue(self.db_path)
+            
+
+            photos_cache = os.path.join(self.db_path, "photos_cache")
+            if os.path.exists(photos_cache):
+                for file in os.listdir(photos_cache):
+                    file_path = os.path.join(photos_cache, file)
+                    try:
+                        os.remove(file_path)
+                    except:
+                        pass
+        finally:
+            self.mutex.release()
+
+
+class SQLiteDatabase:
+    """Хранилище в SQLite (WAL) с тем же интерфейсом, что и Database"""
+    def __init__(self, db_path=DATA_DIR):
+        self.db_path = db_path
+        self.mutex = threading.Lock()
+        self.summaries = {}
+        self.processed = UpdateDeduplicator()
+        if not os.path.exists(db_path):
+            os.makedirs(db_path)
+        photos_cache = os.path.join(db_path, "photos_cache")
+        if not os.path.exists(photos_cache):
+            os.makedirs(photos_cache)
+        self.conn = sqlite3.connect(os.path.join(db_path, "bot.sqlite3"), check_same_thread=False)
+        self.init_database()
+
+    def init_database(self):
+        self.mutex.acquire()
+        try:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL,
+                    id INTEGER NOT NULL,
+                    timestamp REAL NOT NULL DEFAULT 0,
+                    out INTEGER NOT NULL DEFAULT 0,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_time ON messages (chat_id, timestamp);
+                CREATE INDEX IF NOT EXISTS idx_messages_id ON messages (id);
+                CREATE TABLE IF NOT EXISTS processed (
+                    update_id INTEGER PRIMARY KEY
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS summaries (
+                    chat_id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, prefix='1 2 3');
+                CREATE VIRTUAL TABLE IF NOT EXISTS chats_fts USING fts5(name, chat_id UNINDEXED);
+            """)
+            self.conn.commit()
+            migrated = self.conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        finally:
+            self.mutex.release()
+        if not migrated:
+            self.migrate_from_json()
+        self.load_processed()
+        self.load_summaries()
+        self.build_search_index()
+
+    def build_search_index(self):
+        """Один раз заполняет полнотекстовый индекс в базе, созданной до его появления"""
+        self.mutex.acquire()
+        try:
+            if self.conn.execute("SELECT value FROM meta WHERE key = 'fts_built'").fetchone():
+                return
+            with self.conn:
+                self.conn.execute("DELETE FROM messages_fts")
+                self.conn.execute("DELETE FROM chats_fts")
+                rows = self.conn.execute("SELECT seq, data FROM messages")
+                self.conn.executemany("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)",
+                                      ((seq, json.loads(data).get('text', '')) for seq, data in rows))
+                for cid, data in self.conn.execute("SELECT id, data FROM chats").fetchall():
+                    self._index_chat(cid, json.loads(data))
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fts_built', ?)",
+                                  (datetime.now().isoformat(),))
+        except Exception as e:
+            print(f"Error building search index: {e}")
+        finally:
+            self.mutex.release()
+
+    def _index_chat(self, chat_id, chat_data):
+        self.conn.execute("DELETE FROM chats_fts WHERE chat_id = ?", (chat_id,))
+        self.conn.execute("INSERT INTO chats_fts (name, chat_id) VALUES (?, ?)", (chat_title(chat_id, chat_data), chat_id))
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Поиск по FTS5: сначала подходящие чаты, затем сообщения по bm25 и свежести"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        match = search_terms_query(terms)
+        self.mutex.acquire()
+        try:
+            hits = [{'chat_id': cid, 'message_id': None, 'text': name, 'timestamp': 0}
+                    for name, cid in self.conn.execute(
+                        "SELECT name, chat_id FROM chats_fts WHERE chats_fts MATCH ? ORDER BY rank LIMIT ?",
+                        (match, limit))]
+            # bm25 считается только для SEARCH_CANDIDATES самых новых совпадений: частое слово
+            # иначе заставило бы ранжировать все сообщения архива
+            rows = self.conn.execute("""
+                SELECT m.chat_id, m.id, m.timestamp, m.data FROM (
+                    SELECT rowid, rank FROM messages_fts WHERE messages_fts MATCH ?
+                    ORDER BY rowid DESC LIMIT ?
+                ) AS f JOIN messages m ON m.seq = f.rowid
+                ORDER BY f.rank, m.timestamp DESC LIMIT ?
+            """, (match, SEARCH_CANDIDATES, limit - len(hits))).fetchall()
+            hits.extend({'chat_id': cid, 'message_id': message_id, 'text': json.loads(data).get('text', ''),
+                         'timestamp': timestamp} for cid, message_id, timestamp, data in rows)
+            return hits
+        except Exception as e:
+            print(f"Error searching messages: {e}")
+            return []
+        finally:
+            self.mutex.release()
+
+    def load_summaries(self):
+        """Читает сводки чатов; в базе, созданной до их появления, строит их один раз по сообщениям"""
+        self.mutex.acquire()
+        try:
+            built = self.conn.execute("SELECT value FROM meta WHERE key = 'summaries_built'").fetchone()
+            if not built:
+                with self.conn:
+                    self.summaries = {}
+                    for (chat_id,) in self.conn.execute("SELECT DISTINCT chat_id FROM messages").fetchall():
+                        self.summaries[chat_id] = summarize_messages(self._chat_messages(chat_id))
+                        self._save_summary(chat_id)
+                    self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('summaries_built', ?)",
+                                      (datetime.now().isoformat(),))
+            self.summaries = {chat_id: json.loads(data)
+                              for chat_id, data in self.conn.execute("SELECT chat_id, data FROM summaries")}
+        except Exception as e:
+            print(f"Error loading summaries: {e}")
+        finally:
+            self.mutex.release()
+
+    def _save_summary(self, chat_id):
+        self.conn.execute("INSERT OR REPLACE INTO summaries (chat_id, data) VALUES (?, ?)",
+                          (chat_id, json.dumps(self.summaries[chat_id])))
+
+    def _remove_from_summary(self, chat_id, removed):
+        """Вычитает удалённые сообщения из сводки; превью берётся у самого нового из оставшихся"""
+        summary = self.summaries.get(chat_id) or summarize_messages([])
+        for msg in removed:
+            remove_from_summary(summary, msg)
+        row = self.conn.execute("SELECT data FROM messages WHERE chat_id = ? ORDER BY timestamp DESC, seq DESC LIMIT 1",
+                                (chat_id,)).fetchone()
+        set_summary_last(summary, None if row is None else normalize_message(json.loads(row[0])))
+        self.summaries[chat_id] = summary
+        self._save_summary(chat_id)
+
+    def _clear_summary(self, chat_id):
+        read_timestamp = self.summaries.get(chat_id, {}).get('read_timestamp', 0)
+        self.summaries[chat_id] = summarize_messages([], read_timestamp)
+        self._save_summary(chat_id)
+
+    def load_processed(self):
+        self.mutex.acquire()
+        try:
+            rows = self.conn.execute("SELECT update_id FROM processed ORDER BY update_id DESC LIMIT ?",
+                                     (PROCESSED_WINDOW,)).fetchall()
+            self.processed.load(row[0] for row in rows)
+        except Exception as e:
+            print(f"Error loading processed updates: {e}")
+        finally:
+            self.mutex.release()
+
+    def migrate_from_json(self):
+        """Однократный перенос данных из telegram_bot_data/*.json"""
+        json_db = Database(self.db_path)
+        chats = json_db.get_chats()
+        chat_ids = set(chats) | set(json_db.message_chat_ids())
+        history = {cid: json_db.get_messages(cid) for cid in chat_ids}
+        processed = json_db.processed.state()['recent']
+
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                for cid, chat_data in chats.items():
+                    self.conn.execute("INSERT OR REPLACE INTO chats (id, data) VALUES (?, ?)",
+                                      (str(cid), json.dumps(chat_data)))
+                for cid, messages in history.items():
+                    self._insert_messages(str(cid), messages)
+                self.conn.executemany("INSERT OR IGNORE INTO processed (update_id) VALUES (?)",
+                                      [(int(update_id),) for update_id in processed])
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+                                  (datetime.now().isoformat(),))
+        except Exception as e:
+            print(f"Error migrating JSON data: {e}")
+        finally:
+            self.mutex.release()
+
+    def _message_row(self, chat_id, msg):
+        return (str(chat_id), msg.get('id', 0), msg.get('timestamp', 0),
+                1 if msg.get('out') else 0, json.dumps(msg))
+
+    def _insert_messages(self, chat_id, messages):
+        for msg in messages:
+            cur = self.conn.execute("INSERT INTO messages (chat_id, id, timestamp, out, data) VALUES (?, ?, ?, ?, ?)",
+                                    self._message_row(chat_id, msg))
+            self.conn.execute("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)",
+                              (cur.lastrowid, msg.get('text', '')))
+        summary = self.summaries.get(chat_id) or summarize_messages([])
+        for msg in messages:
+            update_summary(summary, msg)
+        self.summaries[chat_id] = summary
+        self._save_summary(chat_id)
+
+    def save_message(self, chat_id, message, is_outgoing, msg_type="text", file_path=None, file_name=None, photo_file=None,
+                     photo_path=None, file_id=None):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            msg_obj = build_message(os.path.join(self.db_path, "photos_cache"), message, is_outgoing,
+                                    msg_type, file_path, file_name, photo_file, photo_path, file_id)
+            with self.conn:
+                self._insert_messages(chat_id, [msg_obj])
+            return msg_obj
+        except Exception as e:
+            print(f"Error saving message: {e}")
+        finally:
+            self.mutex.release()
+
+    def _chat_messages(self, chat_id, before_id=None, limit=None):
+        chat_id = str(chat_id)
+        if before_id is None:
+            rows = self.conn.execute("""
+                SELECT data FROM (
+                    SELECT seq, timestamp, data FROM messages WHERE chat_id = ?
+                    ORDER BY timestamp DESC, seq DESC LIMIT ?
+                ) ORDER BY timestamp, seq
+            """, (chat_id, limit or -1)).fetchall()
+        else:
+            anchor = self.conn.execute("SELECT timestamp, seq FROM messages WHERE chat_id = ? AND id = ? ORDER BY seq LIMIT 1",
+                                       (chat_id, before_id)).fetchone()
+            if anchor is not None:
+                # Страница идёт по индексу (chat_id, timestamp) от позиции сообщения before_id
+                rows = self.conn.execute("""
+                    SELECT data FROM (
+                        SELECT seq, timestamp, data FROM messages
+                        WHERE chat_id = ? AND (timestamp, seq) < (?, ?)
+                        ORDER BY timestamp DESC, seq DESC LIMIT ?
+                    ) ORDER BY timestamp, seq
+                """, (chat_id, anchor[0], anchor[1], limit or -1)).fetchall()
+            else:
+                # Сообщение before_id удалено: берём более старые по id, а id не меньше времени
+                # создания в миллисекундах, так что поиск остаётся в пределах индекса по времени
+                rows = self.conn.execute("""
+                    SELECT data FROM (
+                        SELECT seq, timestamp, data FROM messages
+                        WHERE chat_id = ? AND timestamp <= ? AND id < ?
+                        ORDER BY timestamp DESC, seq DESC LIMIT ?
+                    ) ORDER BY timestamp, seq
+                """, (chat_id, before_id / 1000, before_id, limit or -1)).fetchall()
+        return [normalize_message(json.loads(row[0])) for row in rows]
+
+    def get_messages(self, chat_id, before_id=None, limit=None):
+        """Последние limit сообщений чата (все при limit=None), старше сообщения before_id"""
+        self.mutex.acquire()
+        try:
+            return self._chat_messages(chat_id, before_id, limit)
+        except:
+            return []
+        finally:
+            self.mutex.release()
+
+    def _chat_exists(self, chat_id):
+        return self.conn.execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone() is not None
+
+    def delete_message(self, chat_id, message_id):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            with self.conn:
+                removed = [normalize_message(json.loads(data)) for (data,) in self.conn.execute(
+                    "SELECT data FROM messages WHERE id = ? AND chat_id = ?", (message_id, chat_id))]
+                self.conn.execute("""
+                    DELETE FROM messages_fts WHERE rowid IN (SELECT seq FROM messages WHERE id = ? AND chat_id = ?)
+                """, (message_id, chat_id))
+                cur = self.conn.execute("DELETE FROM messages WHERE id = ? AND chat_id = ?", (message_id, chat_id))
+                if cur.rowcount:
+                    self._remove_from_summary(chat_id, removed)
+            return cur.rowcount > 0 or self._chat_exists(chat_id)
+        except:
+            return False
+        finally:
+            self.mutex.release()
+
+    def clear_chat(self, chat_id):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            with self.conn:
+                self.conn.execute("DELETE FROM messages_fts WHERE rowid IN (SELECT seq FROM messages WHERE chat_id = ?)",
+                                  (chat_id,))
+                cur = self.conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                self._clear_summary(chat_id)
+            return cur.rowcount > 0 or self._chat_exists(chat_id)
+        except:
+            return False
+        finally:
+            self.mutex.release()
+
+    def append_messages(self, chat_id, messages):
+        """Записывает готовые записи сообщений одной транзакцией"""
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                self._insert_messages(str(chat_id), messages)
+        except Exception as e:
+            print(f"Error saving messages: {e}")
+        finally:
+            self.mutex.release()
+
+    def save_chat(self, chat_data):
+        self.save_chats([chat_data])
+
+    def save_chats(self, chats):
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                self._save_chats(chats)
+        except Exception as e:
+            print(f"Error saving chat: {e}")
+        finally:
+            self.mutex.release()
+
+    def _save_chats(self, chats):
+        for chat_data in chats:
+            cid = str(chat_data['id'])
+            row = self.conn.execute("SELECT data FROM chats WHERE id = ?", (cid,)).fetchone()
+            stored = None if row is None else json.loads(row[0])
+            data = chat_data if stored is None else merge_chat(dict(stored), chat_data)
+            self.conn.execute("INSERT OR REPLACE INTO chats (id, data) VALUES (?, ?)",
+                              (cid, json.dumps(data)))
+            if data != stored:
+                self._index_chat(cid, data)
+
+    def write_batch(self, chats, messages, processed=()):
+        """Записывает чаты, сообщения и обработанные update_id пакета одной транзакцией"""
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                self._save_chats(chats)
+                for chat_id, chat_messages in messages.items():
+                    self._insert_messages(str(chat_id), chat_messages)
+                if processed:
+                    self._insert_processed(processed)
+            messages.clear()
+        finally:
+            self.mutex.release()
+
+    def get_chats(self):
+        self.mutex.acquire()
+        try:
+            data = {}
+            for cid, chat_json in self.conn.execute("SELECT id, data FROM chats ORDER BY rowid"):
+                chat_data = json.loads(chat_json)
+                if 'id' not in chat_data:
+                    chat_data['id'] = cid
+                data[cid] = chat_data
+            return data
+        except:
+            return {}
+        finally:
+            self.mutex.release()
+
+    def get_summaries(self):
+        self.mutex.acquire()
+        try:
+            return {cid: dict(summary) for cid, summary in self.summaries.items()}
+        finally:
+            self.mutex.release()
+
+    def get_summary(self, chat_id):
+        self.mutex.acquire()
+        try:
+            return dict(self.summaries.get(str(chat_id)) or summarize_messages([]))
+        finally:
+            self.mutex.release()
+
+    def mark_read(self, chat_id, read_timestamp=None):
+        self.mutex.acquire()
+        try:
+            chat_id = str(chat_id)
+            # Сводки может ещё не быть, если сообщения чата пока лежат в кэше и не записаны
+            summary = self.summaries.setdefault(chat_id, summarize_messages([]))
+            if summary['unread'] or read_timestamp is not None:
+                mark_summary_read(summary, read_timestamp)
+                with self.conn:
+                    self._save_summary(chat_id)
+        except Exception as e:
+            print(f"Error saving summaries: {e}")
+        finally:
+            self.mutex.release()
+
+    def is_processed(self, update_id):
+        return self.processed.is_processed(update_id)
+
+    def mark_processed(self, update_id):
+        self.processed.mark_processed(update_id)
+
+    def flush_processed(self):
+        """Дописывает новые update_id в таблицу processed"""
+        ids = self.processed.take_unsaved()
+        if not ids:
+            return
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                self._insert_processed(ids)
+        except Exception as e:
+            print(f"Error saving processed updates: {e}")
+            self.processed.restore_unsaved(ids)
+        finally:
+            self.mutex.release()
+
+    def _insert_processed(self, ids):
+        """Дописывает update_id и обрезает таблицу до окна"""
+        self.conn.executemany("INSERT OR IGNORE INTO processed (update_id) VALUES (?)",
+                              [(update_id,) for update_id in ids])
+        self.conn.execute("""
+            DELETE FROM processed WHERE update_id < (
+                SELECT MIN(update_id) FROM (
+                    SELECT update_id FROM processed ORDER BY update_id DESC LIMIT ?
+                )
+            )
+        """, (PROCESSED_WINDOW,))
+
+    def clear_all_data(self):
+        """Очистка всех данных при выходе из аккаунта"""
+        self.mutex.acquire()
+        try:
+            with self.conn:
+                self.conn.execute("DELETE FROM messages")
+                self.conn.execute("DELETE FROM chats")
+                self.conn.execute("DELETE FROM processed")
+                self.conn.execute("DELETE FROM summaries")
+                self.conn.execute("DELETE FROM messages_fts")
+                self.conn.execute("DELETE FROM chats_fts")
+            self.summaries = {}
+            self.processed = UpdateDeduplicator()
+            remove_send_queue(self.db_path)
+
+            photos_cache = os.path.join(self.db_path, "photos_cache")
+            if os.path.exists(photos_cache):
+                for file in os.listdir(photos_cache):
+                    file_path = os.path.join(photos_cache, file)
+                    try:
+                        os.remove(file_path)
+                    except:
+                        pass
+        finally:
+            self.mutex.release()
+
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self.conn.close()
+        finally:
+            self.mutex.release()
+
+
+# Параметры отложенной записи: раз в FLUSH_INTERVAL секунд или по FLUSH_THRESHOLD изменениям
+FLUSH_INTERVAL = 2.0
+FLUSH_THRESHOLD = 50
+
+class CachedDatabase:
+    """Кэш в памяти поверх хранилища с отложенной пакетной записью"""
+    def __init__(self, backend, flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD):
+        self.backend = backend
+        self.db_path = backend.db_path
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.chats = None
+        self.messages = {}
+        self.complete = set()
+        self.summaries = None
+        self.pending_chats = {}
+        self.pending_messages = {}
+        self.dirty_count = 0
+        self.batch_depth = 0
+        self.stop_event = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _load_chats(self):
+        if self.chats is None:
+            self.chats = self.backend.get_chats()
+        return self.chats
+
+    def _load_messages(self, chat_id):
+        """Хвост истории чата; complete отмечает чаты, история которых уместилась целиком"""
+        if chat_id not in self.messages:
+            self.messages[chat_id] = self.backend.get_messages(chat_id, limit=CACHED_MESSAGES_PER_CHAT)
+            if len(self.messages[chat_id]) < CACHED_MESSAGES_PER_CHAT:
+                self.complete.add(chat_id)
+        return self.messages[chat_id]
+
+    def _load_summaries(self):
+        if self.summaries is None:
+            self.summaries = self.backend.get_summaries()
+        return self.summaries
+
+    def _mark_dirty(self):
+        self.dirty_count += 1
+        return not self.batch_depth and self.dirty_count >= self.flush_threshold
+
+    @contextmanager
+    def batch(self):
+        """Копит изменения до конца блока и записывает их одним пакетом"""
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                done = not self.batch_depth
+            if done:
+                self.flush()
+
+    def save_message(self, chat_id, message, is_outgoing, msg_type="text", file_path=None, file_name=None, photo_file=None,
+                     photo_path=None, file_id=None):
+        chat_id = str(chat_id)
+        try:
+            msg_obj = build_message(os.path.join(self.db_path, "photos_cache"), message, is_outgoing,
+                                    msg_type, file_path, file_name, photo_file, photo_path, file_id)
+        except Exception as e:
+            print(f"Error saving message: {e}")
+            return
+        with self.lock:
+            messages = self._load_messages(chat_id)
+            messages.append(msg_obj)
+            if len(messages) > CACHED_MESSAGES_PER_CHAT:
+                del messages[:-CACHED_MESSAGES_PER_CHAT]
+                self.complete.discard(chat_id)
+            summaries = self._load_summaries()
+            summaries[chat_id] = update_summary(summaries.get(chat_id) or summarize_messages([]), msg_obj)
+            self.pending_messages.setdefault(chat_id, []).append(msg_obj)
+            need_flush = self._mark_dirty()
+        if need_flush:
+            self.flush()
+        return msg_obj
+
+    def get_messages(self, chat_id, before_id=None, limit=None):
+        """Страница истории из кэша; если она выходит за кэшированный хвост — из хранилища"""
+        chat_id = str(chat_id)
+        with self.lock:
+            messages = self._load_messages(chat_id)
+            if before_id is None:
+                end = len(messages)
+            else:
+                end = next((i for i, msg in enumerate(messages) if msg.get('id') == before_id), None)
+            if end is not None and (chat_id in self.complete or (limit and end >= limit)):
+                return messages[max(0, end - limit) if limit else 0:end]
+        self.flush()
+        return self.backend.get_messages(chat_id, before_id, limit)
+
+    def delete_message(self, chat_id, message_id):
+        chat_id = str(chat_id)
+        with self.lock:
+            if chat_id in self.messages:
+                self.messages[chat_id] = [msg for msg in self.messages[chat_id] if msg['id'] != message_id]
+        with self.flush_lock:
+            self._write_pending()
+            result = self.backend.delete_message(chat_id, message_id)
+            self._reload_summary(chat_id)
+        return result
+
+    def clear_chat(self, chat_id):
+        chat_id = str(chat_id)
+        with self.lock:
+            self.messages[chat_id] = []
+            self.complete.add(chat_id)
+        with self.flush_lock:
+            self._write_pending()
+            result = self.backend.clear_chat(chat_id)
+            self._reload_summary(chat_id)
+        return result
+
+    def _reload_summary(self, chat_id):
+        """Сводка из хранилища плюс сообщения, сохранённые уже после записи пакета.
+
+        Вызывается под flush_lock: пока он взят, эти сообщения не попадут в хранилище
+        и не будут учтены дважды.
+        """
+        summary = self.backend.get_summary(chat_id)
+        with self.lock:
+            for msg in self.pending_messages.get(chat_id, ()):
+                update_summary(summary, msg)
+            self._load_summaries()[chat_id] = summary
+
+    def get_summaries(self):
+        with self.lock:
+            return {cid: dict(summary) for cid, summary in self._load_summaries().items()}
+
+    def get_summary(self, chat_id):
+        with self.lock:
+            return dict(self._load_summaries().get(str(chat_id)) or summarize_messages([]))
+
+    def mark_read(self, chat_id):
+        """Отмечает чат прочитанным; в хранилище передаётся время последнего сообщения из кэша,
+        поэтому ещё не записанные сообщения тоже считаются прочитанными"""
+        chat_id = str(chat_id)
+        with self.lock:
+            summary = self._load_summaries().get(chat_id)
+            if not summary or not summary['unread']:
+                return
+            mark_summary_read(summary)
+            read_timestamp = summary['read_timestamp']
+        self.backend.mark_read(chat_id, read_timestamp)
+
+    def save_chat(self, chat_data):
+        cid = str(chat_data['id'])
+        with self.lock:
+            chats = self._load_chats()
+            if cid not in chats:
+                chats[cid] = dict(chat_data)
+            else:
+                merge_chat(chats[cid], chat_data)
+            if 'id' not in chats[cid]:
+                chats[cid]['id'] = cid
+            self.pending_chats[cid] = dict(chats[cid])
+            need_flush = self._mark_dirty()
+        if need_flush:
+            self.flush()
+
+    def get_chats(self):
+        with self.lock:
+            return {cid: dict(chat_data) for cid, chat_data in self._load_chats().items()}
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """Поиск идёт по хранилищу, поэтому сначала записываем накопленное"""
+        self.flush()
+        return self.backend.search(query, limit)
+
+    @property
+    def processed(self):
+        return self.backend.processed
+
+    def is_processed(self, update_id):
+        return self.backend.is_processed(update_id)
+
+    def mark_processed(self, update_id):
+        """update_id попадает на диск в одном пакете с сообщениями, сохранёнными до него"""
+        with self.lock:
+            if not self.backend.processed.mark_processed(update_id):
+                return
+            need_flush = self._mark_dirty()
+        if need_flush:
+            self.flush()
+
+    def flush(self):
+        """Сбрасывает накопленные изменения в хранилище"""
+        with self.flush_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """Записывает накопленный пакет; вызывается под flush_lock"""
+        with self.lock:
+            chats = list(self.pending_chats.values())
+            messages = self.pending_messages
+            processed = self.backend.processed.take_unsaved()
+            self.pending_chats = {}
+            self.pending_messages = {}
+            self.dirty_count = 0
+        if chats or messages or processed:
+            try:
+                self.backend.write_batch(chats, messages, processed)
+            except Exception as e:
+                print(f"Error writing batch: {e}")
+                self._requeue(chats, messages, processed)
+
+    def _requeue(self, chats, messages, processed):
+        """Возвращает незаписанный пакет в очередь перед изменениями, пришедшими во время записи"""
+        with self.lock:
+            self.backend.processed.restore_unsaved(processed)
+            for chat_data in chats:
+                # Более новая запись чата уже содержит слитые данные старой
+                self.pending_chats.setdefault(str(chat_data['id']), chat_data)
+            for chat_id, chat_messages in messages.items():
+                self.pending_messages[chat_id] = chat_messages + self.pending_messages.get(chat_id, [])
+            self.dirty_count += len(chats) + len(processed) + sum(len(chat_messages) for chat_messages in messages.values())
+
+    def flush_loop(self):
+        while not self.stop_event.wait(self.flush_interval):
+            if self.dirty_count and not self.batch_depth:
+                self.flush()
+
+    def clear_all_data(self):
+        """Очистка всех данных при выходе из аккаунта"""
+        with self.flush_lock:
+            with self.lock:
+                self.chats = None
+                self.messages = {}
+                self.complete = set()
+                self.summaries = None
+                self.pending_chats = {}
+                self.pending_messages = {}
+                self.dirty_count = 0
+            self.backend.clear_all_data()
+
+    def close(self):
+        self.stop_event.set()
+        self.flush()
+        if hasattr(self.backend, 'close'):
+            self.backend.close()
+
+
+def open_database(backend="json", db_path=DATA_DIR,
+                  flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD):
+    """Создаёт кэшированное хранилище выбранного типа ('json' или 'sqlite')"""
+    if backend == "sqlite":
+        store = SQLiteDatabase(db_path)
+    else:
+        store = Database(db_path)
+        store.start_search_index()
+    return CachedDatabase(store, flush_interval, flush_threshold)
+
+
+API_URL = "https://api.telegram.org"
+# Long polling: сервер держит getUpdates открытым до POLL_TIMEOUT секунд
+POLL_TIMEOUT = 10
+# Экспоненциальная пауза после ошибок: BACKOFF_BASE * 2^n, но не больше BACKOFF_MAX
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# Режим webhook: Telegram сам присылает update POST-запросами на встроенный HTTP-сервер
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram-webhook"
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_MAX_CONNECTIONS = 40
+# Сколько одновременно пришедших update обрабатывается одним пакетом записи
+WEBHOOK_BATCH = 100
+
+# Сколько фото скачивается одновременно
+PHOTO_DOWNLOAD_WORKERS = 4
+# Пул keep-alive соединений к Bot API и политика повторов
+HTTP_POOL_SIZE = 20
+HTTP_RETRIES = 3
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+
+class RetryableStatus(Exception):
+    pass
+
+
+class EngineStopping(Exception):
+    """Движок останавливается, и update из очереди webhook уже не будет записан"""
+
+
+class AsyncBotApi:
+    """Асинхронный клиент Bot API поверх одной aiohttp-сессии с пулом соединений"""
+    def __init__(self, token, api_url=API_URL, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+        self.token = token
+        self.api_url = api_url
+        self.pool_size = pool_size
+        self.retries = retries
+        self.session = None
+
+    async def open(self):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def method_url(self, method):
+        return f"{self.api_url}/bot{self.token}/{method}"
+
+    async def request(self, http_method, url, read_timeout=HTTP_READ_TIMEOUT, dest=None, **kwargs):
+        """Возвращает (HTTP-статус, тело ответа).
+
+        Повторяет запрос при ошибке соединения (запрос ещё не ушёл, это безопасно для любых
+        методов), а при 5xx — только для GET, чтобы не отправить сообщение дважды.
+        Если задан dest, успешный ответ пишется в этот файл блоками, а вместо тела возвращается путь.
+        """
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=read_timeout)
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(http_method, url, timeout=timeout, **kwargs) as resp:
+                    if resp.status >= 500 and http_method == 'GET' and attempt < self.retries:
+                        raise RetryableStatus()
+                    if dest and resp.status == 200:
+                        with open(dest, 'wb') as f:
+                            async for chunk in resp.content.iter_chunked(FILE_CHUNK_SIZE):
+                                f.write(chunk)
+                        return resp.status, dest
+                    if resp.content_type == 'application/json':
+                        return resp.status, await resp.json()
+                    return resp.status, await resp.read()
+            except (aiohttp.ClientConnectorError, RetryableStatus):
+                if attempt >= self.retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(0.3 * 2 ** (attempt - 1))
+
+    async def call(self, method, data=None, read_timeout=HTTP_READ_TIMEOUT):
+        return await self.request('POST', self.method_url(method), read_timeout=read_timeout, data=data)
+
+    async def get_updates(self, offset, timeout, allowed_updates=None):
+        params = {'offset': offset, 'timeout': timeout}
+        if allowed_updates is not None:
+            params['allowed_updates'] = json.dumps(allowed_updates)
+        return await self.request('GET', self.method_url("getUpdates"), read_timeout=timeout + 5, params=params)
+
+    async def set_webhook(self, url, secret_token, allowed_updates=None, max_connections=WEBHOOK_MAX_CONNECTIONS):
+        data = {'url': url, 'secret_token': secret_token, 'max_connections': max_connections}
+        if allowed_updates is not None:
+            data['allowed_updates'] = json.dumps(allowed_updates)
+        return await self.call("setWebhook", data=data)
+
+    async def delete_webhook(self, drop_pending_updates=False):
+        return await self.call("deleteWebhook", data={'drop_pending_updates': str(drop_pending_updates).lower()})
+
+    async def get_file(self, file_id):
+        return await self.call("getFile", data={'file_id': file_id})
+
+    async def download_file(self, file_path, dest):
+        """Скачивает файл сразу на диск, не держа его целиком в памяти"""
+        return await self.request('GET', f"{self.api_url}/file/bot{self.token}/{file_path}", dest=dest)
+
+    async def send_message(self, chat_id, text):
+        return await self.call("sendMessage", data={'chat_id': str(chat_id), 'text': text})
+
+    async def send_file(self, method, field, chat_id, file_path):
+        import aiohttp
+        # Файл передаётся объектом: aiohttp читает его блоками прямо в multipart-тело
+        with open(file_path, 'rb') as f:
+            form = aiohttp.FormData()
+            form.add_field('chat_id', str(chat_id))
+            form.add_field(field, f, filename=os.path.basename(file_path))
+            return await self.call(method, data=form)
+
+    async def send_photo(self, chat_id, file_path):
+        return await self.send_file("sendPhoto", 'photo', chat_id, file_path)
+
+    async def send_document(self, chat_id, file_path):
+        return await self.send_file("sendDocument", 'document', chat_id, file_path)
+
+
+# Лимиты Telegram на отправку: ~30 сообщений/с на бота, 1/с в один чат, 20/мин в группу
+GLOBAL_SEND_RATE = 30
+CHAT_SEND_RATE = 1
+GROUP_SEND_RATE = 20 / 60
+GROUP_SEND_BURST = 20
+SEND_MAX_ATTEMPTS = 5
+SEND_QUEUE_COMPACT = 1000
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до появления целого токена"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class SendQueue:
+    """Постоянная очередь исходящих сообщений.
+
+    Сохраняет порядок внутри чата (в каждом чате не больше одной отправки в полёте),
+    соблюдает лимиты Telegram через token bucket'ы, после ответа 429 ждёт retry_after
+    во всех чатах сразу (flood wait действует на весь бот) и повторяет отправку
+    с экспоненциальной паузой при сетевых ошибках и 5xx.
+    Задания журналируются в send_queue.jsonl и переживают перезапуск.
+    """
+    def __init__(self, api, path, on_finished):
+        self.api = api
+        self.path = path
+        self.on_finished = on_finished
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.in_flight = set()
+        self.paused_until = {}
+        self.flood_until = 0
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.records = 0
+        self.loop = None
+        self.wakeup = asyncio.Event()
+        self.load()
+
+    def load(self):
+        jobs = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('op') == 'done':
+                        jobs.pop(record.get('id'), None)
+                    else:
+                        jobs[record['id']] = record
+        for job in jobs.values():
+            self.queues.setdefault(job['chat_id'], deque()).append(job)
+        self._compact()
+
+    def _append(self, record):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+        self.records += 1
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for queue in self.queues.values():
+                for job in queue:
+                    f.write(json.dumps(job) + "\n")
+        os.replace(tmp_path, self.path)
+        self.records = sum(len(queue) for queue in self.queues.values())
+
+    def put(self, chat_id, text=None, file_path=None):
+        """Ставит сообщение в очередь из любого потока; возвращает id задания"""
+        job = {'id': os.urandom(8).hex(), 'chat_id': str(chat_id), 'text': text,
+               'file_path': file_path, 'attempts': 0}
+        with self.lock:
+            self._append(job)
+            self.queues.setdefault(job['chat_id'], deque()).append(job)
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        return job['id']
+
+    def pending(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def clear(self):
+        """Забывает все задания (выход из аккаунта); отправки в полёте уже не повторяются"""
+        with self.lock:
+            self.queues = {}
+            self.paused_until = {}
+            self.flood_until = 0
+            self._compact()
+
+    def buckets_for(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            buckets = [TokenBucket(CHAT_SEND_RATE, 1)]
+            if chat_id.startswith('-'):
+                buckets.append(TokenBucket(GROUP_SEND_RATE, GROUP_SEND_BURST))
+            self.chat_buckets[chat_id] = buckets
+        return self.chat_buckets[chat_id]
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        tasks = set()
+        try:
+            while True:
+                self.wakeup.clear()
+                delay = self.dispatch(tasks)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.wait(tasks)
+
+    def dispatch(self, tasks):
+        """Запускает все отправки, разрешённые лимитами; возвращает паузу до следующей проверки"""
+        next_check = None
+        with self.lock:
+            now = time.monotonic()
+            if self.flood_until > now:
+                return self.flood_until - now
+            for chat_id in list(self.queues):
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    continue
+                if chat_id in self.in_flight:
+                    continue
+                wait = max([self.paused_until.get(chat_id, 0) - now] +
+                           [bucket.wait_time(now) for bucket in self.buckets_for(chat_id)])
+                if wait <= 0:
+                    wait = self.global_bucket.wait_time(now)
+                    if wait > 0:
+                        next_check = wait if next_check is None else min(next_check, wait)
+                        break
+                    self.global_bucket.take()
+                    for bucket in self.buckets_for(chat_id):
+                        bucket.take()
+                    self.in_flight.add(chat_id)
+                    task = asyncio.ensure_future(self.deliver(queue[0]))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    # Чат, из которого только что отправили, уходит в конец круга
+                    self.queues[chat_id] = self.queues.pop(chat_id)
+                else:
+                    next_check = wait if next_check is None else min(next_check, wait)
+        return next_check
+
+    async def send(self, job):
+        if job['file_path']:
+            ext = os.path.splitext(job['file_path'])[1].lower()
+            if ext in ['.jpg', '.png', '.jpeg']:
+                return await self.api.send_photo(job['chat_id'], job['file_path'])
+            return await self.api.send_document(job['chat_id'], job['file_path'])
+        return await self.api.send_message(job['chat_id'], job['text'])
+
+    async def deliver(self, job):
+        chat_id = job['chat_id']
+        try:
+            status, data = await self.send(job)
+        except asyncio.CancelledError:
+            with self.lock:
+                self.in_flight.discard(chat_id)
+            raise
+        except Exception as e:
+            status, data = None, str(e) or type(e).__name__
+
+        result = None
+        with self.lock:
+            self.in_flight.discard(chat_id)
+            if status == 200 and isinstance(data, dict) and data.get('ok'):
+                result = self.complete(job, True, "")
+            elif status == 429:
+                retry_after = data.get('parameters', {}).get('retry_after', 1) if isinstance(data, dict) else 1
+                self.paused_until[chat_id] = time.monotonic() + retry_after
+                self.flood_until = max(self.flood_until, self.paused_until[chat_id])
+            elif status is None or status >= 500:
+                job['attempts'] += 1
+                if job['attempts'] >= SEND_MAX_ATTEMPTS:
+                    result = self.complete(job, False, data if status is None else f"HTTP {status}")
+                else:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (job['attempts'] - 1))
+                    self.paused_until[chat_id] = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            else:
+                error_msg = data.get('description', 'API Error') if isinstance(data, dict) else f"HTTP {status}"
+                result = self.complete(job, False, error_msg)
+        self.wakeup.set()
+        if result:
+            self.on_finished(*result)
+
+    def complete(self, job, ok, error_msg):
+        queue = self.queues.get(job['chat_id'])
+        if queue and queue[0] is job:
+            queue.popleft()
+        self._append({'op': 'done', 'id': job['id']})
+        if self.records >= SEND_QUEUE_COMPACT or not any(self.queues.values()):
+            self._compact()
+        return job['chat_id'], ok, error_msg
+
+
+# Через сколько секунд одно и то же правило может снова ответить в тот же чат
+AUTO_REPLY_COOLDOWN = 60
+AUTO_REPLY_TYPES = ("keyword", "prefix", "regex")
+
+class KeywordMatcher:
+    """Автомат Ахо — Корасик: все вхождения набора строк за один проход по тексту,
+    сколько бы строк ни было"""
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for pattern, value in patterns:
+            state = 0
+            for ch in pattern:
+                following = self.goto[state].get(ch)
+                if following is None:
+                    following = len(self.goto)
+                    self.goto[state][ch] = following
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = following
+            self.out[state] += ((len(pattern), value),)
+        # Суффиксные ссылки строятся обходом в ширину; выходы наследуются по ним
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[following] = self.goto[fallback].get(ch, 0)
+                self.out[following] += self.out[self.fail[following]]
+
+    def find(self, text):
+        """Генерирует (начало, конец, value) для каждого вхождения"""
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for end, ch in enumerate(text, 1):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, value in out[state]:
+                yield end - length, end, value
+
+
+def is_word_char(ch):
+    return ch.isalnum() or ch == '_'
+
+
+def fold_case(text):
+    """text в нижнем регистре и, если при этом меняется длина (например, "İ" -> "i̇"),
+    номер исходного символа для каждого символа результата; иначе None"""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered, None
+    parts = []
+    positions = []
+    for i, ch in enumerate(text):
+        low = ch.lower()
+        parts.append(low)
+        positions.extend([i] * len(low))
+    return "".join(parts), positions
+
+
+def regex_literal_prefix(pattern):
+    """Буквальное начало регулярки, с которого обязано начинаться любое совпадение, или ""
+
+    Оно кладётся в общий автомат ключевых слов, и сама регулярка проверяется только там,
+    где автомат нашёл это начало.
+    """
+    if '|' in pattern:
+        return ""
+    literal = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+            char, step = pattern[i + 1], 2
+        elif ch not in ".^$*+?{}[]\\|()":
+            char, step = ch, 1
+        else:
+            break
+        quantifier = pattern[i + step:i + step + 1]
+        if quantifier in ('?', '*', '{'):
+            break
+        literal.append(char)
+        if quantifier == '+':
+            break
+        i += step
+    return "".join(literal)
+
+
+class AutoResponder:
+    """Правила автоответа из auto_replies.json:
+
+        [{"type": "keyword", "pattern": "price", "reply": "...", "cooldown": 60}, ...]
+
+    keyword — слово или фраза целиком, prefix — начало сообщения, regex — re.search;
+    keyword и prefix без учёта регистра, regex с re.IGNORECASE. Ключевые слова, префиксы
+    и буквальные начала регулярок собраны в один автомат Ахо — Корасик, остальные регулярки —
+    в одну общую, так что проверка сообщения почти не зависит от числа правил. Отвечает правило, совпавшее раньше всех
+    в тексте, при равенстве — стоящее выше в списке; повторно в тот же чат — не раньше cooldown.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.rules = []
+        self.keywords = None
+        self.regex = None
+        self.separate = []
+        self.last_reply = {}
+        self.reload()
+
+    def reload(self):
+        """Перечитывает файл правил, если он изменился с прошлого раза"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        rules = []
+        if mtime is not None:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    rules = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error loading auto replies: {e}")
+        self.compile(rules)
+
+    def compile(self, rules):
+        self.rules = []
+        self.last_reply = {}
+        keywords = []
+        regexes = []
+        self.separate = []
+        for rule in rules:
+            kind = rule.get('type', 'keyword')
+            pattern = rule.get('pattern')
+            if kind not in AUTO_REPLY_TYPES or not pattern or not rule.get('reply'):
+                print(f"Error in auto reply rule: {rule}")
+                continue
+            index = len(self.rules)
+            compiled = None
+            if kind == 'regex':
+                try:
+                    compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    print(f"Error in auto reply regex {pattern!r}: {e}")
+                    continue
+                literal = regex_literal_prefix(pattern).lower()
+                if literal:
+                    keywords.append((literal, index))
+                elif compiled.groups:
+                    # Со своими группами регулярку нельзя вложить в общую: сдвинутся номера групп
+                    self.separate.append((index, compiled))
+                else:
+                    regexes.append((index, compiled))
+            else:
+                keywords.append((pattern.lower(), index))
+            self.rules.append({'type': kind, 'reply': rule['reply'], 'regex': compiled,
+                               'cooldown': float(rule.get('cooldown', AUTO_REPLY_COOLDOWN))})
+        self.keywords = KeywordMatcher(keywords) if keywords else None
+        self.regex = None
+        if regexes:
+            try:
+                self.regex = re.compile("|".join(f"(?P<r{index}>{compiled.pattern})" for index, compiled in regexes),
+                                        re.IGNORECASE)
+            except re.error:
+                # Например, флаги вида (?i) посреди общей регулярки; такие правила проверяются по одному
+                self.separate = sorted(self.separate + regexes)
+
+    def match(self, text):
+        """Номер сработавшего правила или None"""
+        best = None
+        if self.keywords:
+            # Автомат ищет в тексте нижнего регистра, а проверки идут по исходному тексту,
+            # поэтому позиции переводятся обратно, если регистр изменил длину текста
+            lowered, positions = fold_case(text)
+            first = len(text) - len(text.lstrip())
+            for start, end, index in self.keywords.find(lowered):
+                if positions is not None:
+                    if ((start and positions[start] == positions[start - 1]) or
+                            (end < len(positions) and positions[end] == positions[end - 1])):
+                        # Совпадение захватывает только часть символа, ставшего несколькими
+                        continue
+                    start, end = positions[start], positions[end - 1] + 1
+                if best is not None and (start, index) >= best:
+                    continue
+                kind = self.rules[index]['type']
+                if kind == 'prefix':
+                    if start != first:
+                        continue
+                elif kind == 'regex':
+                    if not self.rules[index]['regex'].match(text, start):
+                        continue
+                elif ((start > 0 and is_word_char(text[start - 1]) and is_word_char(text[start])) or
+                      (end < len(text) and is_word_char(text[end]) and is_word_char(text[end - 1]))):
+                    continue
+                best = (start, index)
+        if self.regex:
+            found = self.regex.search(text)
+            if found and (best is None or (found.start(), int(found.lastgroup[1:])) < best):
+                best = (found.start(), int(found.lastgroup[1:]))
+        for index, compiled in self.separate:
+            found = compiled.search(text)
+            if found and (best is None or (found.start(), index) < best):
+                best = (found.start(), index)
+        return best[1] if best else None
+
+    def reply(self, chat_id, text, now=None):
+        """Текст автоответа на сообщение или None"""
+        if not self.rules or not text:
+            return None
+        index = self.match(text)
+        if index is None:
+            return None
+        now = time.monotonic() if now is None else now
+        key = (str(chat_id), index)
+        rule = self.rules[index]
+        last = self.last_reply.get(key)
+        if last is not None and now - last < rule['cooldown']:
+            return None
+        self.last_reply[key] = now
+        return rule['reply']
+
+
+class BotEngine:
+    """Сетевое ядро бота: приём update, отправка и загрузки на одном event loop asyncio.
+
+    Update приходят через long polling getUpdates или, если задан webhook, POST-запросами
+    на встроенный HTTP-сервер: {'url': публичный адрес для setWebhook (None — не регистрировать,
+    например для локальной проверки), 'host', 'port', 'path', 'secret'}.
+    run() блокирует вызывающий поток; остальные методы можно вызывать из любого потока.
+    """
+    def __init__(self, token, db, poll_timeout=POLL_TIMEOUT, allowed_updates=None, api_url=API_URL, webhook=None):
+        self.token = token
+        self.db = db
+        self.poll_timeout = poll_timeout
+        self.allowed_updates = allowed_updates
+        self.webhook = None
+        if webhook is not None:
+            self.webhook = {'url': None, 'host': WEBHOOK_HOST, 'port': WEBHOOK_PORT, 'path': WEBHOOK_PATH}
+            self.webhook.update({key: value for key, value in webhook.items() if value is not None})
+            # Без секрета любой мог бы подсовывать update; если его не задали — придумываем свой
+            self.webhook.setdefault('secret', os.urandom(16).hex())
+        self.webhook_queue = None
+        self.api = AsyncBotApi(token, api_url)
+        # Подтверждаем Telegram всё, что уже обработано до перезапуска
+        self.offset = self.db.processed.high_water
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        self.stop_event = asyncio.Event()
+        self.send_queue = SendQueue(self.api, os.path.join(db.db_path, SEND_QUEUE_FILE), self.finish_send)
+        self.responder = AutoResponder(os.path.join(db.db_path, "auto_replies.json"))
+        self.photos_dir = os.path.join(db.db_path, "photos_cache")
+        self.download_slots = asyncio.Semaphore(PHOTO_DOWNLOAD_WORKERS)
+        self.downloads = {}
+        # Получатели событий; BotWorker превращает их в Qt-сигналы
+        self.on_messages = lambda events: None
+        self.on_status = lambda connected: None
+        self.on_photo = lambda chat_id, photo_path: None
+        self.on_send_finished = lambda chat_id, ok, error: None
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+
+    async def main(self):
+        await self.api.open()
+        receive = self.webhook_loop() if self.webhook else self.poll_loop()
+        tasks = [asyncio.ensure_future(receive), asyncio.ensure_future(self.send_queue.run())]
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.running = False
+            # Неотправленное остаётся в журнале очереди и уйдёт после следующего запуска
+            tasks += list(self.downloads.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            await self.api.close()
+
+    def stop(self):
+        self.running = False
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def poll_loop(self):
+        failures = 0
+        while self.running:
+            retry_after = 0
+            try:
+                status, data = await self.api.get_updates(self.offset + 1, self.poll_timeout, self.allowed_updates)
+                
+                if status == 200:
+                    self.on_status(True)
+                    if data['ok']:
+                        await self.process_batch(data['result'])
+                        # Сразу уходим в следующий long poll: сервер сам подождёт новых сообщений
+                        failures = 0
+                        continue
+                elif status == 409:
+                    description = data.get('description', '') if isinstance(data, dict) else ''
+                    if 'webhook' in description.lower():
+                        # Остался webhook от режима webhook: пока он есть, getUpdates не работает.
+                        # Повтор всё равно идёт после паузы: если webhook держит другой процесс
+                        # с тем же токеном, он поставит его снова, и частые запросы ничего не дадут
+                        await self.api.delete_webhook()
+                    else:
+                        # getUpdates с тем же токеном вызывает кто-то ещё — ждём, ничего не снимая
+                        self.on_status(False)
+                else:
+                    self.on_status(False)
+                    if status == 429 and isinstance(data, dict):
+                        retry_after = data.get('parameters', {}).get('retry_after', 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.on_status(False)
+            
+            failures += 1
+            await self.backoff(failures, retry_after)
+
+    async def webhook_loop(self):
+        """Поднимает HTTP-сервер для webhook, регистрирует его и обрабатывает пришедшие update"""
+        from aiohttp import web
+        self.webhook_queue = asyncio.Queue()
+        app = web.Application()
+        app.router.add_post(self.webhook['path'], self.handle_webhook)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            site = web.TCPSite(runner, self.webhook['host'], self.webhook['port'])
+            await site.start()
+            # При port=0 система выбрала свободный порт — запоминаем настоящий
+            self.webhook['port'] = runner.addresses[0][1]
+            if self.webhook['url']:
+                await self.register_webhook()
+            else:
+                self.on_status(True)
+            await self.ingest_loop()
+        finally:
+            await runner.cleanup()
+
+    async def register_webhook(self):
+        failures = 0
+        while self.running:
+            retry_after = 0
+            try:
+                status, data = await self.api.set_webhook(self.webhook['url'], self.webhook['secret'],
+                                                          self.allowed_updates)
+                if status == 200 and isinstance(data, dict) and data.get('ok'):
+                    self.on_status(True)
+                    return
+                print(f"Error setting webhook: HTTP {status} {data}")
+                if status == 429 and isinstance(data, dict):
+                    retry_after = data.get('parameters', {}).get('retry_after', 0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error setting webhook: {e}")
+            self.on_status(False)
+            failures += 1
+            await self.backoff(failures, retry_after)
+
+    async def handle_webhook(self, request):
+        """Отвечает 200 только после того, как update записан: иначе Telegram пришлёт его снова"""
+        from aiohttp import web
+        secret = request.headers.get(WEBHOOK_SECRET_HEADER, "")
+        if not hmac.compare_digest(secret.encode(), self.webhook['secret'].encode()):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict) or not isinstance(update.get('update_id'), int):
+            return web.Response(status=400)
+        if not self.running:
+            # ingest_loop уже не заберёт update из очереди; Telegram повторит его позже
+            return web.Response(status=503)
+        done = asyncio.get_running_loop().create_future()
+        self.webhook_queue.put_nowait((update, done))
+        try:
+            await done
+        except EngineStopping:
+            return web.Response(status=503)
+        except Exception as e:
+            print(f"Error processing webhook update: {e}")
+            return web.Response(status=500)
+        return web.Response(status=200)
+
+    async def ingest_loop(self):
+        """Всё, что пришло, пока обрабатывался прошлый пакет, идёт одним пакетом в process_batch"""
+        items = []
+        try:
+            while self.running:
+                items = [await self.webhook_queue.get()]
+                while len(items) < WEBHOOK_BATCH and not self.webhook_queue.empty():
+                    items.append(self.webhook_queue.get_nowait())
+                items.sort(key=lambda item: item[0]['update_id'])
+                try:
+                    await self.process_batch([update for update, _ in items])
+                except Exception as e:
+                    for _, done in items:
+                        if not done.done():
+                            done.set_exception(e)
+                else:
+                    for _, done in items:
+                        if not done.done():
+                            done.set_result(None)
+                items = []
+        finally:
+            # Остановка: никто больше не разберёт очередь, ждущие обработчики ответят 503
+            while not self.webhook_queue.empty():
+                items.append(self.webhook_queue.get_nowait())
+            for _, done in items:
+                if not done.done():
+                    done.set_exception(EngineStopping())
+
+    def delete_webhook(self, drop_pending_updates=False):
+        """Снимает webhook у Telegram (из любого потока); нужен для возврата к getUpdates"""
+        if self.loop.is_closed() or not self.loop.is_running():
+            return None
+        return asyncio.run_coroutine_threadsafe(self.api.delete_webhook(drop_pending_updates), self.loop)
+
+    async def backoff(self, failures, retry_after=0):
+        """Пауза с экспоненциальным ростом и случайным разбросом, прерываемая stop()"""
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+        delay = max(delay * random.uniform(0.5, 1.0), retry_after)
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def process_batch(self, updates):
+        """Обрабатывает ответ getUpdates целиком и записывает его одним пакетом"""
+        events = []
+        self.responder.reload()
+        with self.db.batch():
+            for update in updates:
+                self.offset = max(self.offset, update['update_id'])
+                if not self.db.is_processed(update['update_id']):
+                    event = await self.process_update(update)
+                    if event:
+                        events.append(event)
+                        reply = self.auto_reply(event)
+                        if reply:
+                            events.append(reply)
+                    self.db.mark_processed(update['update_id'])
+        if events:
+            self.on_messages(events)
+
+    async def process_update(self, update):
+        if 'message' in update:
+            msg = update['message']
+            chat = msg['chat']
+            
+            if 'id' not in chat:
+                return
+            
+            chat_info = {
+                'id': chat['id'],
+                'first_name': chat.get('first_name', ''),
+                'last_name': chat.get('last_name', ''),
+                'username': chat.get('username', ''),
+                'type': chat.get('type', 'private')
+            }
+            self.db.save_chat(chat_info)
+
+            content = ""
+            msg_type = "text"
+            photo_path = None
+            file_id = None
+            
+            if 'text' in msg:
+                content = msg['text']
+            elif 'photo' in msg:
+                msg_type = "photo"
+                content = "🖼️ Photo"
+                photos = msg['photo']
+                if photos:
+                    largest_photo = photos[-1]
+                    file_id = largest_photo.get('file_id')
+                    if file_id:
+                        cache_key = largest_photo.get('file_unique_id') or file_id
+                        photo_path = os.path.join(self.photos_dir, f"{cache_key}.jpg")
+                        self.fetch_photo(str(chat['id']), file_id, photo_path)
+            elif 'document' in msg:
+                msg_type = "document"
+                doc = msg['document']
+                file_name = doc.get('file_name', 'Document')
+                content = f"📎 {file_name}"
+            
+            if content:
+                message = self.db.save_message(chat['id'], content, False, msg_type, photo_path=photo_path,
+                                               file_id=file_id)
+                if message:
+                    return {'chat_id': chat['id'], 'type': msg_type, 'chat': chat_info, 'message': message}
+        return None
+
+    def auto_reply(self, event):
+        """Ответ по правилам автоответчика уходит прямо в очередь отправки, минуя GUI"""
+        if event['type'] != 'text':
+            return None
+        text = self.responder.reply(event['chat_id'], event['message'].get('text', ''))
+        if not text:
+            return None
+        message = self.db.save_message(event['chat_id'], text, True)
+        self.send_queue.put(event['chat_id'], text=text)
+        return {'chat_id': event['chat_id'], 'type': 'text', 'chat': event['chat'], 'message': message}
+
+    def fetch_photo(self, chat_id, file_id, photo_path):
+        """Ставит фото в пул загрузок, не блокируя обработку остальных сообщений.
+
+        Уже лежащий в кэше файл не скачивается, а одновременные запросы одного файла
+        объединяются в одну загрузку.
+        """
+        if os.path.exists(photo_path):
+            return
+        task = self.downloads.get(photo_path)
+        if task is None:
+            task = asyncio.ensure_future(self.download_photo(file_id, photo_path))
+            self.downloads[photo_path] = task
+            task.add_done_callback(lambda t: self.downloads.pop(photo_path, None))
+
+        def notify(task):
+            if not task.cancelled() and task.result():
+                self.on_photo(chat_id, photo_path)
+        task.add_done_callback(notify)
+
+    async def download_photo(self, file_id, photo_path):
+        """Скачивает фото по file_id в photo_path"""
+        tmp_path = photo_path + ".part"
+        async with self.download_slots:
+            try:
+                status, file_data = await self.api.get_file(file_id)
+                if status == 200 and file_data['ok']:
+                    file_path = file_data['result']['file_path']
+                    status, _ = await self.api.download_file(file_path, tmp_path)
+                    if status == 200:
+                        os.replace(tmp_path, photo_path)
+                        return True
+            except Exception as e:
+                print(f"Error downloading photo: {e}")
+            finally:
+                # Оборванная или отменённая загрузка не должна оставлять недокачанный файл
+                if os.path.exists(tmp_path):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError as e:
+                        print(f"Error removing partial photo: {e}")
+        return False
+
+    def request_photo(self, chat_id, file_id, photo_path):
+        """Повторно ставит в загрузку фото, которого нет на диске; можно вызывать из любого потока"""
+        if not self.loop.is_closed() and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.fetch_photo, str(chat_id), file_id, photo_path)
+
+    def send_message(self, chat_id, text):
+        """Ставит текст в очередь отправки; можно вызывать из любого потока"""
+        return self.send_queue.put(chat_id, text=text)
+
+    def send_file(self, chat_id, file_path):
+        return self.send_queue.put(chat_id, file_path=file_path)
+
+    def clear_send_queue(self):
+        self.send_queue.clear()
+
+    def finish_send(self, chat_id, ok, error_msg):
+        self.on_send_finished(chat_id, ok, error_msg)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бот без GUI: приём update, хранилище, автоответчик и очередь отправки")
+    parser.add_argument('--token', action='append',
+                        help="токен бота; можно повторить, чтобы запустить несколько ботов (по умолчанию $TELEGRAM_BOT_TOKEN)")
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help="каталог данных; у нескольких ботов — подкаталоги по id бота")
+    parser.add_argument('--storage', choices=("json", "sqlite"), default="json")
+    parser.add_argument('--api-url', default=API_URL)
+    parser.add_argument('--poll-timeout', type=int, default=POLL_TIMEOUT)
+    parser.add_argument('--allowed-updates', default="", help="через запятую, например message,edited_message")
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL)
+    parser.add_argument('--flush-threshold', type=int, default=FLUSH_THRESHOLD)
+    parser.add_argument('--webhook-url', help="публичный адрес webhook; без него используется getUpdates")
+    parser.add_argument('--webhook-host', default=WEBHOOK_HOST)
+    parser.add_argument('--webhook-port', type=int, default=WEBHOOK_PORT)
+    parser.add_argument('--webhook-path', default=WEBHOOK_PATH)
+    parser.add_argument('--webhook-secret', default=os.environ.get("TELEGRAM_WEBHOOK_SECRET"))
+    parser.add_argument('--verbose', action='store_true', help="печатать входящие сообщения")
+    args = parser.parse_args(argv)
+    args.token = args.token or [token for token in [os.environ.get("TELEGRAM_BOT_TOKEN")] if token]
+    if not args.token:
+        parser.error("нужен --token или переменная окружения TELEGRAM_BOT_TOKEN")
+    if args.webhook_url and len(args.token) > 1:
+        parser.error("webhook поддерживается только для одного бота на процесс")
+    return args
+
+
+def attach_console(engine, name, verbose=False):
+    """Печатает смену состояния соединения (и при verbose — входящие сообщения) в stdout"""
+    state = {'connected': None}
+
+    def on_status(connected):
+        if connected != state['connected']:
+            state['connected'] = connected
+            print(f"{name}: {'connected' if connected else 'connection lost'}", flush=True)
+
+    def on_messages(events):
+        if verbose:
+            for event in events:
+                print(f"{name}: [{event['chat_id']}] {message_text(event['message'])}", flush=True)
+
+    def on_send_finished(chat_id, ok, error):
+        if not ok:
+            print(f"{name}: Error sending to {chat_id}: {error}", flush=True)
+
+    engine.on_status = on_status
+    engine.on_messages = on_messages
+    engine.on_send_finished = on_send_finished
+
+
+def main(argv=None):
+    """Запускает ботов без GUI и работает до SIGINT/SIGTERM"""
+    args = parse_args(argv)
+    allowed_updates = args.allowed_updates.split(",") if args.allowed_updates else None
+    webhook = None
+    if args.webhook_url:
+        webhook = {'url': args.webhook_url, 'host': args.webhook_host, 'port': args.webhook_port,
+                   'path': args.webhook_path, 'secret': args.webhook_secret}
+
+    engines = []
+    for token in args.token:
+        name = token.split(":")[0]
+        db_path = args.data_dir if len(args.token) == 1 else os.path.join(args.data_dir, name)
+        db = open_database(args.storage, db_path, args.flush_interval, args.flush_threshold)
+        engine = BotEngine(token, db, args.poll_timeout, allowed_updates, args.api_url, webhook)
+        attach_console(engine, f"bot {name}", args.verbose)
+        engines.append(engine)
+
+    def shutdown(signum, frame):
+        for engine in engines:
+            engine.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    # Каждому боту свой поток со своим event loop; главный поток только ждёт сигнала
+    threads = [threading.Thread(target=engine.run, name=f"bot-{i}") for i, engine in enumerate(engines)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        for engine in engines:
+            engine.db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
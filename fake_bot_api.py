@@ -0,0 +1,349 @@
+"""Локальная заглушка Telegram Bot API для замеров задержек и пропускной способности.
+
+Поддерживает getUpdates (long polling), setWebhook/deleteWebhook, getFile,
+скачивание файлов и sendMessage/sendPhoto/sendDocument. Клиент направляется
+на неё через api_url, например BotWorker(token, api_url=server.url).
+Пока установлен webhook, новые update не ждут getUpdates, а отправляются
+POST-запросами на него, как это делает Telegram.
+
+Нагрузка задаётся пачками update (push_burst, play_bursts), задержкой ответов
+на отправку и скачивание (set_latency), ответами 429 (inject_flood) и ошибками
+getUpdates (inject_poll_errors). Каждый вызов getUpdates записывается в polls.
+"""
+import json
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_ATTEMPTS = 3
+
+
+def post_update(url, update, secret_token=None, timeout=10):
+    """Отправляет update на webhook так же, как Telegram; возвращает HTTP-статус или None.
+
+    Годится и для ручной проверки: можно прогнать записанные update через свой webhook.
+    """
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    if secret_token:
+        request.add_header(SECRET_HEADER, secret_token)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return None
+
+
+def text_update(message_id, chat_id, text, first_name="User"):
+    return {'message': {
+        'message_id': message_id,
+        'chat': {'id': chat_id, 'first_name': first_name, 'type': 'private'},
+        'date': int(time.time()),
+        'text': text,
+    }}
+
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.sent = []
+        self.files = {}
+        self.pushed_at = {}
+        self.flood_count = 0
+        self.flood_retry_after = 1
+        self.floods_served = 0
+        self.poll_errors = []
+        self.polls = []
+        self.webhook_deletions = 0
+        self.send_latency = 0.0
+        self.file_latency = 0.0
+        self.webhook = None
+        self.webhook_pool = None
+        self.webhook_failures = 0
+        self.cond = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.server.handle_error = self.handle_error
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл соединение посреди long poll (остановка worker) — это не ошибка заглушки
+        if isinstance(sys.exc_info()[1], (ConnectionError, socket.timeout)):
+            return
+        ThreadingHTTPServer.handle_error(self.server, request, client_address)
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+            pool, self.webhook_pool = self.webhook_pool, None
+        if pool:
+            pool.shutdown(wait=True)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        """Ставит update в очередь getUpdates (или отправляет на webhook) и возвращает его update_id"""
+        with self.cond:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.pushed_at[update['update_id']] = time.perf_counter()
+            if self.webhook:
+                self.webhook_pool.submit(self.deliver, dict(self.webhook), update)
+            else:
+                self.updates.append(update)
+                self.cond.notify_all()
+            return update['update_id']
+
+    def deliver(self, webhook, update):
+        for attempt in range(WEBHOOK_ATTEMPTS):
+            if post_update(webhook['url'], update, webhook['secret_token']) == 200:
+                return
+            time.sleep(0.05 * 2 ** attempt)
+        with self.cond:
+            self.webhook_failures += 1
+
+    def set_webhook(self, url, secret_token=None, max_connections=40):
+        with self.cond:
+            if self.webhook_pool is None or (self.webhook or {}).get('max_connections') != max_connections:
+                if self.webhook_pool:
+                    self.webhook_pool.shutdown(wait=False)
+                self.webhook_pool = ThreadPoolExecutor(max_workers=max_connections)
+            self.webhook = {'url': url, 'secret_token': secret_token, 'max_connections': max_connections}
+
+    def delete_webhook(self, drop_pending_updates=False):
+        with self.cond:
+            self.webhook = None
+            self.webhook_deletions += 1
+            if drop_pending_updates:
+                self.updates = []
+
+    def push_text(self, chat_id, text, first_name="User"):
+        return self.push_update(text_update(self.next_update_id, chat_id, text, first_name))
+
+    def push_burst(self, count, chats=1, prefix="message"):
+        """Ставит count текстовых update разом, по кругу в chats чатов; текст — f"{prefix} {update_id}".
+
+        Возвращает список update_id. В режиме getUpdates клиент увидит всю пачку одним ответом.
+        """
+        if self.webhook:
+            return [self.push_text(1000 + i % chats, f"{prefix} {self.next_update_id}") for i in range(count)]
+        with self.cond:
+            now = time.perf_counter()
+            ids = []
+            for i in range(count):
+                update_id = self.next_update_id
+                self.next_update_id += 1
+                update = dict(text_update(update_id, 1000 + i % chats, f"{prefix} {update_id}"), update_id=update_id)
+                self.updates.append(update)
+                self.pushed_at[update_id] = now
+                ids.append(update_id)
+            self.cond.notify_all()
+            return ids
+
+    def play_bursts(self, pattern, chats=1, prefix="message"):
+        """Проигрывает шаблон нагрузки в фоновом потоке: [(пауза перед пачкой в секундах, размер пачки), ...]"""
+        def play():
+            for delay, count in pattern:
+                if delay:
+                    time.sleep(delay)
+                self.push_burst(count, chats, prefix)
+
+        thread = threading.Thread(target=play, daemon=True)
+        thread.start()
+        return thread
+
+    def push_photo(self, chat_id, file_id, data, caption=""):
+        """Регистрирует файл для getFile/скачивания и ставит update с фото"""
+        self.add_file(f"photos/{file_id}.jpg", data)
+        return self.push_update({'message': {
+            'message_id': self.next_update_id,
+            'chat': {'id': chat_id, 'first_name': "User", 'type': 'private'},
+            'date': int(time.time()),
+            'photo': [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960,
+                       'file_size': len(data)}],
+            'caption': caption,
+        }})
+
+    def add_file(self, file_path, data):
+        self.files[file_path] = data
+
+    def set_latency(self, send=None, file=None):
+        """Задержка ответа (секунды) на отправку сообщений и на getFile/скачивание файлов"""
+        if send is not None:
+            self.send_latency = send
+        if file is not None:
+            self.file_latency = file
+
+    def inject_flood(self, count, retry_after=1):
+        """Следующие count отправок получат 429 Too Many Requests с retry_after"""
+        with self.cond:
+            self.flood_count = count
+            self.flood_retry_after = retry_after
+
+    def take_flood(self):
+        with self.cond:
+            if self.flood_count <= 0:
+                return None
+            self.flood_count -= 1
+            self.floods_served += 1
+            return self.flood_retry_after
+
+    def inject_poll_errors(self, count, status=500, description="Internal Server Error", retry_after=None):
+        """Следующие count вызовов getUpdates получат ошибку status вместо update"""
+        error = {'ok': False, 'error_code': status, 'description': description}
+        if retry_after is not None:
+            error['parameters'] = {'retry_after': retry_after}
+        with self.cond:
+            self.poll_errors = [error] * count
+
+    def take_poll_error(self, offset, allowed_updates):
+        """Записывает вызов getUpdates в polls и возвращает ошибку, если её нужно отдать"""
+        with self.cond:
+            self.polls.append({'time': time.perf_counter(), 'offset': offset, 'allowed_updates': allowed_updates})
+            if self.poll_errors:
+                return self.poll_errors.pop(0)
+            return None
+
+    def get_updates(self, offset, timeout, limit=100, allowed_updates=None):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            # offset подтверждает всё, что было до него, как и в настоящем API;
+            # update не из allowed_updates Telegram не отдаёт вовсе
+            while True:
+                self.updates = [u for u in self.updates if u['update_id'] >= offset and
+                                (not allowed_updates or any(kind in u for kind in allowed_updates))]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return self.updates[:limit]
+                self.cond.wait(remaining)
+
+    def record_send(self, method, params):
+        with self.cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.sent.append({'method': method, 'params': params, 'time': time.perf_counter()})
+            return {'message_id': message_id, 'chat': {'id': params.get('chat_id')}, 'date': int(time.time())}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def read_params(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length', 0) or 0)
+                body = self.rfile.read(length) if length else b""
+                content_type = self.headers.get('Content-Type', '')
+                if body and content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+                elif body and content_type.startswith('application/json'):
+                    params.update(json.loads(body))
+                elif body and content_type.startswith('multipart/form-data'):
+                    params['_body_size'] = len(body)
+                return url.path, params
+
+            def send_json(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def handle_request(self):
+                path, params = self.read_params()
+                parts = path.strip('/').split('/')
+                if len(parts) >= 3 and parts[0] == 'file':
+                    if api.file_latency:
+                        time.sleep(api.file_latency)
+                    data = api.files.get('/'.join(parts[2:]))
+                    if data is None:
+                        self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                if len(parts) != 2 or not parts[0].startswith('bot'):
+                    self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                    return
+
+                method = parts[1]
+                allowed_updates = None
+                if method == 'getUpdates':
+                    if params.get('allowed_updates'):
+                        allowed_updates = json.loads(params['allowed_updates'])
+                    error = api.take_poll_error(int(params.get('offset', 0)), allowed_updates)
+                    if error:
+                        self.send_json(error['error_code'], error)
+                        return
+                if method == 'getUpdates' and api.webhook:
+                    self.send_json(409, {'ok': False, 'error_code': 409,
+                                         'description': "Conflict: can't use getUpdates method while webhook is active"})
+                    return
+                elif method == 'setWebhook':
+                    api.set_webhook(params.get('url', ''), params.get('secret_token'),
+                                    int(params.get('max_connections', 40)))
+                    result = True
+                elif method == 'deleteWebhook':
+                    api.delete_webhook(str(params.get('drop_pending_updates', '')).lower() == 'true')
+                    result = True
+                elif method == 'getUpdates':
+                    result = api.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)),
+                                             int(params.get('limit', 100)), allowed_updates)
+                elif method == 'getFile':
+                    if api.file_latency:
+                        time.sleep(api.file_latency)
+                    file_id = params.get('file_id', '')
+                    result = {'file_id': file_id, 'file_path': f"photos/{file_id}.jpg"}
+                elif method in ('sendMessage', 'sendPhoto', 'sendDocument'):
+                    retry_after = api.take_flood()
+                    if retry_after is not None:
+                        self.send_json(429, {'ok': False, 'error_code': 429,
+                                             'description': f"Too Many Requests: retry after {retry_after}",
+                                             'parameters': {'retry_after': retry_after}})
+                        return
+                    if api.send_latency:
+                        time.sleep(api.send_latency)
+                    result = api.record_send(method, params)
+                else:
+                    self.send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'})
+                    return
+                self.send_json(200, {'ok': True, 'result': result})
+
+        return Handler
@@ -1,21 +1,46 @@
 import sys
+import time
+
+# Начало отсчёта фаз запуска (startup_mark)
+STARTUP_T0 = time.perf_counter()
+
+# Без GUI движок работает сам по себе, и PyQt даже не импортируется
+if __name__ == "__main__" and "--headless" in sys.argv[1:]:
+    import bot_engine
+    sys.exit(bot_engine.main([arg for arg in sys.argv[1:] if arg != "--headless"]))
+
 import json
 import os
-import requests
 from datetime import datetime
+from bot_engine import (API_URL, DATA_DIR, FLUSH_INTERVAL, FLUSH_THRESHOLD, HISTORY_PAGE_SIZE, POLL_TIMEOUT,
+                        WEBHOOK_HOST, WEBHOOK_PATH, WEBHOOK_PORT, BotEngine, chat_title, merge_chat,
+                        message_text, open_database, summarize_messages)
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, 
                              QWidget, QListWidget, QLineEdit, QPushButton, 
                              QLabel, QDialog, QListWidgetItem, QFrame, 
                              QMessageBox, QFileDialog, QScrollArea, 
                              QComboBox, QGroupBox, QSlider, QSizePolicy, 
                              QGraphicsDropShadowEffect, QAbstractItemView, QMenu,
-                             QAction, QTextEdit)
+                             QAction, QTextEdit, QListView, QStyledItemDelegate, QStyle)
 from PyQt5.QtCore import (Qt, QTimer, QPropertyAnimation, pyqtProperty, 
-                          QSize, QSettings, QThread, pyqtSignal, QMutex, QUrl,
-                          QPropertyAnimation, QEasingCurve, QRect, QPoint)
+                          QSize, QSettings, QThread, pyqtSignal, QUrl,
+                          QPropertyAnimation, QEasingCurve, QRect, QPoint,
+                          QAbstractListModel, QModelIndex, QObject, QRunnable, QThreadPool, QEvent)
 from PyQt5.QtGui import (QFont, QPixmap, QPainter, QColor, QBrush, 
                          QPalette, QIcon, QDesktopServices, QImage, QMouseEvent,
-                         QCursor)
+                         QCursor, QFontMetrics, QPen, QImageReader, QPixmapCache)
+
+# Фазы запуска в мс от STARTUP_T0; при TELEGRAM_CLIENT_TIMING=1 печатаются одной строкой
+startup_phases = {}
+
+def startup_mark(phase):
+    startup_phases.setdefault(phase, (time.perf_counter() - STARTUP_T0) * 1000)
+    # Отчёт — когда окно уже нарисовано и хранилище загружено, в каком бы порядке это ни случилось
+    if phase in ("first_paint", "store") and "first_paint" in startup_phases and "store" in startup_phases:
+        if os.environ.get("TELEGRAM_CLIENT_TIMING"):
+            print("Startup: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in startup_phases.items()), flush=True)
+
+startup_mark("imports")
 
 if hasattr(Qt, 'AA_EnableHighDpiScaling'):
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
@@ -77,371 +102,441 @@ STYLES = {
     }
 }
 
-db_mutex = QMutex()
+# Стили всего приложения собраны в одну таблицу на тему: виджеты выбираются по objectName,
+# поэтому смена темы — один setStyleSheet на QApplication, а не разбор CSS каждым виджетом
+compiled_stylesheets = {}
+
+def theme_stylesheet(theme_name):
+    """Таблица стилей темы; собирается один раз и берётся из кэша"""
+    sheet = compiled_stylesheets.get(theme_name)
+    if sheet is None:
+        sheet = compiled_stylesheets[theme_name] = compile_stylesheet(STYLES[theme_name])
+    return sheet
+
+
+def compile_stylesheet(t):
+    return f"""
+        QMainWindow {{
+            background: {t['bg']};
+        }}
+        QMenuBar {{
+            background: {t['bg']};
+            color: {t['text']};
+            border-bottom: 1px solid {t['border']};
+        }}
+        QMenuBar::item:selected {{
+            background: {t['list_hover']};
+        }}
+        QMenu {{
+            background: {t['list_bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+        }}
+        QMenu::item:selected {{
+            background: {t['list_hover']};
+        }}
+
+        #left_panel {{
+            background: {t['list_bg']};
+        }}
+        #left_header {{
+            background: {t['accent']};
+            border: none;
+        }}
+        #left_header QPushButton {{
+            background: transparent;
+            border: none;
+            color: white;
+            font-size: 18px;
+            border-radius: 20px;
+        }}
+        #left_header QPushButton:hover {{
+            background: rgba(255,255,255,0.1);
+        }}
+        #left_title {{
+            color: white;
+            font-size: 20px;
+            font-weight: bold;
+        }}
+        #chat_list {{
+            background: {t['list_bg']};
+            color: {t['text']};
+            border: none;
+            outline: none;
+        }}
+        #chat_list QScrollBar:vertical {{
+            background: {t['list_bg']};
+            width: 8px;
+            margin: 0px;
+        }}
+        #chat_list QScrollBar::handle:vertical {{
+            background: {t['border']};
+            border-radius: 4px;
+            min-height: 20px;
+        }}
+        #chat_list QScrollBar::handle:vertical:hover {{
+            background: {t['text_secondary']};
+        }}
+
+        #right_panel {{
+            background: {t['chat_bg']};
+        }}
+        #chat_header, #input_area {{
+            background: {t['bg']};
+            border: none;
+        }}
+        #chat_header {{
+            border-bottom: 1px solid {t['border']};
+        }}
+        #input_area {{
+            border-top: 1px solid {t['border']};
+        }}
+        #chat_header QPushButton, #input_area QPushButton {{
+            background: transparent;
+            border: none;
+            color: {t['text']};
+            font-size: 18px;
+            border-radius: 20px;
+        }}
+        #chat_header QPushButton:hover, #input_area QPushButton:hover {{
+            background: rgba(0,0,0,0.1);
+        }}
+        #input_area QPushButton#send_btn {{
+            background: {t['accent']};
+            color: white;
+        }}
+        #input_area QPushButton#send_btn:hover {{
+            background: #44A0FC;
+        }}
+        #input_area QLineEdit {{
+            background: {t['input_bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+            border-radius: 20px;
+            padding: 8px 15px;
+            font-size: 14px;
+        }}
+        #chat_title {{
+            color: {t['text']};
+        }}
+        #message_view {{
+            background: transparent;
+            border: none;
+        }}
+        #message_view QScrollBar:vertical {{
+            background: transparent;
+            width: 8px;
+            margin: 0px;
+        }}
+        #message_view QScrollBar::handle:vertical {{
+            background: {t['border']};
+            border-radius: 4px;
+            min-height: 20px;
+        }}
+
+        QDialog#settings_dialog {{
+            background: {t['bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+        }}
+        #settings_dialog QGroupBox {{
+            font-weight: bold;
+            border: 1px solid {t['border']};
+            border-radius: 5px;
+            margin-top: 10px;
+            padding-top: 10px;
+            color: {t['text']};
+            background: {t['list_bg']};
+        }}
+        #settings_dialog QGroupBox::title {{
+            subcontrol-origin: margin;
+            left: 10px;
+            padding: 0 5px 0 5px;
+            color: {t['text']};
+        }}
+        #settings_dialog QComboBox {{
+            background: {t['input_bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+            border-radius: 3px;
+            padding: 5px;
+        }}
+        #settings_dialog QLabel {{
+            color: {t['text']};
+        }}
+        #settings_dialog QPushButton {{
+            background: {t['accent']};
+            color: white;
+            border: 1px solid {t['accent']};
+            border-radius: 5px;
+            padding: 8px 15px;
+        }}
+        #settings_dialog QPushButton:hover {{
+            background: #44A0FC;
+        }}
+        #settings_dialog QPushButton#cancel_btn {{
+            background: {t['border']};
+            border: 1px solid {t['border']};
+        }}
+        #settings_dialog QPushButton#cancel_btn:hover {{
+            background: {t['text_secondary']};
+        }}
+
+        QDialog#search_dialog {{
+            background: {t['bg']};
+            color: {t['text']};
+        }}
+        #search_dialog QLineEdit {{
+            background: {t['input_bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+            border-radius: 15px;
+            padding: 8px 15px;
+            font-size: 14px;
+        }}
+        #search_dialog QListWidget {{
+            background: {t['list_bg']};
+            color: {t['text']};
+            border: 1px solid {t['border']};
+            outline: none;
+        }}
+        #search_dialog QListWidget::item {{
+            padding: 6px;
+        }}
+        #search_dialog QListWidget::item:selected {{
+            background: {t['list_sel']};
+            color: {t['text']};
+        }}
+        #search_dialog QLabel {{
+            color: {t['text_secondary']};
+        }}
+    """
 
-class Database:
-    def __init__(self, db_path="telegram_bot_data"):
-        self.db_path = db_path
-        if not os.path.exists(db_path):
-            os.makedirs(db_path)
-        self.init_database()
-    
-    def init_database(self):
-        for file in ["messages.json", "chats.json", "processed.json", "photos_cache"]:
-            path = os.path.join(self.db_path, file)
-            if file == "photos_cache":
-                if not os.path.exists(path):
-                    os.makedirs(path)
-            else:
-                if not os.path.exists(path):
-                    with open(path, 'w', encoding='utf-8') as f:
-                        json.dump({}, f)
-    
-    def save_message(self, chat_id, message, is_outgoing, msg_type="text", file_path=None, file_name=None, photo_data=None):
-        db_mutex.lock()
-        try:
-            path = os.path.join(self.db_path, "messages.json")
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            chat_id = str(chat_id)
-            if chat_id not in data:
-                data[chat_id] = []
-            
-            current_time = datetime.now()
-            msg_obj = {
-                'id': int(current_time.timestamp() * 1000),
-                'text': message,
-                'out': is_outgoing,
-                'time': current_time.strftime("%H:%M"),
-                'type': msg_type,
-                'timestamp': current_time.timestamp()
-            }
-            
-            if not message and msg_type == 'photo':
-                msg_obj['text'] = "🖼️ Photo"
-            elif not message and msg_type == 'document':
-                msg_obj['text'] = "📎 File"
-            
-            if file_path: 
-                msg_obj['file_path'] = file_path
-            if file_name: 
-                msg_obj['file_name'] = file_name
-            if photo_data:
-                # Сохраняем фото в кэш
-                photo_id = f"photo_{int(current_time.timestamp() * 1000)}"
-                photo_path = os.path.join(self.db_path, "photos_cache", f"{photo_id}.jpg")
-                with open(photo_path, 'wb') as f:
-                    f.write(photo_data)
-                msg_obj['photo_id'] = photo_id
-                msg_obj['photo_path'] = photo_path
-            
-            data[chat_id].append(msg_obj)
 
-            if len(data[chat_id]) > 500:
-                data[chat_id] = data[chat_id][-500:]
 
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            print(f"Error saving message: {e}")
-        finally:
-            db_mutex.unlock()
 
-    def get_messages(self, chat_id):
-        db_mutex.lock()
-        try:
-            path = os.path.join(self.db_path, "messages.json")
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            messages = data.get(str(chat_id), [])
-            for msg in messages:
-                if 'type' not in msg:
-                    msg['type'] = 'text'
-                if 'text' not in msg:
-                    msg['text'] = ''
-                if 'time' not in msg:
-                    if 'timestamp' in msg:
-                        try:
-                            dt = datetime.fromtimestamp(msg['timestamp'])
-                            msg['time'] = dt.strftime("%H:%M")
-                        except:
-                            msg['time'] = '00:00'
-                    else:
-                        msg['time'] = '00:00'
-                if 'out' not in msg:
-                    msg['out'] = False
-            return messages
-        except:
-            return []
-        finally:
-            db_mutex.unlock()
+class BotWorker(QThread):
+    """Поток Qt, в котором крутится BotEngine; события движка приходят в GUI сигналами"""
+    new_messages = pyqtSignal(list)  # [{'chat_id', 'type', 'chat', 'message'}, ...] за один getUpdates
+    connection_status = pyqtSignal(bool)
+    photo_ready = pyqtSignal(str, str)  # chat_id, photo_path
+    send_finished = pyqtSignal(str, bool, str)  # chat_id, ok, error
 
-    def delete_message(self, chat_id, message_id):
-        db_mutex.lock()
-        try:
-            path = os.path.join(self.db_path, "messages.json")
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            chat_id = str(chat_id)
-            if chat_id in data:
-                data[chat_id] = [msg for msg in data[chat_id] if msg['id'] != message_id]
-                
-                with open(path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2)
-                return True
-            return False
-        except:
-            return False
-        finally:
-            db_mutex.unlock()
+    def __init__(self, token, db=None, poll_timeout=POLL_TIMEOUT, allowed_updates=None, api_url=API_URL, webhook=None):
+        super().__init__()
+        self.db = db or open_database()
+        self.engine = BotEngine(token, self.db, poll_timeout, allowed_updates, api_url, webhook)
+        self.engine.on_messages = self.new_messages.emit
+        self.engine.on_status = self.connection_status.emit
+        self.engine.on_photo = self.photo_ready.emit
+        self.engine.on_send_finished = self.send_finished.emit
 
-    def clear_chat(self, chat_id):
-        db_mutex.lock()
-        try:
-            path = os.path.join(self.db_path, "messages.json")
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            chat_id = str(chat_id)
-            if chat_id in data:
-                data[chat_id] = []
-                
-                with open(path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2)
-                return True
-            return False
-        except:
-            return False
-        finally:
-            db_mutex.unlock()
+    def run(self):
+        self.engine.run()
 
-    def save_chat(self, chat_data):
-        db_mutex.lock()
-        try:
-            path = os.path.join(self.db_path, "chats.json")
-            with open(path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            cid = str(chat_data['id'])
-            if cid not in data:
-                data[cid] = chat_data
-            else:
-                for key, value in chat_data.items():
-                    if key not in data[cid] or not data[cid][key]:
-                        data[cid][key] = value
-            
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            print(f"Error saving chat: {e}")
-        finally:
-            db_mutex.unlock()
-            
-    def get_chats(self):
-        db_mutex.lock()
-        try:
-            with open(os.path.join(self.db_path, "chats.json"), 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            for cid, chat_data in data.items():
-                if 'id' not in chat_data:
-                    chat_data['id'] = cid
-            return data
-        except:
-            return {}
-        finally:
-            db_mutex.unlock()
+    def send_message(self, chat_id, text):
+        return self.engine.send_message(chat_id, text)
 
-    def is_processed(self, update_id):
-        try:
-            with open(os.path.join(self.db_path, "processed.json"), 'r') as f:
-                data = json.load(f)
-            return str(update_id) in data
-        except: 
-            return False
+    def send_file(self, chat_id, file_path):
+        return self.engine.send_file(chat_id, file_path)
 
-    def mark_processed(self, update_id):
-        try:
-            path = os.path.join(self.db_path, "processed.json")
-            with open(path, 'r') as f:
-                data = json.load(f)
-            data[str(update_id)] = True
-            if len(data) > 1000:
-                keys = list(data.keys())[-500:]
-                data = {k: data[k] for k in keys}
-            with open(path, 'w') as f:
-                json.dump(data, f)
-        except: 
-            pass
-
-    def clear_all_data(self):
-        """Очистка всех данных при выходе из аккаунта"""
-        db_mutex.lock()
-        try:
+    def request_photo(self, chat_id, file_id, photo_path):
+        self.engine.request_photo(chat_id, file_id, photo_path)
 
-            for file in ["messages.json", "chats.json", "processed.json"]:
-                path = os.path.join(self.db_path, file)
-                if os.path.exists(path):
-                    with open(path, 'w', encoding='utf-8') as f:
-                        json.dump({}, f)
-            
+    def clear_send_queue(self):
+        self.engine.clear_send_queue()
 
-            photos_cache = os.path.join(self.db_path, "photos_cache")
-            if os.path.exists(photos_cache):
-                for file in os.listdir(photos_cache):
-                    file_path = os.path.join(photos_cache, file)
-                    try:
-                        os.remove(file_path)
-                    except:
-                        pass
-        finally:
-            db_mutex.unlock()
+    def stop(self):
+        self.engine.stop()
+        self.wait()
+        self.db.flush()
 
 
-class BotWorker(QThread):
-    new_message = pyqtSignal(dict)
-    connection_status = pyqtSignal(bool)
-    photo_received = pyqtSignal(str, bytes)  # chat_id, photo_data
+class HistoryLoader(QThread):
+    """Читает страницу старых сообщений чата в фоне"""
+    loaded = pyqtSignal(str, list)  # chat_id, сообщения в хронологическом порядке
 
-    def __init__(self, token):
+    def __init__(self, db, chat_id, before_id, limit=HISTORY_PAGE_SIZE):
         super().__init__()
-        self.token = token
-        self.running = True
-        self.offset = 0
-        self.db = Database()
-        self.mutex = QMutex()
+        self.db = db
+        self.chat_id = str(chat_id)
+        self.before_id = before_id
+        self.limit = limit
 
     def run(self):
-        url = f"https://api.telegram.org/bot{self.token}/getUpdates"
-        while self.running:
-            try:
-                params = {'offset': self.offset + 1, 'timeout': 10}
-                resp = requests.get(url, params=params, timeout=15)
-                
-                if resp.status_code == 200:
-                    self.connection_status.emit(True)
-                    data = resp.json()
-                    if data['ok']:
-                        for update in data['result']:
-                            self.offset = max(self.offset, update['update_id'])
-                            if not self.db.is_processed(update['update_id']):
-                                self.process_update(update)
-                                self.db.mark_processed(update['update_id'])
-                else:
-                    self.connection_status.emit(False)
-            except:
-                self.connection_status.emit(False)
-            
-            self.msleep(500)
-
-    def process_update(self, update):
-        if 'message' in update:
-            msg = update['message']
-            chat = msg['chat']
-            
-            if 'id' not in chat:
-                return
-            
-            chat_info = {
-                'id': chat['id'],
-                'first_name': chat.get('first_name', ''),
-                'last_name': chat.get('last_name', ''),
-                'username': chat.get('username', ''),
-                'type': chat.get('type', 'private')
-            }
-            self.db.save_chat(chat_info)
-
-            content = ""
-            msg_type = "text"
-            photo_data = None
-            
-            if 'text' in msg:
-                content = msg['text']
-            elif 'photo' in msg:
-                msg_type = "photo"
-                content = "🖼️ Photo"
-                photos = msg['photo']
-                if photos:
-                    largest_photo = photos[-1]
-                    file_id = largest_photo.get('file_id')
-                    if file_id:
-                        photo_data = self.download_photo(file_id)
-                        if photo_data:
-                            self.photo_received.emit(str(chat['id']), photo_data)
-            elif 'document' in msg:
-                msg_type = "document"
-                doc = msg['document']
-                file_name = doc.get('file_name', 'Document')
-                content = f"📎 {file_name}"
-            
-            if content:
-                self.db.save_message(chat['id'], content, False, msg_type, photo_data=photo_data)
-                self.new_message.emit({'chat_id': chat['id'], 'type': msg_type})
-
-    def download_photo(self, file_id):
-        """Скачивает фото по file_id"""
         try:
-
-            url = f"https://api.telegram.org/bot{self.token}/getFile"
-            resp = requests.post(url, data={'file_id': file_id})
-            if resp.status_code == 200:
-                file_data = resp.json()
-                if file_data['ok']:
-                    file_path = file_data['result']['file_path']
-                    
-
-                    download_url = f"https://api.telegram.org/file/bot{self.token}/{file_path}"
-                    photo_resp = requests.get(download_url, timeout=15)
-                    
-                    if photo_resp.status_code == 200:
-                        return photo_resp.content
+            messages = self.db.get_messages(self.chat_id, before_id=self.before_id, limit=self.limit)
         except Exception as e:
-            print(f"Error downloading photo: {e}")
-        return None
-
-    def stop(self):
-        self.running = False
-        self.wait()
-
-class SendWorker(QThread):
-    finished = pyqtSignal(bool, str)
+            print(f"Error loading history: {e}")
+            messages = []
+        self.loaded.emit(self.chat_id, messages)
+
+
+# Снимок верхних строк списка чатов: при запуске окно показывает его сразу, не дожидаясь хранилища
+CHAT_SNAPSHOT_FILE = "chat_list_snapshot.json"
+CHAT_SNAPSHOT_ROWS = 100
+
+def load_chat_snapshot(path, storage):
+    """{chat_id: {'chat', 'summary'}} с прошлого запуска; пусто, если снимка нет или он от другого хранилища"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get('storage') == storage:
+            return {row['id']: {'chat': row['chat'], 'summary': row['summary']} for row in snapshot['rows']}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return {}
+
+def save_chat_snapshot(path, storage, rows):
+    temp_path = path + ".part"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'storage': storage, 'rows': rows}, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Error saving chat list snapshot: {e}")
+
+
+class StoreLoader(QThread):
+    """Открывает хранилище и читает весь список чатов в фоне, пока окно показывает снимок"""
+    loaded = pyqtSignal()
+
+    def __init__(self, backend, flush_interval=FLUSH_INTERVAL, flush_threshold=FLUSH_THRESHOLD):
+        super().__init__()
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.db = None
+        self.entries = {}
 
-    def __init__(self, token, chat_id, text=None, file_path=None):
+    def run(self):
+        self.db = open_database(self.backend, flush_interval=self.flush_interval,
+                                flush_threshold=self.flush_threshold)
+        summaries = self.db.get_summaries()
+        self.entries = {cid: {'chat': data, 'summary': summaries.get(cid) or summarize_messages([])}
+                        for cid, data in self.db.get_chats().items()}
+        self.loaded.emit()
+
+
+# Объём QPixmapCache под превью фото (КБ) и качество JPEG для превью на диске
+PIXMAP_CACHE_KB = 64 * 1024
+THUMBNAIL_QUALITY = 85
+# Потоков декодирования фото; размер и число крошечных размытых заглушек в памяти
+PHOTO_DECODE_THREADS = 2
+PREVIEW_SIZE = 16
+PREVIEW_CACHE_LIMIT = 5000
+# Через сколько секунд фото, которого всё ещё нет на диске, снова запрашивается у движка
+PHOTO_RETRY_INTERVAL = 30
+
+def thumbnail_path(photo_path, size):
+    """Превью лежит рядом с фото и включает размер в имя, поэтому у каждого масштаба своё"""
+    return f"{os.path.splitext(photo_path)[0]}.thumb{size.width()}x{size.height()}.jpg"
+
+
+def make_thumbnail(photo_path, size):
+    """Уменьшает фото до size (JPEG декодируется сразу в уменьшенном виде), сохраняет и возвращает превью"""
+    reader = QImageReader(photo_path)
+    reader.setAutoTransform(True)
+    source = reader.size()
+    if source.isValid():
+        reader.setScaledSize(source.scaled(size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        print(f"Error reading photo {photo_path}: {reader.errorString()}")
+        return image
+    if image.width() > size.width() or image.height() > size.height():
+        image = image.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    thumb_path = thumbnail_path(photo_path, size)
+    part_path = thumb_path + ".part"
+    if image.save(part_path, "JPG", THUMBNAIL_QUALITY):
+        os.replace(part_path, thumb_path)
+    else:
+        print(f"Error saving thumbnail {thumb_path}")
+    return image
+
+
+class PhotoDecodeTask(QRunnable):
+    """Читает превью с диска (или делает его из фото) в пуле потоков; работает только с QImage"""
+    def __init__(self, loader, photo_path, size):
         super().__init__()
-        self.token = token
-        self.chat_id = chat_id
-        self.text = text
-        self.file_path = file_path
+        # Временем жизни управляет PhotoLoader: задача живёт, пока не пришёл finished
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.photo_path = photo_path
+        self.thumb_path = thumbnail_path(photo_path, size)
+        self.size = QSize(size)
+        self.cancelled = False
 
     def run(self):
         try:
-            url = f"https://api.telegram.org/bot{self.token}/"
-            
-            if self.file_path:
-                ext = os.path.splitext(self.file_path)[1].lower()
-                if ext in ['.jpg', '.png', '.jpeg']:
-                    method = "sendPhoto"
-                    with open(self.file_path, 'rb') as f:
-                        files = {'photo': f}
-                        resp = requests.post(url + method, data={'chat_id': self.chat_id}, files=files)
-                else:
-                    method = "sendDocument"
-                    with open(self.file_path, 'rb') as f:
-                        files = {'document': f}
-                        resp = requests.post(url + method, data={'chat_id': self.chat_id}, files=files)
-            else:
-                resp = requests.post(url + "sendMessage", data={'chat_id': self.chat_id, 'text': self.text})
-            
-            if resp.status_code == 200 and resp.json().get('ok'):
-                self.finished.emit(True, "")
+            if not self.cancelled:
+                self.decode()
+        finally:
+            self.loader.finished.emit(self)
+
+    def decode(self):
+        try:
+            if os.path.exists(self.thumb_path):
+                image = QImageReader(self.thumb_path).read()
             else:
-                error_msg = resp.json().get('description', 'API Error') if resp.status_code == 200 else f"HTTP {resp.status_code}"
-                self.finished.emit(False, error_msg)
+                image = make_thumbnail(self.photo_path, self.size)
         except Exception as e:
-            self.finished.emit(False, str(e))
+            print(f"Error decoding photo: {e}")
+            image = QImage()
+        preview = QImage()
+        if not image.isNull():
+            preview = image.scaled(PREVIEW_SIZE, PREVIEW_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self.loader.decoded.emit(self.photo_path, self.thumb_path, image, preview)
+
+
+class PhotoLoader(QObject):
+    """Очередь декодирования фото: задачи для строк, ушедших с экрана, отменяются"""
+    decoded = pyqtSignal(str, str, QImage, QImage)  # photo_path, путь превью, превью, размытая заглушка
+    finished = pyqtSignal(object)  # PhotoDecodeTask
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(PHOTO_DECODE_THREADS)
+        self.tasks = {}
+        self.active = set()
+        self.finished.connect(self.on_finished)
+
+    def request(self, photo_path, size):
+        """Ставит фото в очередь, если оно ещё не декодируется"""
+        thumb_path = thumbnail_path(photo_path, size)
+        if thumb_path not in self.tasks:
+            task = PhotoDecodeTask(self, photo_path, size)
+            self.tasks[thumb_path] = task
+            self.active.add(task)
+            self.pool.start(task)
+
+    def on_finished(self, task):
+        self.active.discard(task)
+        if self.tasks.get(task.thumb_path) is task:
+            del self.tasks[task.thumb_path]
+
+    def cancel_except(self, keep):
+        """Отменяет задачи, чьих превью нет в keep; уже начатые дорабатывают как есть"""
+        for thumb_path in [path for path in self.tasks if path not in keep]:
+            task = self.tasks.pop(thumb_path)
+            task.cancelled = True
+            if self.pool.tryTake(task):
+                self.active.discard(task)
+
+    def stop(self):
+        self.cancel_except(())
+        self.pool.waitForDone()
+
+
+def paint_avatar(painter, rect, letter, font):
+    """Круглый аватар с первой буквой имени"""
+    painter.setPen(QPen(QColor(255, 255, 255, 77), 2))
+    painter.setBrush(QColor('#3390EC'))
+    painter.drawEllipse(rect)
+    painter.setFont(font)
+    painter.setPen(QColor('white'))
+    painter.drawText(rect, Qt.AlignCenter, letter)
 
 
 class AvatarLabel(QLabel):
@@ -461,340 +556,547 @@ class AvatarLabel(QLabel):
         
         self.update_style()
 
+    def set_size(self, size):
+        self.size = size
+        self.setFixedSize(size, size)
+        self.update_style()
+
     def update_style(self):
-        self.setStyleSheet(f"""
-            border-radius: {self.size//2}px; 
-            background: #3390EC; 
-            color: white; 
-            font-weight: bold;
-            border: 2px solid rgba(255, 255, 255, 0.3);
-            font-size: {self.size//2}px;
-        """)
+        # Рисуется в paintEvent тем же кодом, что и аватары в списке чатов, без таблицы стилей
+        self.avatar_font = QFont("Segoe UI")
+        self.avatar_font.setPixelSize(max(self.size // 2, 1))
+        self.avatar_font.setBold(True)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+        paint_avatar(painter, self.rect().adjusted(1, 1, -1, -1), QLabel.text(self), self.avatar_font)
+        painter.end()
+
+class ChatListModel(QAbstractListModel):
+    """Список чатов по убыванию времени последнего сообщения; меняются только затронутые строки"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.entries = {}
+        # Номер строки чата — row_index[chat_id] + row_shift: новый чат сверху сдвигает все строки
+        # одним увеличением row_shift, а подъём чата наверх правит только строки над ним
+        self.row_index = {}
+        self.row_shift = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        chat_id = self.rows[index.row()]
+        if role == Qt.UserRole:
+            return chat_id
+        if role == Qt.DisplayRole:
+            return chat_title(chat_id, self.entries[chat_id]['chat'])
+        return None
+
+    def entry(self, row):
+        return self.entries[self.rows[row]]
+
+    def row_of(self, chat_id):
+        position = self.row_index.get(str(chat_id))
+        return -1 if position is None else position + self.row_shift
+
+    def snapshot(self, limit):
+        """Верхние строки списка: [{'id', 'chat', 'summary'}, ...]"""
+        return [dict(self.entries[cid], id=cid) for cid in self.rows[:limit]]
+
+    def set_chats(self, entries):
+        """entries: {chat_id: {'chat': данные чата, 'summary': сводка}}"""
+        self.beginResetModel()
+        self.entries = {str(cid): entry for cid, entry in entries.items()}
+        self.rows = sorted(self.entries, key=lambda cid: self.entries[cid]['summary']['last_timestamp'],
+                           reverse=True)
+        self.row_index = {cid: row for row, cid in enumerate(self.rows)}
+        self.row_shift = 0
+        self.endResetModel()
+
+    def update_chat(self, chat_id, chat_data=None, summary=None):
+        """Учитывает новое сообщение: обновляет строку и поднимает её наверх перемещением"""
+        chat_id = str(chat_id)
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            entry = {'chat': dict(chat_data or {}), 'summary': summary or summarize_messages([])}
+            self.beginInsertRows(QModelIndex(), 0, 0)
+            self.entries[chat_id] = entry
+            self.rows.insert(0, chat_id)
+            self.row_shift += 1
+            self.row_index[chat_id] = -self.row_shift
+            self.endInsertRows()
+            return
 
-class PhotoMessageWidget(QWidget):
-    """Виджет для отображения фото в чате"""
-    def __init__(self, photo_path, theme_dict, scale=1.0, parent=None):
+        if chat_data:
+            entry['chat'] = merge_chat(dict(entry['chat']), chat_data)
+        row = self.row_of(chat_id)
+        if summary:
+            entry['summary'] = summary
+            if row > 0:
+                self.beginMoveRows(QModelIndex(), row, row, QModelIndex(), 0)
+                for cid in self.rows[:row]:
+                    self.row_index[cid] += 1
+                self.rows.insert(0, self.rows.pop(row))
+                self.row_index[chat_id] = -self.row_shift
+                self.endMoveRows()
+                row = 0
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def set_summary(self, chat_id, summary):
+        """Заменяет сводку (после удаления или очистки истории) без перестановки строк"""
+        row = self.row_of(chat_id)
+        if row >= 0:
+            self.entries[str(chat_id)]['summary'] = summary
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+
+class ChatListDelegate(QStyledItemDelegate):
+    """Рисует строку чата: аватар, имя, превью, время и счётчик непрочитанных"""
+    def __init__(self, theme_dict, scale=1.0, parent=None):
         super().__init__(parent)
-        self.photo_path = photo_path
+        self.set_style(theme_dict, scale)
+
+    def set_style(self, theme_dict, scale):
         self.theme = theme_dict
         self.scale = scale
-        self.is_outgoing = False
-        self.init_ui()
-        
-    def init_ui(self):
-        layout = QVBoxLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(5)
-        
-        self.photo_label = QLabel()
-        self.photo_label.setFixedSize(int(300 * self.scale), int(200 * self.scale))
-        self.photo_label.setAlignment(Qt.AlignCenter)
-        self.photo_label.setStyleSheet("""
-            QLabel {
-                border-radius: 10px;
-                border: 1px solid rgba(0,0,0,0.1);
-                background: rgba(0,0,0,0.05);
-            }
-        """)
+        self.row_height = int(72 * scale)
+        self.avatar_size = int(54 * scale)
+        self.name_font = QFont("Segoe UI", int(14 * scale), QFont.DemiBold)
+        self.selected_name_font = QFont("Segoe UI", int(14 * scale), QFont.Bold)
+        self.preview_font = QFont("Segoe UI", int(12 * scale))
+        self.time_font = QFont("Segoe UI", int(10 * scale))
+        self.badge_font = QFont("Segoe UI", int(9 * scale), QFont.Bold)
+        self.avatar_font = QFont("Segoe UI", self.avatar_size // 2)
+        self.avatar_font.setBold(True)
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), self.row_height)
+
+    def paint(self, painter, option, index):
+        entry = index.model().entry(index.row())
+        chat_id = index.model().rows[index.row()]
+        summary = entry['summary']
+        selected = bool(option.state & QStyle.State_Selected)
+        rect = option.rect
+        s = self.scale
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        if selected:
+            bg = self.theme['list_sel']
+        elif option.state & QStyle.State_MouseOver:
+            bg = self.theme['list_hover']
+        else:
+            bg = self.theme['list_bg']
+        painter.fillRect(rect, QColor(bg))
+
+        name = chat_title(chat_id, entry['chat'])
+        left = rect.left() + int(15 * s)
+        avatar = QRect(left, rect.top() + (rect.height() - self.avatar_size) // 2,
+                       self.avatar_size, self.avatar_size)
+        letter = name.strip()[:1].upper()
+        paint_avatar(painter, avatar, letter if letter.isprintable() and letter else "?", self.avatar_font)
+
+        right = rect.right() - int(15 * s)
+        top = rect.top() + int(8 * s)
+        text_left = avatar.right() + int(12 * s)
+        side_width = 0
+        if summary['last_time']:
+            painter.setFont(self.time_font)
+            painter.setPen(QColor(self.theme['text_secondary']))
+            time_width = painter.fontMetrics().horizontalAdvance(summary['last_time'])
+            side_width = time_width
+            painter.drawText(QRect(right - time_width, top, time_width, painter.fontMetrics().height()),
+                             Qt.AlignRight, summary['last_time'])
+        if summary['unread'] > 0:
+            painter.setFont(self.badge_font)
+            badge_text = str(summary['unread'])
+            fm = painter.fontMetrics()
+            badge_height = fm.height() + 4
+            badge_width = max(fm.horizontalAdvance(badge_text) + 12, badge_height)
+            side_width = max(side_width, badge_width)
+            badge = QRect(right - badge_width, rect.bottom() - int(8 * s) - badge_height, badge_width, badge_height)
+            painter.setPen(Qt.NoPen)
+            painter.setBrush(QColor('#3390EC'))
+            painter.drawRoundedRect(badge, badge_height / 2, badge_height / 2)
+            painter.setPen(QColor('white'))
+            painter.drawText(badge, Qt.AlignCenter, badge_text)
+
+        text_width = right - side_width - int(8 * s) - text_left
+        middle = rect.top() + rect.height() // 2
+        painter.setFont(self.selected_name_font if selected else self.name_font)
+        painter.setPen(QColor(self.theme['text']))
+        fm = painter.fontMetrics()
+        painter.drawText(QRect(text_left, middle - fm.height() - int(2 * s), text_width, fm.height()),
+                         Qt.AlignLeft | Qt.AlignVCenter, fm.elidedText(name, Qt.ElideRight, text_width))
+        painter.setFont(self.preview_font)
+        painter.setPen(QColor(self.theme['text'] if selected else self.theme['text_secondary']))
+        fm = painter.fontMetrics()
+        painter.drawText(QRect(text_left, middle + int(2 * s), text_width, fm.height()),
+                         Qt.AlignLeft | Qt.AlignVCenter,
+                         fm.elidedText(summary['last_text'], Qt.ElideRight, text_width))
+        painter.restore()
+
+class MessageListModel(QAbstractListModel):
+    """Сообщения открытого чата; виджеты на строки не создаются"""
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
 
-        self.load_photo()
-        
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
 
-        self.time_label = QLabel(datetime.now().strftime("%H:%M"))
-        self.time_label.setFont(QFont("Segoe UI", int(10 * self.scale)))
-        self.time_label.setAlignment(Qt.AlignRight)
-        
-        layout.addWidget(self.photo_label)
-        layout.addWidget(self.time_label)
-        
-        self.setLayout(layout)
-        
-    def load_photo(self):
-        if os.path.exists(self.photo_path):
-            pixmap = QPixmap(self.photo_path)
-            if not pixmap.isNull():
-                scaled_pixmap = pixmap.scaled(
-                    self.photo_label.size(), 
-                    Qt.KeepAspectRatio, 
-                    Qt.SmoothTransformation
-                )
-                self.photo_label.setPixmap(scaled_pixmap)
-            else:
-                self.photo_label.setText("🖼️")
-        else:
-            self.photo_label.setText("🖼️")
-    
-    def set_outgoing(self, is_outgoing):
-        self.is_outgoing = is_outgoing
-        time_color = self.theme['time_out'] if is_outgoing else self.theme['time_in']
-        self.time_label.setStyleSheet(f"color: {time_color}; background: transparent;")
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role == Qt.DisplayRole:
+            return message_text(self.messages[index.row()])
+        return None
 
-class MessageBubble(QWidget):
-    def __init__(self, message_data, theme_dict, scale=1.0, parent=None):
-        super().__init__(parent)
-        self.data = message_data
-        self.theme = theme_dict
-        self.scale = scale
-        self.is_photo = message_data.get('type') == 'photo' and 'photo_path' in message_data
-        self.init_ui()
+    def message(self, row):
+        return self.messages[row]
 
-    def init_ui(self):
-        layout = QVBoxLayout()
-        layout.setContentsMargins(0, 0, 0, 0)
-        layout.setSpacing(5)
-        if self.is_photo:
-
-            self.photo_widget = PhotoMessageWidget(
-                self.data['photo_path'], 
-                self.theme, 
-                self.scale
-            )
-            self.photo_widget.set_outgoing(self.data.get('out', False))
-            layout.addWidget(self.photo_widget)
-        else:
-            self.content_frame = QFrame()
-            self.content_frame.setSizePolicy(QSizePolicy.Maximum, QSizePolicy.Minimum)
-            
-            content_layout = QHBoxLayout(self.content_frame)
-            content_layout.setContentsMargins(
-                int(12 * self.scale), 
-                int(8 * self.scale), 
-                int(12 * self.scale), 
-                int(8 * self.scale)
-            )
-            
-            self.content_label = QLabel()
-            self.content_label.setFont(QFont("Segoe UI", int(14 * self.scale)))
-            self.content_label.setWordWrap(True)
-            self.content_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
-            
-            msg_text = self.data.get('text', '')
-            if not msg_text:
-                msg_type = self.data.get('type', 'text')
-                if msg_type == 'photo':
-                    msg_text = "🖼️ Photo"
-                elif msg_type == 'document':
-                    msg_text = "📎 File"
-                else:
-                    msg_text = "Message"
-            
-            self.content_label.setText(msg_text)
-            
-            content_layout.addWidget(self.content_label)
-            time_layout = QVBoxLayout()
-            time_layout.setAlignment(Qt.AlignBottom)
-            
-            time_text = self.data.get('time', '')
-            if not time_text and 'timestamp' in self.data:
-                try:
-                    dt = datetime.fromtimestamp(self.data['timestamp'])
-                    time_text = dt.strftime("%H:%M")
-                except:
-                    time_text = ""
-            
-            self.time_label = QLabel(time_text)
-            self.time_label.setFont(QFont("Segoe UI", int(11 * self.scale)))
-            
-            time_layout.addWidget(self.time_label)
-            content_layout.addLayout(time_layout)
-            
-            layout.addWidget(self.content_frame)
-        
-        self.setLayout(layout)
-        self.update_style()
-        
-    def update_style(self):
-        if not self.is_photo:
-            radius = int(12 * self.scale)
-            is_outgoing = self.data.get('out', False)
-            
-            if is_outgoing:
-                bg_color = self.theme['msg_out']
-                text_color = '#FFFFFF'
-                time_color = self.theme['time_out']
-                border_radius = f"{radius}px {radius}px 4px {radius}px"
-            else:
-                bg_color = self.theme['msg_in']
-                text_color = self.theme['text']
-                time_color = self.theme['time_in']
-                border_radius = f"{radius}px {radius}px {radius}px 4px"
-            
-            self.content_frame.setStyleSheet(f"""
-                QFrame {{
-                    background: {bg_color};
-                    border: 1px solid {bg_color};
-                    border-radius: {border_radius};
-                    padding: 0px;
-                }}
-            """)
-            
-            self.content_label.setStyleSheet(f"color: {text_color}; background: transparent; border: none;")
-            self.time_label.setStyleSheet(f"color: {time_color}; background: transparent; border: none;")
+    def set_messages(self, messages):
+        self.beginResetModel()
+        self.messages = list(messages)
+        self.endResetModel()
 
-class ChatListItem(QWidget):
-    def __init__(self, chat_id, chat_data, theme_dict, scale=1.0, parent=None):
-        super().__init__(parent)
-        self.chat_id = chat_id
-        self.chat_data = chat_data
+    def prepend_messages(self, messages):
+        """Добавляет подгруженную страницу старых сообщений в начало"""
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        self.messages[:0] = messages
+        self.endInsertRows()
+
+    def append_messages(self, messages):
+        if not messages:
+            return
+        first = len(self.messages)
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        self.messages.extend(messages)
+        self.endInsertRows()
+
+    def remove_first(self, count):
+        """Убирает самые старые строки; они дочитываются заново при прокрутке вверх"""
+        if count <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        del self.messages[:count]
+        self.endRemoveRows()
+
+    def clear(self):
+        self.set_messages([])
+
+    def row_of(self, message_id):
+        return next((row for row, msg in enumerate(self.messages) if msg.get('id') == message_id), -1)
+
+    def photo_changed(self, photo_path):
+        """Перерисовывает строки с этим фото"""
+        for row, msg in enumerate(self.messages):
+            if msg.get('photo_path') == photo_path:
+                index = self.index(row)
+                self.dataChanged.emit(index, index)
+
+
+# Сколько размеров строк помнит делегат (ключ включает ширину, так что ресайз не сбрасывает кэш)
+SIZE_CACHE_LIMIT = 20000
+
+class MessageDelegate(QStyledItemDelegate):
+    """Рисует пузыри сообщений; размеры строк кэшируются до смены стиля"""
+    photo_missing = pyqtSignal(str, str)  # file_id, photo_path
+
+    def __init__(self, view, theme_dict, scale=1.0):
+        super().__init__(view)
+        self.view = view
+        self.size_cache = {}
+        # Фото, которые не удалось прочитать, и крошечные заглушки на время декодирования
+        self.failed = set()
+        self.previews = {}
+        # Когда фото без файла на диске последний раз запрашивалось у движка
+        self.missing_requested = {}
+        QPixmapCache.setCacheLimit(PIXMAP_CACHE_KB)
+        self.photo_loader = PhotoLoader(self)
+        self.photo_loader.decoded.connect(self.on_photo_decoded)
+        view.verticalScrollBar().valueChanged.connect(self.cancel_hidden_photos)
+        self.highlight_id = None
+        self.set_style(theme_dict, scale)
+
+    def set_style(self, theme_dict, scale):
         self.theme = theme_dict
         self.scale = scale
-        self.isSelected = False
-        self.setFixedHeight(int(72 * scale))
-        self.init_ui()
-
-    def init_ui(self):
-        layout = QHBoxLayout()
-        layout.setContentsMargins(int(15 * self.scale), int(8 * self.scale), int(15 * self.scale), int(8 * self.scale))
-        layout.setSpacing(int(12 * self.scale))
-
-        first_name = self.chat_data.get('first_name', '')
-        last_name = self.chat_data.get('last_name', '')
-        username = self.chat_data.get('username', '')
-        
-        name = f"{first_name} {last_name}".strip()
-        if not name:
-            name = username if username else str(self.chat_id)
-        
-        self.avatar = AvatarLabel(name, int(54 * self.scale))
-        
-        text_layout = QVBoxLayout()
-        text_layout.setSpacing(int(4 * self.scale))
-        self.name_label = QLabel(name)
-        self.name_label.setFont(QFont("Segoe UI", int(14 * self.scale), QFont.DemiBold))
-        
-        db = Database()
-        messages = db.get_messages(self.chat_id)
-        last_msg = ""
-        last_msg_time = ""
-        unread_count = 0
-        
-        if messages:
-            unread_count = sum(1 for msg in messages if not msg.get('out', False) and not msg.get('read', False))
-            
-            last_msg_data = messages[-1]
-            msg_text = last_msg_data.get('text', '')
-            if msg_text:
-                if len(msg_text) > 30:
-                    last_msg = msg_text[:27] + "..."
-                else:
-                    last_msg = msg_text
-            else:
-                msg_type = last_msg_data.get('type', 'text')
-                if msg_type == 'photo':
-                    last_msg = "🖼️ Photo"
-                elif msg_type == 'document':
-                    last_msg = "📎 File"
-            
-            last_msg_time = last_msg_data.get('time', '')
-            if not last_msg_time and 'timestamp' in last_msg_data:
-                try:
-                    dt = datetime.fromtimestamp(last_msg_data['timestamp'])
-                    last_msg_time = dt.strftime("%H:%M")
-                except:
-                    last_msg_time = ""
-        
-        self.last_msg_label = QLabel(last_msg)
-        self.last_msg_label.setFont(QFont("Segoe UI", int(12 * self.scale)))
-        
-        text_layout.addWidget(self.name_label)
-        text_layout.addWidget(self.last_msg_label)
-        
-        layout.addWidget(self.avatar)
-        layout.addLayout(text_layout)
-        layout.addStretch()
-        
-        right_layout = QVBoxLayout()
-        right_layout.setAlignment(Qt.AlignTop)
-        right_layout.setSpacing(3)
-        
-        if last_msg_time:
-            time_label = QLabel(last_msg_time)
-            time_label.setFont(QFont("Segoe UI", int(10 * self.scale)))
-            right_layout.addWidget(time_label)
-        
-        if unread_count > 0:
-            unread_label = QLabel(str(unread_count))
-            unread_label.setFont(QFont("Segoe UI", int(9 * self.scale), QFont.Bold))
-            unread_label.setStyleSheet("""
-                QLabel {
-                    background: #3390EC;
-                    color: white;
-                    border-radius: 10px;
-                    padding: 2px 6px;
-                    min-width: 20px;
-                }
-            """)
-            unread_label.setAlignment(Qt.AlignCenter)
-            right_layout.addWidget(unread_label)
-        
-        layout.addLayout(right_layout)
-        
-        self.setLayout(layout)
-        self.update_style(False)
-        
-    def update_style(self, selected):
-        self.isSelected = selected
-        palette = self.palette()
-        if selected:
-            palette.setColor(QPalette.Window, QColor(self.theme['list_sel']))
-            self.name_label.setStyleSheet(f"color: {self.theme['text']}; font-weight: bold;")
-            self.last_msg_label.setStyleSheet(f"color: {self.theme['text']};")
+        self.text_font = QFont("Segoe UI", int(14 * scale))
+        self.time_font = QFont("Segoe UI", int(11 * scale))
+        self.photo_time_font = QFont("Segoe UI", int(10 * scale))
+        self.text_metrics = QFontMetrics(self.text_font)
+        self.time_metrics = QFontMetrics(self.time_font)
+        self.photo_time_height = QFontMetrics(self.photo_time_font).height()
+        self.margin_h = int(10 * scale)
+        self.margin_v = int(5 * scale)
+        self.pad_h = int(12 * scale)
+        self.pad_v = int(8 * scale)
+        self.spacing = int(6 * scale)
+        self.radius = int(12 * scale)
+        self.photo_size = QSize(int(300 * scale), int(200 * scale))
+        self.size_cache.clear()
+
+    def forget_photo(self, photo_path):
+        """Фото появилось на диске (например, докачалось) — можно снова пробовать сделать превью"""
+        self.failed.discard(photo_path)
+        self.missing_requested.pop(photo_path, None)
+
+    def request_missing(self, msg):
+        """Просит скачать фото заново, если загрузка не удалась или прервалась"""
+        photo_path = msg['photo_path']
+        if not msg.get('file_id') or os.path.exists(photo_path):
+            return
+        now = time.monotonic()
+        if now - self.missing_requested.get(photo_path, -PHOTO_RETRY_INTERVAL) < PHOTO_RETRY_INTERVAL:
+            return
+        self.missing_requested[photo_path] = now
+        self.photo_missing.emit(msg['file_id'], photo_path)
+
+    def is_photo(self, msg):
+        return msg.get('type') == 'photo' and 'photo_path' in msg
+
+    def bubble_layout(self, msg):
+        """Возвращает (размер пузыря, размер текста) для текущей ширины ленты"""
+        width = self.view.layout_width()
+        key = (msg.get('id'), msg.get('timestamp'), width)
+        cached = self.size_cache.get(key)
+        if cached:
+            return cached
+
+        if self.is_photo(msg):
+            bubble = QSize(self.photo_size.width(), self.photo_size.height() + 5 + self.photo_time_height)
+            text_size = QSize()
+        else:
+            time_fm = self.time_metrics
+            time_width = time_fm.horizontalAdvance(msg.get('time', ''))
+            max_bubble = max(int(width * 0.75) - 2 * self.margin_h, 4 * self.pad_h + time_width)
+            max_text = max_bubble - 2 * self.pad_h - self.spacing - time_width
+            text_rect = self.text_metrics.boundingRect(
+                QRect(0, 0, max_text, 1000000), Qt.TextWordWrap, message_text(msg))
+            text_size = text_rect.size()
+            bubble = QSize(text_size.width() + self.spacing + time_width + 2 * self.pad_h,
+                           max(text_size.height(), time_fm.height()) + 2 * self.pad_v)
+
+        cached = (bubble, text_size)
+        if len(self.size_cache) >= SIZE_CACHE_LIMIT:
+            self.size_cache.clear()
+        self.size_cache[key] = cached
+        return cached
+
+    def sizeHint(self, option, index):
+        bubble, _ = self.bubble_layout(index.model().message(index.row()))
+        return QSize(self.view.viewport().width(), bubble.height() + 2 * self.margin_v)
+
+    def photo_pixmap(self, photo_path):
+        """Превью из QPixmapCache; если его нет — ставит декодирование в очередь и возвращает None"""
+        thumb_path = thumbnail_path(photo_path, self.photo_size)
+        pixmap = QPixmapCache.find(thumb_path)
+        if pixmap is not None and not pixmap.isNull():
+            return pixmap
+        if photo_path not in self.failed and (os.path.exists(thumb_path) or os.path.exists(photo_path)):
+            self.photo_loader.request(photo_path, self.photo_size)
+        return None
+
+    def on_photo_decoded(self, photo_path, thumb_path, image, preview):
+        # QPixmap можно создавать только в GUI-потоке, поэтому конвертация здесь
+        if image.isNull():
+            self.failed.add(photo_path)
+        else:
+            QPixmapCache.insert(thumb_path, QPixmap.fromImage(image))
+            if len(self.previews) >= PREVIEW_CACHE_LIMIT:
+                self.previews.clear()
+            self.previews[photo_path] = preview
+        model = self.view.model()
+        if model is not None:
+            model.photo_changed(photo_path)
+
+    def cancel_hidden_photos(self):
+        """Отменяет декодирование фото, которые прокрутились за пределы экрана"""
+        if not self.photo_loader.tasks:
+            return
+        model = self.view.model()
+        viewport = self.view.viewport().rect()
+        first = self.view.indexAt(viewport.topLeft())
+        last = self.view.indexAt(viewport.bottomLeft())
+        if model is None or not first.isValid():
+            self.photo_loader.cancel_except(())
+            return
+        last_row = last.row() if last.isValid() else model.rowCount() - 1
+        visible = set()
+        for row in range(first.row(), last_row + 1):
+            msg = model.message(row)
+            if self.is_photo(msg):
+                visible.add(thumbnail_path(msg['photo_path'], self.photo_size))
+        self.photo_loader.cancel_except(visible)
+
+    def paint(self, painter, option, index):
+        msg = index.model().message(index.row())
+        bubble_size, text_size = self.bubble_layout(msg)
+        is_outgoing = msg.get('out', False)
+        rect = option.rect
+        if is_outgoing:
+            x = rect.right() - self.margin_h - bubble_size.width() + 1
         else:
-            palette.setColor(QPalette.Window, QColor(self.theme['list_bg']))
-            self.name_label.setStyleSheet(f"color: {self.theme['text']};")
-            self.last_msg_label.setStyleSheet(f"color: {self.theme['text_secondary']};")
-        
-        self.setPalette(palette)
-
-    def enterEvent(self, event):
-        if not self.isSelected:
-            palette = self.palette()
-            palette.setColor(QPalette.Window, QColor(self.theme['list_hover']))
-            self.setPalette(palette)
-        super().enterEvent(event)
-
-    def leaveEvent(self, event):
-        if not self.isSelected:
-            palette = self.palette()
-            palette.setColor(QPalette.Window, QColor(self.theme['list_bg']))
-            self.setPalette(palette)
-        super().leaveEvent(event)
-
-class SmoothScrollArea(QScrollArea):
-    """Плавная прокрутка с автоскроллом"""
+            x = rect.left() + self.margin_h
+        bubble = QRect(QPoint(x, rect.top() + self.margin_v), bubble_size)
+
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        if self.highlight_id is not None and msg.get('id') == self.highlight_id:
+            # Подсветка сообщения, к которому перешли из поиска
+            highlight = QColor(self.theme['accent'])
+            highlight.setAlpha(40)
+            painter.fillRect(rect, highlight)
+        time_color = QColor(self.theme['time_out'] if is_outgoing else self.theme['time_in'])
+        if self.is_photo(msg):
+            self.paint_photo(painter, msg, bubble, time_color)
+        else:
+            self.paint_text(painter, msg, bubble, text_size, is_outgoing, time_color)
+        painter.restore()
+
+    def paint_photo(self, painter, msg, bubble, time_color):
+        photo_rect = QRect(bubble.topLeft(), self.photo_size)
+        painter.setPen(QColor(0, 0, 0, 25))
+        painter.setBrush(QColor(0, 0, 0, 13))
+        painter.drawRoundedRect(photo_rect, 10, 10)
+        pixmap = self.photo_pixmap(msg['photo_path'])
+        preview = self.previews.get(msg['photo_path'])
+        if pixmap:
+            target = QRect(QPoint(0, 0), pixmap.size())
+            target.moveCenter(photo_rect.center())
+            painter.drawPixmap(target, pixmap)
+        elif preview is not None:
+            # Превью вытеснено из кэша и декодируется заново: пока рисуем размытую копию того же размера
+            target = QRect(QPoint(0, 0), preview.size().scaled(self.photo_size, Qt.KeepAspectRatio))
+            target.moveCenter(photo_rect.center())
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+            painter.drawImage(target, preview)
+        else:
+            painter.setFont(self.text_font)
+            painter.drawText(photo_rect, Qt.AlignCenter, "🖼️")
+            self.request_missing(msg)
+
+        painter.setFont(self.photo_time_font)
+        painter.setPen(time_color)
+        time_rect = QRect(bubble.left(), photo_rect.bottom() + 5, bubble.width(),
+                          bubble.bottom() - photo_rect.bottom() - 5)
+        painter.drawText(time_rect, Qt.AlignRight | Qt.AlignVCenter, msg.get('time', ''))
+
+    def paint_text(self, painter, msg, bubble, text_size, is_outgoing, time_color):
+        # Углы как в прежнем стиле: у «хвоста» пузыря радиус 4px, у остальных — 12px
+        tail = int(4 * self.scale)
+        corner = QRect(0, 0, self.radius * 2, self.radius * 2)
+        if is_outgoing:
+            bg_color = QColor(self.theme['msg_out'])
+            text_color = QColor('#FFFFFF')
+            corner.moveBottomRight(bubble.bottomRight())
+        else:
+            bg_color = QColor(self.theme['msg_in'])
+            text_color = QColor(self.theme['text'])
+            corner.moveBottomLeft(bubble.bottomLeft())
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(bg_color)
+        painter.drawRoundedRect(bubble, self.radius, self.radius)
+        painter.drawRoundedRect(corner, tail, tail)
+
+        content = bubble.adjusted(self.pad_h, self.pad_v, -self.pad_h, -self.pad_v)
+        painter.setFont(self.text_font)
+        painter.setPen(text_color)
+        painter.drawText(QRect(content.topLeft(), text_size), Qt.TextWordWrap, message_text(msg))
+
+        painter.setFont(self.time_font)
+        painter.setPen(time_color)
+        painter.drawText(content, Qt.AlignRight | Qt.AlignBottom, msg.get('time', ''))
+
+
+class MessageListView(QListView):
+    """Лента сообщений с автоскроллом вниз"""
     def __init__(self, parent=None):
         super().__init__(parent)
-        self.setWidgetResizable(True)
         self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.setStyleSheet("background: transparent; border: none;")
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setResizeMode(QListView.Adjust)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setFrameShape(QFrame.NoFrame)
         self.verticalScrollBar().setSingleStep(10)
         self.auto_scroll_enabled = True
-        
+        self.scroll_animation = None
+        self.wrap_width = None
+
+    def layout_width(self):
+        """Ширина для переноса строк; не зависит от того, показана ли полоса прокрутки,
+        иначе её появление заставляло бы пересчитывать размеры всех строк"""
+        if self.wrap_width is None:
+            self.wrap_width = self.maximumViewportSize().width() - self.verticalScrollBar().sizeHint().width()
+        return self.wrap_width
+
+    def resizeEvent(self, event):
+        self.wrap_width = None
+        super().resizeEvent(event)
+
+    def scroll_anchor(self):
+        """(верхняя видимая строка, её смещение, прижата ли лента к низу) — снимается до смены стиля,
+        пока раскладка строк ещё действительна"""
+        sb = self.verticalScrollBar()
+        anchor = self.indexAt(QPoint(0, 0))
+        if not anchor.isValid():
+            return -1, 0, True
+        return anchor.row(), self.visualRect(anchor).top(), sb.value() >= sb.maximum()
+
+    def relayout(self, anchor, keep_above=None):
+        """Пересчитывает размеры строк (после смены темы или масштаба), не сдвигая ленту:
+        строка из scroll_anchor остаётся на месте, а прижатая к низу лента — внизу.
+
+        Если задан keep_above, выше видимой части остаётся не больше keep_above строк,
+        чтобы пересчёт не зависел от длины подгруженной истории. Возвращает число убранных строк.
+        """
+        sb = self.verticalScrollBar()
+        row, offset, at_bottom = anchor
+        removed = 0
+        if keep_above is not None and row > keep_above:
+            removed = row - keep_above
+            self.model().remove_first(removed)
+        self.doItemsLayout()
+        if at_bottom or row < 0:
+            sb.setValue(sb.maximum())
+        else:
+            sb.setValue(sb.value() + self.visualRect(self.model().index(row - removed)).top() - offset)
+        return removed
+
     def enable_auto_scroll(self):
         """Включить автоскролл"""
         self.auto_scroll_enabled = True
-        
+
     def disable_auto_scroll(self):
         """Выключить автоскролл (когда пользователь прокручивает вверх)"""
         self.auto_scroll_enabled = False
-        
+
     def scroll_to_bottom_animated(self):
         """Плавная прокрутка вниз"""
         if self.auto_scroll_enabled:
             sb = self.verticalScrollBar()
-            target_value = sb.maximum()
-            
-            animation = QPropertyAnimation(sb, b"value")
-            animation.setDuration(300)
-            animation.setStartValue(sb.value())
-            animation.setEndValue(target_value)
-            animation.setEasingCurve(QEasingCurve.OutCubic)
-            animation.start()
-    
+            self.scroll_animation = QPropertyAnimation(sb, b"value")
+            self.scroll_animation.setDuration(300)
+            self.scroll_animation.setStartValue(sb.value())
+            self.scroll_animation.setEndValue(sb.maximum())
+            self.scroll_animation.setEasingCurve(QEasingCurve.OutCubic)
+            self.scroll_animation.start()
+
     def wheelEvent(self, event):
         """Обработка прокрутки колесиком мыши"""
         super().wheelEvent(event)
-        
+
         if event.angleDelta().y() > 0:
             self.disable_auto_scroll()
         elif self.verticalScrollBar().value() >= self.verticalScrollBar().maximum() - 50:
@@ -877,7 +1179,8 @@ class SettingsDialog(QDialog):
     def __init__(self, parent=None, current_settings=None):
         super().__init__(parent)
         self.setWindowTitle("⚙️ Settings")
-        self.setFixedSize(400, 400)
+        self.setObjectName("settings_dialog")
+        self.setFixedSize(400, 480)
         self.settings_data = current_settings or {}
         
         layout = QVBoxLayout()
@@ -904,6 +1207,17 @@ class SettingsDialog(QDialog):
         scale_h.addWidget(self.scale_lbl)
         t_layout.addLayout(scale_h)
         theme_grp.setLayout(t_layout)
+
+        storage_grp = QGroupBox("💾 Storage")
+        s_layout = QVBoxLayout()
+        self.storage_combo = QComboBox()
+        self.storage_combo.addItem("JSON files", "json")
+        self.storage_combo.addItem("SQLite", "sqlite")
+        index = self.storage_combo.findData(self.settings_data.get('storage', 'json'))
+        self.storage_combo.setCurrentIndex(max(index, 0))
+        s_layout.addWidget(QLabel("Backend:"))
+        s_layout.addWidget(self.storage_combo)
+        storage_grp.setLayout(s_layout)
         
         btn_layout = QHBoxLayout()
         save_btn = QPushButton("💾 Save")
@@ -916,83 +1230,163 @@ class SettingsDialog(QDialog):
         btn_layout.addWidget(save_btn)
         
         layout.addWidget(theme_grp)
+        layout.addWidget(storage_grp)
         layout.addStretch()
         layout.addLayout(btn_layout)
         self.setLayout(layout)
-        
-        self.apply_theme()
-
-    def apply_theme(self):
-        theme_name = self.settings_data.get('theme', 'Light')
-        theme = STYLES.get(theme_name, STYLES['Light'])
-        
-        self.setStyleSheet(f"""
-            QDialog {{
-                background: {theme['bg']};
-                color: {theme['text']};
-                border: 1px solid {theme['border']};
-            }}
-            QGroupBox {{
-                font-weight: bold;
-                border: 1px solid {theme['border']};
-                border-radius: 5px;
-                margin-top: 10px;
-                padding-top: 10px;
-                color: {theme['text']};
-                background: {theme['list_bg']};
-            }}
-            QGroupBox::title {{
-                subcontrol-origin: margin;
-                left: 10px;
-                padding: 0 5px 0 5px;
-                color: {theme['text']};
-            }}
-            QComboBox {{
-                background: {theme['input_bg']};
-                color: {theme['text']};
-                border: 1px solid {theme['border']};
-                border-radius: 3px;
-                padding: 5px;
-            }}
-            QLabel {{
-                color: {theme['text']};
-            }}
-            QPushButton {{
-                background: {theme['accent']};
-                color: white;
-                border: 1px solid {theme['accent']};
-                border-radius: 5px;
-                padding: 8px 15px;
-            }}
-            QPushButton:hover {{
-                background: #44A0FC;
-            }}
-            QPushButton#cancel_btn {{
-                background: {theme['border']};
-                border: 1px solid {theme['border']};
-            }}
-            QPushButton#cancel_btn:hover {{
-                background: {theme['text_secondary']};
-            }}
-        """)
 
     def get_data(self):
         return {
             'theme': self.theme_combo.currentText(),
-            'scale': self.scale_slider.value() / 100.0
+            'scale': self.scale_slider.value() / 100.0,
+            'storage': self.storage_combo.currentData()
         }
 
 
+class SearchWorker(QThread):
+    """Выполняет поисковый запрос в фоне: индекс хранилища может ещё строиться"""
+    found = pyqtSignal(str, list, float)  # запрос, результаты, время в мс
+
+    def __init__(self, db, query, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.query = query
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            hits = self.db.search(self.query)
+        except Exception as e:
+            print(f"Error searching messages: {e}")
+            hits = []
+        self.found.emit(self.query, hits, (time.perf_counter() - started) * 1000)
+
+
+class SearchDialog(QDialog):
+    """Поиск по сообщениям и именам чатов; выбранный результат открывается в чате"""
+    def __init__(self, db, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.selected = None
+        # Запрос из поля ввода, запрос в работе и запрос, чьи результаты сейчас показаны
+        self.query = ""
+        self.worker = None
+        self.shown_query = ""
+        self.open_when_found = False
+        self.chat_names = {cid: chat_title(cid, data) for cid, data in db.get_chats().items()}
+        self.setWindowTitle("🔍 Search")
+        self.setObjectName("search_dialog")
+        self.resize(520, 560)
+
+        layout = QVBoxLayout()
+        layout.setSpacing(10)
+        layout.setContentsMargins(15, 15, 15, 15)
+
+        self.query_input = QLineEdit()
+        self.query_input.setPlaceholderText("Search messages and chats...")
+        self.query_input.textChanged.connect(lambda: self.search_timer.start())
+        self.query_input.returnPressed.connect(self.open_first)
+
+        # Запрос уходит после паузы в наборе, а не на каждую букву
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.run_search)
+
+        self.results = QListWidget()
+        self.results.itemActivated.connect(self.open_item)
+        self.results.itemClicked.connect(self.open_item)
+
+        self.status_label = QLabel("")
+
+        layout.addWidget(self.query_input)
+        layout.addWidget(self.results)
+        layout.addWidget(self.status_label)
+        self.setLayout(layout)
+
+    def run_search(self):
+        self.query = self.query_input.text().strip()
+        if not self.query:
+            self.results.clear()
+            self.shown_query = ""
+            self.status_label.setText("")
+            return
+        # Пока идёт предыдущий запрос, новый ждёт его окончания: on_found запустит последний набранный
+        if self.worker is None:
+            self.start_search()
+
+    def start_search(self):
+        self.worker = SearchWorker(self.db, self.query, self)
+        self.worker.found.connect(self.on_found)
+        self.worker.start()
+        self.status_label.setText("Searching...")
+
+    def on_found(self, query, hits, elapsed):
+        self.worker = None
+        if query != self.query:
+            if self.query:
+                self.start_search()
+            return
+        self.show_results(query, hits, elapsed)
+        if self.open_when_found:
+            self.open_when_found = False
+            if self.results.count():
+                self.open_item(self.results.item(0))
+
+    def show_results(self, query, hits, elapsed):
+        self.results.clear()
+        self.shown_query = query
+        for hit in hits:
+            chat_name = self.chat_names.get(hit['chat_id'], hit['chat_id'])
+            if hit['message_id'] is None:
+                text = f"👤 {chat_name}"
+            else:
+                when = datetime.fromtimestamp(hit['timestamp']).strftime("%d.%m %H:%M") if hit['timestamp'] else ""
+                snippet = hit['text'].replace("\n", " ")
+                if len(snippet) > 80:
+                    snippet = snippet[:77] + "..."
+                text = f"{chat_name}  ·  {when}\n{snippet}"
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, (hit['chat_id'], hit['message_id']))
+            self.results.addItem(item)
+        self.status_label.setText(f"{len(hits)} results in {elapsed:.1f} ms")
+
+    def open_first(self):
+        self.search_timer.stop()
+        query = self.query_input.text().strip()
+        if not query:
+            return
+        if query == self.shown_query and self.worker is None:
+            if self.results.count():
+                self.open_item(self.results.item(0))
+            return
+        self.open_when_found = True
+        self.run_search()
+
+    def open_item(self, item):
+        self.selected = item.data(Qt.UserRole)
+        self.accept()
+
+
 class TelegramClient(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.db = Database()
         self.settings = QSettings("PyTelegram", "Config")
         self.load_settings()
+        # Хранилище читается в фоне; до его загрузки список чатов показывается по снимку
+        self.db = None
+        self.snapshot_path = os.path.join(DATA_DIR, CHAT_SNAPSHOT_FILE)
+        self.store_loader = StoreLoader(self.storage_backend,
+                                        float(self.settings.value("flush_interval", FLUSH_INTERVAL)),
+                                        int(self.settings.value("flush_threshold", FLUSH_THRESHOLD)))
+        self.store_loader.loaded.connect(self.on_store_loaded)
+        self.store_loader.start()
         
         self.bot_token = ""
         self.current_chat_id = None
         self.worker = None
+        self.history_loader = None
+        self.history_complete = True
         self.is_logged_in = False
         
         self.check_login()
@@ -1006,7 +1400,6 @@ class TelegramClient(QMainWindow):
             self.is_logged_in = True
             self.setup_ui()
             self.apply_theme()
-            self.start_bot_worker()
     
     def show_login_dialog(self):
         dlg = LoginDialog()
@@ -1018,7 +1411,8 @@ class TelegramClient(QMainWindow):
                 self.is_logged_in = True
                 self.setup_ui()
                 self.apply_theme()
-                self.start_bot_worker()
+                if self.db is not None:
+                    self.start_bot_worker()
             else:
                 sys.exit(0)
         else:
@@ -1031,13 +1425,22 @@ class TelegramClient(QMainWindow):
                                    QMessageBox.Yes | QMessageBox.No)
         
         if reply == QMessageBox.Yes:
+            self.ensure_store()
             if self.worker:
+                # Неотправленное не должно уйти после входа с другим токеном
+                self.worker.clear_send_queue()
                 self.worker.stop()
                 self.worker = None
             
+            self.db.flush()
             self.db.clear_all_data()
+            self.db.close()
             
             self.settings.remove("bot_token")
+            # Снимок списка чатов тоже удаляем, и closeEvent не должен записать его заново
+            self.is_logged_in = False
+            if os.path.exists(self.snapshot_path):
+                os.remove(self.snapshot_path)
             
             self.close()
             
@@ -1045,12 +1448,27 @@ class TelegramClient(QMainWindow):
             new_window = TelegramClient()
             new_window.show()
     
+    def closeEvent(self, event):
+        self.ensure_store()
+        if self.is_logged_in:
+            save_chat_snapshot(self.snapshot_path, self.storage_backend, self.chat_model.snapshot(CHAT_SNAPSHOT_ROWS))
+        if self.worker:
+            self.worker.stop()
+            self.worker = None
+        if self.history_loader:
+            self.history_loader.wait()
+        self.message_delegate.photo_loader.stop()
+        self.db.close()
+        super().closeEvent(event)
+
     def load_settings(self):
         self.app_scale = float(self.settings.value("scale", 1.0))
         self.current_theme = self.settings.value("theme", "Light")
         if self.current_theme not in STYLES:
             self.current_theme = "Light"
         self.theme_data = STYLES[self.current_theme]
+        self.storage_backend = self.settings.value("storage", "json")
+        self.api_url = self.settings.value("api_url", API_URL)
 
     def setup_ui(self):
         self.setWindowTitle("Telegram Client")
@@ -1065,13 +1483,13 @@ class TelegramClient(QMainWindow):
         main_layout.setContentsMargins(0,0,0,0)
         
         self.left_panel = QWidget()
-        self.left_panel.setFixedWidth(int(380 * self.app_scale))
+        self.left_panel.setObjectName("left_panel")
         left_layout = QVBoxLayout(self.left_panel)
         left_layout.setSpacing(0)
         left_layout.setContentsMargins(0,0,0,0)
         
         self.left_header = QFrame()
-        self.left_header.setFixedHeight(int(60 * self.app_scale))
+        self.left_header.setObjectName("left_header")
         h_layout = QHBoxLayout(self.left_header)
         h_layout.setContentsMargins(15, 0, 15, 0)
         
@@ -1080,7 +1498,7 @@ class TelegramClient(QMainWindow):
         self.menu_btn.clicked.connect(self.open_settings)
         
         self.left_title = QLabel("Telegram")
-        self.left_title.setStyleSheet("color: white; font-size: 20px; font-weight: bold;")
+        self.left_title.setObjectName("left_title")
         
         self.new_chat_btn = QPushButton("✏️")
         self.new_chat_btn.setFixedSize(40, 40)
@@ -1089,6 +1507,7 @@ class TelegramClient(QMainWindow):
         self.search_btn = QPushButton("🔍")
         self.search_btn.setFixedSize(40, 40)
         self.search_btn.setToolTip("Search")
+        self.search_btn.clicked.connect(self.open_search)
         
         h_layout.addWidget(self.menu_btn)
         h_layout.addWidget(self.left_title)
@@ -1096,32 +1515,41 @@ class TelegramClient(QMainWindow):
         h_layout.addWidget(self.new_chat_btn)
         h_layout.addWidget(self.search_btn)
         
-        self.chat_list = QListWidget()
+        self.chat_list = QListView()
+        self.chat_list.setObjectName("chat_list")
+        self.chat_model = ChatListModel(self)
+        self.chat_delegate = ChatListDelegate(self.theme_data, self.app_scale, self.chat_list)
+        self.chat_list.setModel(self.chat_model)
+        self.chat_list.setItemDelegate(self.chat_delegate)
+        self.chat_list.setMouseTracking(True)
+        self.chat_list.setUniformItemSizes(True)
         self.chat_list.setFrameShape(QFrame.NoFrame)
         self.chat_list.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
         self.chat_list.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.chat_list.itemClicked.connect(self.load_chat)
+        self.chat_list.clicked.connect(self.load_chat)
         
         left_layout.addWidget(self.left_header)
         left_layout.addWidget(self.chat_list)
         
 
         self.right_panel = QWidget()
+        self.right_panel.setObjectName("right_panel")
         right_layout = QVBoxLayout(self.right_panel)
         right_layout.setSpacing(0)
         right_layout.setContentsMargins(0,0,0,0)
         
         self.chat_header = QFrame()
-        self.chat_header.setFixedHeight(int(60 * self.app_scale))
+        self.chat_header.setObjectName("chat_header")
         ch_layout = QHBoxLayout(self.chat_header)
         ch_layout.setContentsMargins(15, 0, 15, 0)
         
         self.back_btn = QPushButton("←")
         self.back_btn.setFixedSize(40, 40)
         
-        self.chat_avatar = AvatarLabel("", int(40 * self.app_scale))
+        self.chat_avatar = AvatarLabel("")
         
         self.chat_title = QLabel("Select a chat")
+        self.chat_title.setObjectName("chat_title")
         self.chat_title.setFont(QFont("Segoe UI", 14, QFont.DemiBold))
         
         self.chat_menu_btn = QPushButton("⋮")
@@ -1136,14 +1564,19 @@ class TelegramClient(QMainWindow):
         ch_layout.addWidget(self.chat_menu_btn)
         
 
-        self.scroll_area = SmoothScrollArea()
-        self.msg_container = QWidget()
-        self.msg_layout = QVBoxLayout(self.msg_container)
-        self.msg_layout.addStretch()
-        self.scroll_area.setWidget(self.msg_container)
+        self.message_view = MessageListView()
+        self.message_view.setObjectName("message_view")
+        self.message_model = MessageListModel(self)
+        self.message_delegate = MessageDelegate(self.message_view, self.theme_data, self.app_scale)
+        self.message_delegate.photo_missing.connect(self.on_photo_missing)
+        self.message_view.setModel(self.message_model)
+        self.message_view.setItemDelegate(self.message_delegate)
+        self.message_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.message_view.customContextMenuRequested.connect(self.on_message_context_menu)
+        self.message_view.verticalScrollBar().valueChanged.connect(self.maybe_load_history)
 
         self.input_area = QFrame()
-        self.input_area.setFixedHeight(int(70 * self.app_scale))
+        self.input_area.setObjectName("input_area")
         in_layout = QHBoxLayout(self.input_area)
         in_layout.setContentsMargins(15, 10, 15, 10)
         
@@ -1161,6 +1594,7 @@ class TelegramClient(QMainWindow):
         self.emoji_btn.setToolTip("Emoji")
         
         self.send_btn = QPushButton("➤")
+        self.send_btn.setObjectName("send_btn")
         self.send_btn.setFixedSize(40, 40)
         self.send_btn.clicked.connect(self.send_text)
         self.send_btn.setToolTip("Send message")
@@ -1171,13 +1605,29 @@ class TelegramClient(QMainWindow):
         in_layout.addWidget(self.send_btn)
         
         right_layout.addWidget(self.chat_header)
-        right_layout.addWidget(self.scroll_area)
+        right_layout.addWidget(self.message_view)
         right_layout.addWidget(self.input_area)
         
         main_layout.addWidget(self.left_panel)
         main_layout.addWidget(self.right_panel)
 
-        self.refresh_chats()
+        self.apply_scale()
+        if self.db is None:
+            self.chat_model.set_chats(load_chat_snapshot(self.snapshot_path, self.storage_backend))
+        else:
+            self.refresh_chats()
+        # Первая отрисовка списка чатов — конец видимой части запуска
+        self.chat_list.viewport().installEventFilter(self)
+        startup_mark("ui")
+
+    def apply_scale(self):
+        """Размеры панелей по app_scale; шрифты и отступы строк берут масштаб в делегатах (apply_theme)"""
+        s = self.app_scale
+        self.left_panel.setFixedWidth(int(380 * s))
+        self.left_header.setFixedHeight(int(60 * s))
+        self.chat_header.setFixedHeight(int(60 * s))
+        self.chat_avatar.set_size(int(40 * s))
+        self.input_area.setFixedHeight(int(70 * s))
 
     def create_menu(self):
         """Создает главное меню"""
@@ -1198,6 +1648,11 @@ class TelegramClient(QMainWindow):
         settings_action.triggered.connect(self.open_settings)
         edit_menu.addAction(settings_action)
 
+        search_action = QAction('🔍 Search', self)
+        search_action.setShortcut('Ctrl+F')
+        search_action.triggered.connect(self.open_search)
+        edit_menu.addAction(search_action)
+
         view_menu = menubar.addMenu('👁️ View')
         
         refresh_action = QAction('🔄 Refresh', self)
@@ -1212,249 +1667,203 @@ class TelegramClient(QMainWindow):
 
     def apply_theme(self):
         t = self.theme_data
-
-        self.setStyleSheet(f"""
-            QMainWindow {{
-                background: {t['bg']};
-            }}
-            QMenuBar {{
-                background: {t['bg']};
-                color: {t['text']};
-                border-bottom: 1px solid {t['border']};
-            }}
-            QMenuBar::item:selected {{
-                background: {t['list_hover']};
-            }}
-            QMenu {{
-                background: {t['list_bg']};
-                color: {t['text']};
-                border: 1px solid {t['border']};
-            }}
-            QMenu::item:selected {{
-                background: {t['list_hover']};
-            }}
-        """)
-
-        self.left_panel.setStyleSheet(f"background: {t['list_bg']};")
-
-        self.left_header.setStyleSheet(f"""
-            QFrame {{
-                background: {t['accent']};
-                border: none;
-            }}
-            QPushButton {{
-                background: transparent;
-                border: none;
-                color: white;
-                font-size: 18px;
-                border-radius: 20px;
-            }}
-            QPushButton:hover {{
-                background: rgba(255,255,255,0.1);
-            }}
-        """)
-
-        self.chat_list.setStyleSheet(f"""
-            QListWidget {{
-                background: {t['list_bg']};
-                color: {t['text']};
-                border: none;
-                outline: none;
-            }}
-            QListWidget::item {{
-                border: none;
-                background: transparent;
-            }}
-            QListWidget::item:hover {{
-                background: {t['list_hover']};
-            }}
-            QListWidget::item:selected {{
-                background: {t['list_sel']};
-            }}
-            QScrollBar:vertical {{
-                background: {t['list_bg']};
-                width: 8px;
-                margin: 0px;
-            }}
-            QScrollBar::handle:vertical {{
-                background: {t['border']};
-                border-radius: 4px;
-                min-height: 20px;
-            }}
-            QScrollBar::handle:vertical:hover {{
-                background: {t['text_secondary']};
-            }}
-        """)
-
-        self.chat_header.setStyleSheet(f"""
-            QFrame {{
-                background: {t['bg']};
-                border-bottom: 1px solid {t['border']};
-            }}
-            QPushButton {{
-                background: transparent;
-                border: none;
-                color: {t['text']};
-                font-size: 18px;
-                border-radius: 20px;
-            }}
-            QPushButton:hover {{
-                background: rgba(0,0,0,0.1);
-            }}
-        """)
-
-        self.input_area.setStyleSheet(f"""
-            QFrame {{
-                background: {t['bg']};
-                border-top: 1px solid {t['border']};
-            }}
-            QPushButton {{
-                background: transparent;
-                border: none;
-                color: {t['text']};
-                font-size: 18px;
-                border-radius: 20px;
-            }}
-            QPushButton:hover {{
-                background: rgba(0,0,0,0.1);
-            }}
-            QPushButton#send_btn {{
-                background: {t['accent']};
-                color: white;
-            }}
-            QPushButton#send_btn:hover {{
-                background: #44A0FC;
-            }}
-            QLineEdit {{
-                background: {t['input_bg']};
-                color: {t['text']};
-                border: 1px solid {t['border']};
-                border-radius: 20px;
-                padding: 8px 15px;
-                font-size: 14px;
-            }}
-        """)
-        
-        self.send_btn.setObjectName("send_btn")
-
-        self.right_panel.setStyleSheet(f"background: {t['chat_bg']};")
-        self.chat_title.setStyleSheet(f"color: {t['text']};")
-
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            widget = self.chat_list.itemWidget(item)
-            if widget:
-                widget.update_style(item.isSelected())
+        app = QApplication.instance()
+        stylesheet = theme_stylesheet(self.current_theme)
+        # Таблица зависит только от темы: при смене одного масштаба виджеты не перечитывают стили
+        if app.styleSheet() != stylesheet:
+            app.setStyleSheet(stylesheet)
+        anchor = self.message_view.scroll_anchor()
+        self.message_delegate.set_style(t, self.app_scale)
+        # Пересчёт ленты — после того, как отработают отложенные изменения геометрии панелей
+        QTimer.singleShot(0, lambda: self.relayout_messages(anchor))
+
+        self.chat_delegate.set_style(t, self.app_scale)
+        self.chat_list.doItemsLayout()
+
+    def relayout_messages(self, anchor):
+        if self.message_view.relayout(anchor, keep_above=HISTORY_PAGE_SIZE):
+            self.history_complete = False
 
     def start_bot_worker(self):
         """Запускает worker для получения сообщений"""
         if self.worker:
             self.worker.stop()
         
-        self.worker = BotWorker(self.bot_token)
-        self.worker.new_message.connect(self.on_new_message)
+        allowed_updates = self.settings.value("allowed_updates", "")
+        # Если задан публичный адрес webhook, update принимает встроенный сервер, а не getUpdates
+        webhook_url = self.settings.value("webhook_url", "")
+        webhook = None
+        if webhook_url:
+            webhook = {'url': webhook_url,
+                       'host': self.settings.value("webhook_host", WEBHOOK_HOST),
+                       'port': int(self.settings.value("webhook_port", WEBHOOK_PORT)),
+                       'path': self.settings.value("webhook_path", WEBHOOK_PATH),
+                       'secret': self.settings.value("webhook_secret", "") or None}
+        self.worker = BotWorker(self.bot_token, self.db,
+                                poll_timeout=int(self.settings.value("poll_timeout", POLL_TIMEOUT)),
+                                allowed_updates=allowed_updates.split(",") if allowed_updates else None,
+                                api_url=self.api_url, webhook=webhook)
+        self.worker.new_messages.connect(self.on_new_messages)
         self.worker.connection_status.connect(self.update_status)
-        self.worker.photo_received.connect(self.on_photo_received)
+        self.worker.send_finished.connect(self.on_send_finished)
+        self.worker.photo_ready.connect(self.on_photo_ready)
         self.worker.start()
 
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Paint and obj is self.chat_list.viewport():
+            obj.removeEventFilter(self)
+            startup_mark("first_paint")
+        return super().eventFilter(obj, event)
+
+    def on_store_loaded(self):
+        """Хранилище готово: полный список чатов вместо снимка и запуск приёма сообщений"""
+        if self.db is not None:
+            return
+        self.db = self.store_loader.db
+        startup_mark("store")
+        # До входа (окно логина) интерфейса ещё нет: список и worker поднимет check_login
+        if self.is_logged_in:
+            self.set_chat_entries(self.store_loader.entries)
+            self.start_bot_worker()
+
+    def ensure_store(self):
+        """Если хранилище понадобилось раньше, чем догрузилось в фоне, — дожидаемся его"""
+        if self.db is None:
+            self.store_loader.wait()
+            self.on_store_loaded()
+
     def refresh_chats(self):
-        self.chat_list.clear()
+        """Полная перезагрузка списка; новые сообщения обновляют строки через update_chat"""
+        self.ensure_store()
         chats = self.db.get_chats()
-        for cid, data in chats.items():
-            widget = ChatListItem(cid, data, self.theme_data, self.app_scale)
-            item = QListWidgetItem()
-            item.setSizeHint(widget.sizeHint())
-            item.setData(Qt.UserRole, cid)
-            self.chat_list.addItem(item)
-            self.chat_list.setItemWidget(item, widget)
-
-    def load_chat(self, item):
-        chat_id = item.data(Qt.UserRole)
+        summaries = self.db.get_summaries()
+        self.set_chat_entries({
+            cid: {'chat': data, 'summary': summaries.get(cid) or summarize_messages([])}
+            for cid, data in chats.items()
+        })
+
+    def set_chat_entries(self, entries):
+        self.chat_model.set_chats(entries)
+        if self.current_chat_id:
+            row = self.chat_model.row_of(self.current_chat_id)
+            if row >= 0:
+                self.chat_list.setCurrentIndex(self.chat_model.index(row))
+
+    def update_chat_summary(self, chat_id):
+        self.chat_model.set_summary(chat_id, self.db.get_summary(chat_id))
+
+    def load_chat(self, index):
+        chat_id = index.data(Qt.UserRole)
         self.current_chat_id = chat_id
+        # По строке снимка могли кликнуть до загрузки хранилища; выделение восстановит set_chat_entries
+        self.ensure_store()
+        self.db.mark_read(chat_id)
+        self.update_chat_summary(chat_id)
 
         chats = self.db.get_chats()
-        chat_data = chats.get(chat_id, {})
-        
-        first_name = chat_data.get('first_name', '')
-        last_name = chat_data.get('last_name', '')
-        username = chat_data.get('username', '')
-        
-        name = f"{first_name} {last_name}".strip()
-        if not name:
-            name = username if username else str(chat_id)
+        name = chat_title(chat_id, chats.get(chat_id, {}))
         
         self.chat_title.setText(name)
         self.chat_avatar.setText(name[0].upper() if name else "?")
 
-        self.clear_message_area()
-
-        msgs = self.db.get_messages(chat_id)
-        for msg in msgs:
-            self.add_message_bubble(msg, animate=False)
+        # Сначала только последняя страница; старые сообщения подгружаются при прокрутке вверх
+        messages = self.db.get_messages(chat_id, limit=HISTORY_PAGE_SIZE)
+        self.history_complete = len(messages) < HISTORY_PAGE_SIZE
+        self.message_model.set_messages(messages)
+        self.message_view.enable_auto_scroll()
+        self.message_view.scrollToBottom()
+        self.maybe_load_history()
+
+    def maybe_load_history(self):
+        """Запускает подгрузку старой страницы, когда лента прокручена почти до верха"""
+        if self.history_complete or not self.current_chat_id or not self.message_model.messages:
+            return
+        if self.history_loader and self.history_loader.isRunning():
+            return
+        if self.message_view.verticalScrollBar().value() > self.message_view.viewport().height():
+            return
+        self.history_loader = HistoryLoader(self.db, self.current_chat_id, self.message_model.message(0).get('id'))
+        self.history_loader.loaded.connect(self.on_history_loaded)
+        self.history_loader.finished.connect(self.maybe_load_history)
+        self.history_loader.start()
+
+    def on_history_loaded(self, chat_id, messages):
+        # Пока страница грузилась, чат могли сменить или дозагрузить историю переходом из поиска
+        if chat_id != str(self.current_chat_id) or not self.message_model.messages:
+            return
+        if self.history_loader.before_id != self.message_model.message(0).get('id'):
+            return
+        if len(messages) < HISTORY_PAGE_SIZE:
+            self.history_complete = True
+        # Держим видимые сообщения на месте: запоминаем расстояние до низа ленты
+        sb = self.message_view.verticalScrollBar()
+        from_bottom = sb.maximum() - sb.value()
+        self.message_model.prepend_messages(messages)
+        self.message_view.doItemsLayout()
+        sb.setValue(sb.maximum() - from_bottom)
+
+    def open_search(self):
+        self.ensure_store()
+        dlg = SearchDialog(self.db, self)
+        if dlg.exec_() == QDialog.Accepted and dlg.selected:
+            self.jump_to_message(*dlg.selected)
+
+    def jump_to_message(self, chat_id, message_id=None):
+        """Открывает чат и прокручивает к сообщению, дочитывая историю до него"""
+        self.load_chat_by_id(chat_id)
+        if message_id is None or str(self.current_chat_id) != str(chat_id):
+            return
+        row = self.message_model.row_of(message_id)
+        limit = HISTORY_PAGE_SIZE
+        while row < 0 and not self.history_complete and self.message_model.messages:
+            # Страницы растут вдвое, чтобы до старого сообщения было немного запросов
+            limit *= 2
+            older = self.db.get_messages(chat_id, before_id=self.message_model.message(0).get('id'), limit=limit)
+            if len(older) < limit:
+                self.history_complete = True
+            self.message_model.prepend_messages(older)
+            row = self.message_model.row_of(message_id)
+        if row < 0:
+            return
+        self.message_view.disable_auto_scroll()
+        self.message_delegate.highlight_id = message_id
+        self.message_view.scrollTo(self.message_model.index(row), QAbstractItemView.PositionAtCenter)
+        QTimer.singleShot(2000, self.clear_highlight)
 
-        self.scroll_area.enable_auto_scroll()
-        QTimer.singleShot(100, self.scroll_area.scroll_to_bottom_animated)
+    def clear_highlight(self):
+        self.message_delegate.highlight_id = None
+        self.message_view.viewport().update()
 
     def clear_message_area(self):
-        while self.msg_layout.count() > 1:
-            item = self.msg_layout.takeAt(0)
-            if item.widget():
-                item.widget().deleteLater()
+        self.message_model.clear()
 
     def add_message_bubble(self, msg_data, animate=True):
-        bubble = MessageBubble(msg_data, self.theme_data, self.app_scale)
-        bubble.setContextMenuPolicy(Qt.CustomContextMenu)
-        bubble.customContextMenuRequested.connect(lambda pos, msg=msg_data: self.show_message_menu(msg, pos))
-        
-        wrapper = QWidget()
-        wrapper_layout = QHBoxLayout(wrapper)
-        wrapper_layout.setContentsMargins(int(10 * self.app_scale), int(5 * self.app_scale), 
-                                         int(10 * self.app_scale), int(5 * self.app_scale))
-        
-        if msg_data.get('out', False):
-            wrapper_layout.addStretch()
-            wrapper_layout.addWidget(bubble)
-        else:
-            wrapper_layout.addWidget(bubble)
-            wrapper_layout.addStretch()
-            
-        self.msg_layout.insertWidget(self.msg_layout.count() - 1, wrapper)
-        
-        if animate:
-            effect = QGraphicsDropShadowEffect(bubble)
-            effect.setBlurRadius(10)
-            effect.setColor(QColor(0,0,0,50))
-            bubble.setGraphicsEffect(effect)
-            
-            anim = QPropertyAnimation(wrapper, b"windowOpacity")
-            anim.setDuration(300)
-            anim.setStartValue(0)
-            anim.setEndValue(1)
-            anim.start()
+        self.add_message_bubbles([msg_data], animate)
 
-            if self.scroll_area.auto_scroll_enabled:
-                QTimer.singleShot(50, self.scroll_area.scroll_to_bottom_animated)
+    def add_message_bubbles(self, messages, animate=True):
+        self.message_model.append_messages(messages)
+        if animate and self.message_view.auto_scroll_enabled:
+            QTimer.singleShot(50, self.message_view.scroll_to_bottom_animated)
+
+    def on_message_context_menu(self, pos):
+        index = self.message_view.indexAt(pos)
+        if index.isValid():
+            self.show_message_menu(self.message_model.message(index.row()),
+                                   self.message_view.viewport().mapTo(self, pos))
 
     def send_text(self):
         txt = self.msg_input.text().strip()
         if not txt or not self.current_chat_id: 
             return
 
-        msg_data = {
-            'id': int(datetime.now().timestamp() * 1000),
-            'text': txt,
-            'out': True,
-            'time': datetime.now().strftime("%H:%M"),
-            'type': 'text',
-            'timestamp': datetime.now().timestamp()
-        }
-        self.db.save_message(self.current_chat_id, txt, True, 'text')
-        self.add_message_bubble(msg_data)
+        msg_data = self.db.save_message(self.current_chat_id, txt, True, 'text')
+        if msg_data:
+            self.add_message_bubble(msg_data)
+            self.chat_model.update_chat(self.current_chat_id, summary=self.db.get_summary(self.current_chat_id))
         self.msg_input.clear()
         
         # 2. Network Send
-        self.sender_thread = SendWorker(self.bot_token, self.current_chat_id, text=txt)
-        self.sender_thread.start()
+        self.worker.send_message(self.current_chat_id, txt)
 
     def attach_file(self):
         if not self.current_chat_id: 
@@ -1469,51 +1878,46 @@ class TelegramClient(QMainWindow):
             if ext in ['.png', '.jpg', '.jpeg']:
                 msg_type = "photo"
                 display_text = "🖼️ Photo"
-                with open(path, 'rb') as f:
-                    photo_data = f.read()
-                self.db.save_message(self.current_chat_id, display_text, True, msg_type, 
-                                    file_path=path, file_name=filename, photo_data=photo_data)
+                # Фото копируется в кэш блоками, в память целиком не читается
+                msg_data = self.db.save_message(self.current_chat_id, display_text, True, msg_type, 
+                                               file_path=path, file_name=filename, photo_file=path)
             else:
                 msg_type = "document"
                 display_text = f"📎 {filename}"
-                self.db.save_message(self.current_chat_id, display_text, True, msg_type, 
-                                    file_path=path, file_name=filename)
-
-            msg_data = {
-                'id': int(datetime.now().timestamp() * 1000),
-                'text': display_text,
-                'out': True,
-                'time': datetime.now().strftime("%H:%M"),
-                'type': msg_type,
-                'timestamp': datetime.now().timestamp(),
-                'file_name': filename
-            }
-            
-            if msg_type == 'photo' and 'photo_path' in msg_data:
-                msg_data['photo_path'] = os.path.join(self.db.db_path, "photos_cache", 
-                                                     f"photo_{msg_data['id']}.jpg")
-            
-            self.add_message_bubble(msg_data)
-            
-
-            self.sender_thread = SendWorker(self.bot_token, self.current_chat_id, file_path=path)
-            self.sender_thread.start()
+                msg_data = self.db.save_message(self.current_chat_id, display_text, True, msg_type, 
+                                               file_path=path, file_name=filename)
 
-    def on_new_message(self, data):
-        self.refresh_chats()
-        if str(data.get('chat_id', '')) == str(self.current_chat_id):
-            msgs = self.db.get_messages(self.current_chat_id)
-            if msgs:
-                self.add_message_bubble(msgs[-1])
-
-    def on_photo_received(self, chat_id, photo_data):
-        """Обработка полученного фото"""
+            if msg_data:
+                self.add_message_bubble(msg_data)
+                self.chat_model.update_chat(self.current_chat_id, summary=self.db.get_summary(self.current_chat_id))
+            
+            self.worker.send_file(self.current_chat_id, path)
+
+    def on_new_messages(self, events):
+        """Один вызов на весь ответ getUpdates; меняются только строки затронутых чатов"""
+        current = [event['message'] for event in events if str(event['chat_id']) == str(self.current_chat_id)]
+        if current:
+            # Сообщения в открытом чате пользователь видит сразу
+            self.db.mark_read(self.current_chat_id)
+        for event in events:
+            self.chat_model.update_chat(event['chat_id'], event['chat'], self.db.get_summary(event['chat_id']))
+        if current:
+            self.add_message_bubbles(current)
+
+    def on_photo_ready(self, chat_id, photo_path):
+        """Подставляет скачанное фото вместо заглушки в открытом чате"""
+        self.message_delegate.forget_photo(photo_path)
         if str(chat_id) == str(self.current_chat_id):
+            self.message_model.photo_changed(photo_path)
 
-            self.refresh_chats()
-            msgs = self.db.get_messages(self.current_chat_id)
-            if msgs:
-                self.add_message_bubble(msgs[-1])
+    def on_photo_missing(self, file_id, photo_path):
+        """Фото в открытом чате так и не скачалось — ставим его в загрузку ещё раз"""
+        if self.worker and self.current_chat_id is not None:
+            self.worker.request_photo(self.current_chat_id, file_id, photo_path)
+
+    def on_send_finished(self, chat_id, ok, error):
+        if not ok:
+            self.statusBar().showMessage(f"❌ Failed to send message: {error}", 5000)
 
     def update_status(self, connected):
         status = "🟢 Online" if connected else "🔴 Offline"
@@ -1522,16 +1926,23 @@ class TelegramClient(QMainWindow):
     def open_settings(self):
         curr = {
             'theme': self.current_theme,
-            'scale': self.app_scale
+            'scale': self.app_scale,
+            'storage': self.storage_backend
         }
         dlg = SettingsDialog(self, curr)
         if dlg.exec_() == QDialog.Accepted:
             data = dlg.get_data()
             self.settings.setValue("theme", data['theme'])
             self.settings.setValue("scale", data['scale'])
-            
-            QMessageBox.information(self, "🔄 Restart Required", "Please restart the app to apply changes.")
+            self.settings.setValue("storage", data['storage'])
+
+            # Тема и масштаб применяются сразу; хранилище открыто на всё время работы
+            if data['storage'] != self.storage_backend:
+                QMessageBox.information(self, "🔄 Restart Required", "Please restart the app to switch storage.")
+            scale_changed = data['scale'] != self.app_scale
             self.load_settings()
+            if scale_changed:
+                self.apply_scale()
             self.apply_theme()
 
     def show_about(self):
@@ -1551,6 +1962,12 @@ class TelegramClient(QMainWindow):
     def show_message_menu(self, message_data, pos):
         menu = QMenu(self)
         
+        # Текст в ленте рисуется делегатом и не выделяется мышью, поэтому копирование — через меню
+        if message_data.get('text'):
+            copy_action = QAction("📋 Copy Text", self)
+            copy_action.triggered.connect(lambda: QApplication.clipboard().setText(message_data['text']))
+            menu.addAction(copy_action)
+        
         delete_action = QAction("🗑️ Delete Message", self)
         delete_action.triggered.connect(lambda: self.delete_message(message_data))
         menu.addAction(delete_action)
@@ -1592,17 +2009,12 @@ class TelegramClient(QMainWindow):
         chats = self.db.get_chats()
         chat_data = chats.get(str(self.current_chat_id), {})
         
-        first_name = chat_data.get('first_name', '')
-        last_name = chat_data.get('last_name', '')
         username = chat_data.get('username', '')
+        name = chat_title(self.current_chat_id, chat_data)
         
-        name = f"{first_name} {last_name}".strip()
-        if not name:
-            name = username if username else str(self.current_chat_id)
-        
-        messages = self.db.get_messages(self.current_chat_id)
-        total_messages = len(messages)
-        your_messages = sum(1 for msg in messages if msg.get('out', False))
+        summary = self.db.get_summary(self.current_chat_id)
+        total_messages = summary['total']
+        your_messages = summary['outgoing']
         their_messages = total_messages - your_messages
         
         info_text = f"""
@@ -1628,6 +2040,7 @@ class TelegramClient(QMainWindow):
         if reply == QMessageBox.Yes:
             success = self.db.delete_message(self.current_chat_id, message_data.get('id', 0))
             if success:
+                self.update_chat_summary(self.current_chat_id)
                 self.load_chat_by_id(self.current_chat_id)
             else:
                 QMessageBox.warning(self, "❌ Error", "Failed to delete message")
@@ -1643,18 +2056,17 @@ class TelegramClient(QMainWindow):
         if reply == QMessageBox.Yes:
             success = self.db.clear_chat(self.current_chat_id)
             if success:
+                self.update_chat_summary(self.current_chat_id)
                 self.clear_message_area()
-                self.msg_layout.addStretch()
             else:
                 QMessageBox.warning(self, "❌ Error", "Failed to clear chat history")
 
     def load_chat_by_id(self, chat_id):
-        for i in range(self.chat_list.count()):
-            item = self.chat_list.item(i)
-            if item.data(Qt.UserRole) == chat_id:
-                self.chat_list.setCurrentItem(item)
-                self.load_chat(item)
-                break
+        row = self.chat_model.row_of(chat_id)
+        if row >= 0:
+            index = self.chat_model.index(row)
+            self.chat_list.setCurrentIndex(index)
+            self.load_chat(index)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
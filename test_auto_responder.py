@@ -0,0 +1,153 @@
+"""Семантика автоответчика (bot_engine.AutoResponder): какие правила срабатывают и какое из них отвечает.
+
+    python -m unittest test_auto_responder
+"""
+import random
+import re
+import unittest
+
+from bot_engine import AutoResponder, KeywordMatcher, is_word_char, regex_literal_prefix
+
+
+def make_responder(rules):
+    responder = AutoResponder("/nonexistent/auto_replies.json")
+    responder.compile([dict(rule, reply=rule.get('reply', f"reply {i}")) for i, rule in enumerate(rules)])
+    return responder
+
+
+def reference_match(rules, text):
+    """Правила по одному, обычными re.search: раньше всех в тексте, при равенстве — выше в списке"""
+    best = None
+    for index, rule in enumerate(rules):
+        pattern = rule['pattern']
+        if rule['type'] == 'regex':
+            regex = pattern
+        else:
+            regex = re.escape(pattern)
+            if rule['type'] == 'prefix':
+                regex = r"^\s*" + regex
+            else:
+                if is_word_char(pattern[0]):
+                    regex = r"(?<!\w)" + regex
+                if is_word_char(pattern[-1]):
+                    regex += r"(?!\w)"
+        found = re.search(regex, text, re.IGNORECASE)
+        if found is None:
+            continue
+        start = len(text) - len(text.lstrip()) if rule['type'] == 'prefix' else found.start()
+        if best is None or (start, index) < best:
+            best = (start, index)
+    return best[1] if best else None
+
+
+class KeywordMatcherTest(unittest.TestCase):
+    def test_finds_all_overlapping_occurrences(self):
+        matcher = KeywordMatcher([("he", 0), ("she", 1), ("his", 2), ("hers", 3)])
+        self.assertEqual(sorted(matcher.find("ushers")), [(1, 4, 1), (2, 4, 0), (2, 6, 3)])
+
+    def test_regex_literal_prefix(self):
+        cases = {
+            r"order\d+": "order",
+            r"price\?": "price?",
+            r"colou?r": "colo",
+            r"ab+c": "ab",
+            r"a|b": "",
+            r"\d+ items": "",
+            r"(?i)x": "",
+        }
+        for pattern, literal in cases.items():
+            self.assertEqual(regex_literal_prefix(pattern), literal, pattern)
+
+
+class AutoResponderTest(unittest.TestCase):
+    def test_keyword_matches_whole_words_ignoring_case(self):
+        responder = make_responder([{'type': 'keyword', 'pattern': "price"}])
+        self.assertEqual(responder.match("What's the PRICE?"), 0)
+        self.assertIsNone(responder.match("priceless"))
+        self.assertIsNone(responder.match("the_price"))
+
+    def test_keyword_phrase(self):
+        responder = make_responder([{'type': 'keyword', 'pattern': "How much"}])
+        self.assertEqual(responder.match("so, how MUCH is it"), 0)
+        self.assertIsNone(responder.match("how muchness"))
+
+    def test_prefix_only_at_start(self):
+        responder = make_responder([{'type': 'prefix', 'pattern': "/start"}])
+        self.assertEqual(responder.match("  /START now"), 0)
+        self.assertIsNone(responder.match("say /start"))
+
+    def test_regex_kinds(self):
+        responder = make_responder([
+            {'type': 'regex', 'pattern': r"order\s*#?\d+"},
+            {'type': 'regex', 'pattern': r"\d{3}-\d{4}"},
+            {'type': 'regex', 'pattern': r"(hello|hi) there"},
+        ])
+        self.assertEqual(responder.match("my ORDER #12 is late"), 0)
+        self.assertEqual(responder.match("call 555-1234"), 1)
+        self.assertEqual(responder.match("well, hi there"), 2)
+        self.assertIsNone(responder.match("order none"))
+
+    def test_earliest_match_wins_then_rule_order(self):
+        rules = [{'type': 'keyword', 'pattern': "refund"}, {'type': 'keyword', 'pattern': "price"},
+                 {'type': 'regex', 'pattern': r"pri\w+"}]
+        responder = make_responder(rules)
+        self.assertEqual(responder.match("price and refund"), 1)
+        self.assertEqual(responder.match("refund and price"), 0)
+        self.assertEqual(responder.match("pricing"), 2)
+
+    def test_case_folding_that_changes_length(self):
+        # "İ".lower() — два символа, позиции в тексте нижнего регистра сдвигаются
+        responder = make_responder([
+            {'type': 'regex', 'pattern': r"order\d+"},
+            {'type': 'regex', 'pattern': "foo"},
+            {'type': 'keyword', 'pattern': "price"},
+            {'type': 'prefix', 'pattern': "go"},
+        ])
+        self.assertEqual(responder.match("İİ order12"), 0)
+        self.assertEqual(responder.match("İfoo"), 1)
+        self.assertEqual(responder.match("İİ price?"), 2)
+        self.assertIsNone(responder.match("İprice"))
+        self.assertEqual(responder.match(" go İ"), 3)
+        self.assertIsNone(responder.match("İ go"))
+
+    def test_keyword_does_not_match_part_of_expanded_character(self):
+        responder = make_responder([{'type': 'keyword', 'pattern': "i"}])
+        self.assertIsNone(responder.match("İ"))
+        self.assertEqual(responder.match("İ i"), 0)
+
+    def test_invalid_rules_are_skipped(self):
+        responder = AutoResponder("/nonexistent/auto_replies.json")
+        responder.compile([{'type': 'regex', 'pattern': "(", 'reply': "x"},
+                           {'type': 'keyword', 'pattern': "no reply"},
+                           {'type': 'unknown', 'pattern': "x", 'reply': "x"},
+                           {'type': 'keyword', 'pattern': "ok", 'reply': "fine"}])
+        self.assertEqual(len(responder.rules), 1)
+        self.assertEqual(responder.reply(1, "ok then"), "fine")
+
+    def test_cooldown_per_chat_and_rule(self):
+        responder = make_responder([{'type': 'keyword', 'pattern': "hi", 'reply': "hello", 'cooldown': 60}])
+        self.assertEqual(responder.reply(1, "hi", now=100), "hello")
+        self.assertIsNone(responder.reply(1, "hi", now=130))
+        self.assertEqual(responder.reply(2, "hi", now=130), "hello")
+        self.assertEqual(responder.reply(1, "hi", now=161), "hello")
+
+    def test_matches_rule_by_rule_reference(self):
+        rng = random.Random(7)
+        words = ["price", "order", "refund", "help", "цена", "заказ", "ok", "pri", "or"]
+        rules = []
+        for word in words:
+            rules.append({'type': 'keyword', 'pattern': word})
+            rules.append({'type': 'prefix', 'pattern': word})
+            rules.append({'type': 'regex', 'pattern': word + r"\d+"})
+        rules.append({'type': 'regex', 'pattern': r"\d{2}:\d{2}"})
+        rules.append({'type': 'regex', 'pattern': r"(ab|cd)+e"})
+        rng.shuffle(rules)
+        responder = make_responder(rules)
+        alphabet = words + ["12", "  ", " ", "_", "ab", "cde", "10:30", "PRICE", "Цена", "x"]
+        for _ in range(3000):
+            text = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8)))
+            self.assertEqual(responder.match(text), reference_match(rules, text), text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,262 @@
+"""Приём через getUpdates и отправка (bot_engine.BotEngine) против локальной заглушки FakeBotAPI:
+задержка доставки, паузы после ошибок, allowed_updates, конфликт 409 и flood wait.
+
+    python -m unittest test_bot_engine
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import bot_engine
+from fake_bot_api import FakeBotAPI, text_update
+
+# Паузы после ошибок в тестах короче, чтобы их можно было измерить за доли секунды
+BACKOFF_BASE = 0.05
+# Запас на обход HTTP-запроса и планирование потоков
+SLACK = 0.1
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.002)
+    return True
+
+
+class EngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeBotAPI().start()
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.db = bot_engine.open_database(db_path=self.data_dir.name)
+        self.engine = None
+        self.received = {}
+        self.statuses = []
+        self.finished = []
+        patcher = mock.patch.object(bot_engine, 'BACKOFF_BASE', BACKOFF_BASE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_engine(self, **kwargs):
+        self.engine = bot_engine.BotEngine("TEST", self.db, api_url=self.server.url, poll_timeout=2, **kwargs)
+        # Повторы 5xx внутри AsyncBotApi здесь не нужны: проверяется пауза самого poll_loop
+        self.engine.api.retries = 0
+        self.engine.on_messages = self.on_messages
+        self.engine.on_status = self.statuses.append
+        self.engine.on_send_finished = lambda chat_id, ok, error: self.finished.append((chat_id, ok, time.perf_counter()))
+        self.thread = threading.Thread(target=self.engine.run, daemon=True)
+        self.thread.start()
+
+    def on_messages(self, events):
+        now = time.perf_counter()
+        for event in events:
+            self.received[event['message']['text']] = now
+
+    def tearDown(self):
+        if self.engine:
+            self.engine.stop()
+            self.thread.join(10)
+        self.server.stop()
+        self.db.close()
+        self.data_dir.cleanup()
+
+    def poll_gaps(self):
+        times = [poll['time'] for poll in self.server.polls]
+        return [later - earlier for earlier, later in zip(times, times[1:])]
+
+
+class PollLoopTest(EngineTestCase):
+    def test_delivery_latency(self):
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: self.server.polls))
+        latencies = []
+        for i in range(20):
+            update_id = self.server.push_text(1, f"message {i}")
+            self.assertTrue(wait_for(lambda: f"message {i}" in self.received))
+            latencies.append(self.received[f"message {i}"] - self.server.pushed_at[update_id])
+        # Long poll возвращается сразу с новым update, а следующий запрос уходит без паузы
+        self.assertLess(max(latencies), SLACK * 2)
+        self.assertLess(sorted(latencies)[len(latencies) // 2], SLACK)
+
+    @mock.patch.object(bot_engine, 'BACKOFF_BASE', 1.0)
+    def test_repolls_immediately_while_updates_keep_arriving(self):
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: self.server.polls))
+        ids = self.server.push_burst(450, chats=5)
+        self.assertTrue(wait_for(lambda: len(self.received) == len(ids)))
+        self.assertTrue(wait_for(lambda: len(self.server.polls) >= 6))
+        # Заглушка отдаёт по 100 update: пачка уходит за несколько запросов подряд,
+        # и каждый следующий идёт сразу, а не через паузу backoff (здесь не меньше 0,5 с)
+        self.assertEqual([poll['offset'] for poll in self.server.polls[:6]], [1, 101, 201, 301, 401, 451])
+        self.assertLess(max(self.poll_gaps()[:5]), SLACK)
+        self.assertEqual(self.engine.offset, ids[-1])
+
+    def test_backoff_grows_with_jitter_on_errors(self):
+        self.server.inject_poll_errors(4, status=500)
+        jitter = [1.0, 0.5, 0.75, 0.5]
+        with mock.patch.object(bot_engine.random, 'uniform', side_effect=jitter) as uniform:
+            self.start_engine()
+            self.assertTrue(wait_for(lambda: len(self.server.polls) >= 5))
+        self.assertEqual(uniform.call_args_list, [mock.call(0.5, 1.0)] * 4)
+        for failures, (gap, factor) in enumerate(zip(self.poll_gaps(), jitter), 1):
+            delay = BACKOFF_BASE * 2 ** (failures - 1) * factor
+            self.assertGreaterEqual(gap, delay)
+            self.assertLess(gap, delay + SLACK)
+        self.assertIn(False, self.statuses)
+        # После ошибок приём работает, а счётчик неудач сбрасывается
+        self.server.push_text(1, "after errors")
+        self.assertTrue(wait_for(lambda: "after errors" in self.received))
+        self.assertEqual(self.statuses[-1], True)
+
+    def test_backoff_on_non_200_answer(self):
+        self.server.inject_poll_errors(3, status=400, description="Bad Request")
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: len(self.server.polls) >= 4))
+        gaps = self.poll_gaps()[:3]
+        for failures, gap in enumerate(gaps, 1):
+            delay = BACKOFF_BASE * 2 ** (failures - 1)
+            self.assertGreaterEqual(gap, delay * 0.5)
+            self.assertLess(gap, delay + SLACK)
+
+    def test_backoff_respects_retry_after(self):
+        self.server.inject_poll_errors(1, status=429, description="Too Many Requests", retry_after=0.4)
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: len(self.server.polls) >= 2))
+        self.assertGreaterEqual(self.poll_gaps()[0], 0.4)
+
+    def test_allowed_updates(self):
+        self.start_engine(allowed_updates=["message"])
+        self.assertTrue(wait_for(lambda: self.server.polls))
+        self.server.push_update({'edited_message': text_update(1, 1, "edited")['message']})
+        self.server.push_text(1, "plain")
+        self.assertTrue(wait_for(lambda: "plain" in self.received))
+        self.assertTrue(all(poll['allowed_updates'] == ["message"] for poll in self.server.polls))
+        self.assertEqual(self.engine.offset, 2)
+
+    def test_default_allowed_updates_are_not_sent(self):
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: self.server.polls))
+        self.assertIsNone(self.server.polls[0]['allowed_updates'])
+
+    def test_conflict_with_webhook_deletes_it(self):
+        self.server.set_webhook("http://127.0.0.1:9/unused")
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: len(self.server.polls) >= 2))
+        self.assertEqual(self.server.webhook_deletions, 1)
+        # Повтор после webhook-конфликта всё равно идёт после паузы
+        self.assertGreaterEqual(self.poll_gaps()[0], BACKOFF_BASE * 0.5)
+        self.server.push_text(1, "after webhook")
+        self.assertTrue(wait_for(lambda: "after webhook" in self.received))
+
+    def test_conflict_with_other_poller_backs_off(self):
+        self.server.inject_poll_errors(3, status=409, description="Conflict: terminated by other getUpdates request; "
+                                                                 "make sure that only one bot instance is running")
+        self.start_engine()
+        self.assertTrue(wait_for(lambda: len(self.server.polls) >= 4))
+        self.assertEqual(self.server.webhook_deletions, 0)
+        self.assertEqual(self.statuses[:3], [False] * 3)
+        for failures, gap in enumerate(self.poll_gaps()[:3], 1):
+            self.assertGreaterEqual(gap, BACKOFF_BASE * 2 ** (failures - 1) * 0.5)
+
+
+class SendQueueTest(EngineTestCase):
+    def test_flood_wait_holds_every_chat(self):
+        self.server.inject_flood(1, retry_after=1)
+        self.start_engine()
+        self.engine.send_message(1, "flooded")
+        # Ждём, пока движок разберёт ответ 429, а не только пока заглушка его отдаст
+        self.assertTrue(wait_for(lambda: self.engine.send_queue.flood_until))
+        flood_ends = time.perf_counter() + self.engine.send_queue.flood_until - time.monotonic()
+        self.assertGreater(flood_ends - time.perf_counter(), 1 - SLACK)
+        for chat_id in (2, 3):
+            self.engine.send_message(chat_id, "waits")
+        self.assertTrue(wait_for(lambda: len(self.finished) == 3))
+        self.assertTrue(all(ok for _, ok, _ in self.finished))
+        # retry_after действует на весь бот, а не только на чат, получивший 429
+        self.assertGreaterEqual(min(sent['time'] for sent in self.server.sent), flood_ends - 0.01)
+        self.assertEqual(sorted(sent['params']['text'] for sent in self.server.sent), ["flooded", "waits", "waits"])
+
+    def test_slow_sends_to_different_chats_overlap(self):
+        self.server.set_latency(send=0.2)
+        self.start_engine()
+        for chat_id in range(1, 11):
+            self.engine.send_message(chat_id, "hi")
+        self.assertTrue(wait_for(lambda: len(self.finished) == 10))
+        # Чаты отправляются параллельно: по очереди десять ответов по 0,2 с заняли бы две секунды
+        times = [sent['time'] for sent in self.server.sent]
+        self.assertLess(max(times) - min(times), 0.5)
+
+    def test_order_and_rate_within_chat(self):
+        self.server.set_latency(send=0.01)
+        self.start_engine()
+        for i in range(3):
+            self.engine.send_message(1, f"m{i}")
+        self.assertTrue(wait_for(lambda: len(self.finished) == 3))
+        self.assertEqual([sent['params']['text'] for sent in self.server.sent], ["m0", "m1", "m2"])
+        times = [sent['time'] for sent in self.server.sent]
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, 1 / bot_engine.CHAT_SEND_RATE - SLACK)
+
+
+class PartialDownloadApi:
+    """Отдаёт getFile, а скачивание пишет часть файла и затем падает или зависает"""
+    def __init__(self, fail):
+        self.fail = fail
+        self.started = asyncio.Event()
+
+    async def get_file(self, file_id):
+        return 200, {'ok': True, 'result': {'file_path': f"photos/{file_id}.jpg"}}
+
+    async def download_file(self, file_path, dest):
+        with open(dest, 'wb') as f:
+            f.write(b"partial")
+        self.started.set()
+        if self.fail:
+            raise ConnectionResetError("connection reset")
+        await asyncio.sleep(60)
+
+
+class PhotoDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        self.db = bot_engine.open_database(db_path=self.data_dir.name)
+        self.addCleanup(self.db.close)
+        self.photo_path = os.path.join(self.data_dir.name, "photo.jpg")
+
+    def download(self, fail):
+        engine = bot_engine.BotEngine("TEST", self.db)
+
+        async def run():
+            engine.api = PartialDownloadApi(fail)
+            task = asyncio.ensure_future(engine.download_photo("file", self.photo_path))
+            if fail:
+                return await task
+            await engine.api.started.wait()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        try:
+            return engine.loop.run_until_complete(run())
+        finally:
+            engine.loop.close()
+
+    def test_failed_download_leaves_no_partial_file(self):
+        self.assertFalse(self.download(fail=True))
+        self.assertFalse(os.path.exists(self.photo_path + ".part"))
+        self.assertFalse(os.path.exists(self.photo_path))
+
+    def test_cancelled_download_leaves_no_partial_file(self):
+        self.download(fail=False)
+        self.assertFalse(os.path.exists(self.photo_path + ".part"))
+        self.assertFalse(os.path.exists(self.photo_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Модель списка чатов (one_file.ChatListModel): порядок строк и поиск строки по chat_id.
+
+    python -m unittest test_chat_list
+"""
+import random
+import unittest
+
+from PyQt5.QtCore import Qt
+
+from bot_engine import summarize_messages
+from one_file import ChatListModel
+
+
+def summary(timestamp):
+    return dict(summarize_messages([]), last_timestamp=timestamp)
+
+
+class ChatListModelTest(unittest.TestCase):
+    def check_rows(self, model):
+        self.assertEqual(model.rowCount(), len(model.rows))
+        for row, chat_id in enumerate(model.rows):
+            self.assertEqual(model.row_of(chat_id), row)
+            self.assertEqual(model.data(model.index(row), Qt.UserRole), chat_id)
+
+    def test_sorted_by_last_message(self):
+        model = ChatListModel()
+        model.set_chats({1: {'chat': {'first_name': "A"}, 'summary': summary(10)},
+                         2: {'chat': {'first_name': "B"}, 'summary': summary(30)},
+                         3: {'chat': {'first_name': "C"}, 'summary': summary(20)}})
+        self.assertEqual(model.rows, ["2", "3", "1"])
+        self.assertEqual(model.row_of(1), 2)
+        self.assertEqual(model.row_of(4), -1)
+        self.check_rows(model)
+
+    def test_new_message_moves_chat_to_top(self):
+        model = ChatListModel()
+        model.set_chats({cid: {'chat': {}, 'summary': summary(10 - cid)} for cid in range(5)})
+        model.update_chat(3, summary=summary(100))
+        self.assertEqual(model.rows, ["3", "0", "1", "2", "4"])
+        model.update_chat(7, {'first_name': "New"}, summary(101))
+        self.assertEqual(model.rows, ["7", "3", "0", "1", "2", "4"])
+        # Без новой сводки строка остаётся на месте
+        model.update_chat(2, {'first_name': "Renamed"})
+        self.assertEqual(model.row_of(2), 4)
+        self.assertEqual(model.entry(4)['chat']['first_name'], "Renamed")
+        self.check_rows(model)
+
+    def test_row_of_follows_random_updates(self):
+        rng = random.Random(3)
+        model = ChatListModel()
+        model.set_chats({cid: {'chat': {}, 'summary': summary(cid)} for cid in range(50)})
+        for step in range(500):
+            model.update_chat(rng.randrange(80), summary=summary(1000 + step))
+            if step % 50 == 0:
+                self.check_rows(model)
+        self.check_rows(model)
+        model.set_chats({cid: {'chat': {}, 'summary': summary(cid)} for cid in range(5)})
+        self.check_rows(model)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+"""Поиск по сообщениям: индекс в памяти (bot_engine.SearchIndex) и его поддержка хранилищами.
+
+    python -m unittest test_search
+"""
+import tempfile
+import threading
+import time
+import unittest
+
+import bot_engine
+from bot_engine import SearchIndex
+
+
+def texts(hits):
+    return [hit['text'] for hit in hits]
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_every_term_is_a_prefix(self):
+        index = SearchIndex()
+        index.add(1, 1, "hello world")
+        index.add(1, 2, "help wanted")
+        index.add(1, 3, "shell")
+        self.assertEqual(sorted(texts(index.search("hel"))), ["hello world", "help wanted"])
+        self.assertEqual(texts(index.search("HEL wor")), ["hello world"])
+        self.assertEqual(index.search("hel nothing"), [])
+        self.assertEqual(index.search("  "), [])
+
+    def test_exact_word_ranks_above_prefix(self):
+        index = SearchIndex()
+        index.add(1, 1, "cathedral", timestamp=2)
+        index.add(1, 2, "cat", timestamp=1)
+        self.assertEqual(texts(index.search("cat")), ["cat", "cathedral"])
+
+    def test_rare_word_ranks_above_common(self):
+        index = SearchIndex()
+        for i in range(10):
+            index.add(1, i, "order status", timestamp=i)
+        index.add(1, 100, "order refund", timestamp=0)
+        index.add(1, 101, "refund status", timestamp=0)
+        self.assertEqual(texts(index.search("refund status")), ["refund status"])
+        self.assertEqual(texts(index.search("order refund"))[0], "order refund")
+        self.assertEqual(texts(index.search("re", limit=1)), ["order refund"])
+
+    def test_chat_names_first_then_newer(self):
+        index = SearchIndex()
+        index.add(1, 1, "meeting at noon", timestamp=1)
+        index.add(1, 2, "meeting moved", timestamp=3)
+        index.add(2, None, "Meeting room")
+        index.add(1, 3, "meeting cancelled", timestamp=2)
+        hits = index.search("meet")
+        self.assertEqual(texts(hits), ["Meeting room", "meeting moved", "meeting cancelled", "meeting at noon"])
+        self.assertIsNone(hits[0]['message_id'])
+        self.assertEqual(len(index.search("meet", limit=2)), 2)
+
+    def test_words_before_and_after_merge(self):
+        index = SearchIndex()
+        index.add(1, 1, "alpha")
+        index.merge_words()
+        index.add(1, 2, "alphabet")
+        self.assertEqual(sorted(texts(index.search("alp"))), ["alpha", "alphabet"])
+
+    def test_readding_same_text_is_ignored_and_edit_replaces(self):
+        index = SearchIndex()
+        index.add(1, 1, "first version")
+        index.add(1, 1, "first version")
+        self.assertEqual(len(index.docs), 1)
+        index.add(1, 1, "second version")
+        self.assertEqual(index.search("first"), [])
+        self.assertEqual(texts(index.search("vers")), ["second version"])
+
+    def test_remove_and_remove_chat(self):
+        index = SearchIndex()
+        index.add(1, None, "Alice")
+        index.add(1, 1, "apple")
+        index.add(1, 2, "apricot")
+        index.add(2, 3, "apple pie")
+        index.remove(1, 1)
+        self.assertEqual(sorted(texts(index.search("ap"))), ["apple pie", "apricot"])
+        index.remove_chat(1)
+        self.assertEqual(texts(index.search("ap")), ["apple pie"])
+        self.assertEqual(texts(index.search("ali")), ["Alice"])
+
+    def test_rebuild_after_many_removals(self):
+        index = SearchIndex()
+        count = bot_engine.SEARCH_REBUILD_DELETED * 2 + 2
+        for i in range(count):
+            index.add(1, i, f"note {i}")
+        for i in range(count - 1):
+            index.remove(1, i)
+        # Удалённые документы вычищены пересборкой, а оставшийся находится по-прежнему
+        self.assertLess(len(index.docs), count)
+        self.assertEqual(texts(index.search("note")), [f"note {count - 1}"])
+
+
+class StoreSearchTest(unittest.TestCase):
+    backend = "json"
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        self.db = bot_engine.open_database(self.backend, self.data_dir.name)
+        self.addCleanup(self.db.close)
+        self.db.save_chat({'id': 1, 'first_name': "Alice"})
+        self.db.save_chat({'id': 2, 'first_name': "Bob"})
+
+    def test_new_messages_are_found(self):
+        self.db.save_message(1, "invoice attached", False)
+        self.assertEqual(texts(self.db.search("invo")), ["invoice attached"])
+        self.db.save_message(2, "second invoice", True)
+        self.assertEqual(sorted(texts(self.db.search("invoice"))), ["invoice attached", "second invoice"])
+
+    def test_deleted_messages_are_not_found(self):
+        kept = self.db.save_message(1, "parcel shipped", False)
+        gone = self.db.save_message(1, "parcel lost", False)
+        self.db.delete_message(1, gone['id'])
+        hits = self.db.search("parcel")
+        self.assertEqual([hit['message_id'] for hit in hits], [kept['id']])
+
+    def test_cleared_chat_keeps_its_name(self):
+        self.db.save_message(1, "bobcat photo", False)
+        self.db.save_message(2, "bobcat video", False)
+        self.db.clear_chat(2)
+        self.assertEqual(texts(self.db.search("bob")), ["Bob", "bobcat photo"])
+
+    def test_new_chat_is_found(self):
+        self.db.save_chat({'id': 3, 'first_name': "Robert", 'last_name': "Smith"})
+        self.assertEqual(texts(self.db.search("rob smi")), ["Robert Smith"])
+
+
+class SQLiteStoreSearchTest(StoreSearchTest):
+    backend = "sqlite"
+
+
+class GatedChats:
+    """Список чатов для сборки индекса, перед выдачей очередного чата выполняющий before(номер)"""
+    def __init__(self, chat_ids, before):
+        self.chat_ids = chat_ids
+        self.before = before
+
+    def __iter__(self):
+        for i, chat_id in enumerate(self.chat_ids):
+            self.before(i)
+            yield chat_id
+
+
+class IndexBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        self.store = bot_engine.Database(self.data_dir.name)
+        for chat_id in (1, 2):
+            self.store.save_chat({'id': chat_id, 'first_name': f"Chat {chat_id}"})
+            self.store.save_message(chat_id, f"ticket {chat_id}", False)
+
+    def test_abandoned_build_does_not_release_newer_waiters(self):
+        store = self.store
+        message_chat_ids = store.message_chat_ids
+        second_started = threading.Event()
+        second_gate = threading.Event()
+        results = []
+        threads = []
+
+        def second_build(i):
+            if i == 1:
+                second_started.set()
+                second_gate.wait(5)
+
+        def first_build(i):
+            if i:
+                return
+            # Пока первая сборка отпустила блокировку, индекс сбрасывают (как clear_all_data)
+            # и начинают новую сборку, а поиск ждёт её
+            store.mutex.acquire()
+            store.search_index = None
+            store.mutex.release()
+            threads.append(threading.Thread(target=store.build_search_index))
+            threads[-1].start()
+            self.assertTrue(second_started.wait(5))
+            threads.append(threading.Thread(target=lambda: results.append(store.search("ticket"))))
+            threads[-1].start()
+
+        gates = [first_build, second_build]
+        store.message_chat_ids = lambda: GatedChats(message_chat_ids(), gates.pop(0))
+        store.build_search_index()
+        time.sleep(0.1)
+        # Первая сборка брошена, вторая ещё идёт: поиск не должен вернуть неполный результат
+        self.assertEqual(results, [])
+        second_gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(sorted(texts(results[0])), ["ticket 1", "ticket 2"])
+
+    def test_search_after_clear(self):
+        self.store.build_search_index()
+        self.assertEqual(len(self.store.search("ticket")), 2)
+        self.store.clear_all_data()
+        self.assertEqual(self.store.search("ticket"), [])
+        self.store.save_message(3, "ticket 3", False)
+        self.assertEqual(texts(self.store.search("ticket")), ["ticket 3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
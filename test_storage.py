@@ -0,0 +1,190 @@
+"""Хранилища (bot_engine.Database, SQLiteDatabase) за кэшем записи CachedDatabase:
+сводки чатов, удаление и очистка, страницы истории.
+
+    python -m unittest test_storage
+"""
+import tempfile
+import threading
+import unittest
+
+import bot_engine
+
+
+class StorageTestCase(unittest.TestCase):
+    backend = "json"
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        self.db = self.open()
+
+    def tearDown(self):
+        self.db.close()
+
+    def open(self):
+        # Записывает только явный flush, чтобы тест сам выбирал момент
+        return bot_engine.open_database(self.backend, self.data_dir.name, flush_interval=60, flush_threshold=10 ** 6)
+
+    def reopen(self):
+        self.db.close()
+        self.db = self.open()
+
+    def save(self, chat_id, texts, out=False):
+        self.db.save_chat({'id': chat_id, 'first_name': f"Chat {chat_id}"})
+        return [self.db.save_message(chat_id, text, out) for text in texts]
+
+
+class SummaryTest(StorageTestCase):
+    def test_counts_and_preview(self):
+        self.save(1, ["a", "b"])
+        self.save(1, ["mine"], out=True)
+        summary = self.db.get_summary(1)
+        self.assertEqual((summary['total'], summary['unread'], summary['outgoing']), (3, 2, 1))
+        self.assertEqual(summary['last_text'], "mine")
+        self.reopen()
+        self.assertEqual(self.db.get_summary(1), summary)
+
+    def test_mark_read(self):
+        self.save(1, ["a", "b"])
+        self.db.mark_read(1)
+        self.assertEqual(self.db.get_summary(1)['unread'], 0)
+        self.save(1, ["c"])
+        self.assertEqual(self.db.get_summary(1)['unread'], 1)
+        self.reopen()
+        self.assertEqual(self.db.get_summary(1)['unread'], 1)
+
+    def test_delete_updates_summary(self):
+        first, second, last = self.save(1, ["a", "b", "c"])
+        self.db.delete_message(1, last['id'])
+        summary = self.db.get_summary(1)
+        self.assertEqual((summary['total'], summary['unread'], summary['last_text']), (2, 2, "b"))
+        self.db.delete_message(1, first['id'])
+        self.db.delete_message(1, second['id'])
+        summary = self.db.get_summary(1)
+        self.assertEqual((summary['total'], summary['unread'], summary['last_text']), (0, 0, ""))
+        self.reopen()
+        self.assertEqual(self.db.get_summary(1), summary)
+
+    def test_clear_chat(self):
+        self.save(1, ["a", "b"])
+        self.save(2, ["other"])
+        self.db.clear_chat(1)
+        self.assertEqual(self.db.get_summary(1)['total'], 0)
+        self.assertEqual(self.db.get_messages(1), [])
+        self.assertEqual(self.db.get_summary(2)['last_text'], "other")
+        self.reopen()
+        self.assertEqual(self.db.get_summary(1)['total'], 0)
+
+    def race_save_during(self, method):
+        """Сообщение из другого потока приходит, пока хранилище удаляет; его нельзя потерять в сводке"""
+        original = getattr(self.db.backend, method)
+
+        def slow_backend(*args):
+            result = original(*args)
+            saver = threading.Thread(target=self.db.save_message, args=(1, "arrived meanwhile", False))
+            saver.start()
+            saver.join(5)
+            self.assertFalse(saver.is_alive())
+            return result
+
+        setattr(self.db.backend, method, slow_backend)
+        self.addCleanup(delattr, self.db.backend, method)
+
+    def test_save_while_deleting(self):
+        first, second = self.save(1, ["a", "b"])
+        self.race_save_during('delete_message')
+        self.db.delete_message(1, second['id'])
+        summary = self.db.get_summary(1)
+        self.assertEqual((summary['total'], summary['unread'], summary['last_text']), (2, 2, "arrived meanwhile"))
+        self.db.flush()
+        self.assertEqual(self.db.backend.get_summary(1), summary)
+
+    def test_save_while_clearing(self):
+        self.save(1, ["a", "b"])
+        self.race_save_during('clear_chat')
+        self.db.clear_chat(1)
+        summary = self.db.get_summary(1)
+        self.assertEqual((summary['total'], summary['last_text']), (1, "arrived meanwhile"))
+        self.db.flush()
+        self.assertEqual(self.db.backend.get_summary(1), summary)
+        self.assertEqual([msg['text'] for msg in self.db.get_messages(1)], ["arrived meanwhile"])
+
+
+class HistoryTest(StorageTestCase):
+    def page_through(self, chat_id, limit):
+        texts = []
+        page = self.db.get_messages(chat_id, limit=limit)
+        while page:
+            texts[:0] = [msg['text'] for msg in page]
+            page = self.db.get_messages(chat_id, before_id=page[0]['id'], limit=limit)
+        return texts
+
+    def test_pages_cover_history(self):
+        texts = [f"m{i}" for i in range(bot_engine.CACHED_MESSAGES_PER_CHAT + 130)]
+        self.save(1, texts)
+        self.assertEqual(self.page_through(1, 50), texts)
+        self.reopen()
+        self.assertEqual(self.page_through(1, 50), texts)
+        self.assertEqual(self.page_through(1, 7), texts)
+
+    def test_pages_skip_deleted(self):
+        messages = self.save(1, [f"m{i}" for i in range(100)])
+        self.db.flush()
+        for msg in messages[10:90:3]:
+            self.db.delete_message(1, msg['id'])
+        self.reopen()
+        expected = [msg['text'] for i, msg in enumerate(messages) if not (10 <= i < 90 and (i - 10) % 3 == 0)]
+        self.assertEqual(self.page_through(1, 9), expected)
+
+    def test_page_before_deleted_message(self):
+        messages = self.save(1, [f"m{i}" for i in range(60)])
+        self.db.flush()
+        page = self.db.get_messages(1, limit=20)
+        self.assertEqual(page[0]['text'], "m40")
+        # Верхнее загруженное сообщение удалили, пока история была открыта
+        self.db.delete_message(1, page[0]['id'])
+        page = self.db.get_messages(1, before_id=page[0]['id'], limit=20)
+        self.assertEqual([msg['text'] for msg in page], [f"m{i}" for i in range(20, 40)])
+        self.db.delete_message(1, messages[19]['id'])
+        self.db.delete_message(1, messages[18]['id'])
+        self.reopen()
+        page = self.db.get_messages(1, before_id=messages[19]['id'], limit=5)
+        self.assertEqual([msg['text'] for msg in page], [f"m{i}" for i in range(13, 18)])
+        self.assertEqual([msg['text'] for msg in self.db.get_messages(1, before_id=messages[19]['id'])],
+                         [f"m{i}" for i in range(18)])
+
+    def test_store_page_before_deleted_message(self):
+        self.save(1, [f"m{i}" for i in range(60)])
+        self.db.flush()
+        store = self.db.backend
+        # Прямо в хранилище: у JSON вторая страница продолжается с курсора первой
+        page = store.get_messages(1, limit=20)
+        store.delete_message(1, page[0]['id'])
+        page = store.get_messages(1, before_id=page[0]['id'], limit=20)
+        self.assertEqual([msg['text'] for msg in page], [f"m{i}" for i in range(20, 40)])
+        store.delete_message(1, page[0]['id'])
+        page = store.get_messages(1, before_id=page[0]['id'], limit=30)
+        self.assertEqual([msg['text'] for msg in page], [f"m{i}" for i in range(20)])
+
+    def test_page_before_deleted_message_after_compaction(self):
+        messages = self.save(1, [f"m{i}" for i in range(30)])
+        self.db.flush()
+        for msg in messages[10:]:
+            self.db.delete_message(1, msg['id'])
+        if self.backend == "json":
+            self.db.backend.compact()
+        self.reopen()
+        page = self.db.get_messages(1, before_id=messages[20]['id'], limit=4)
+        self.assertEqual([msg['text'] for msg in page], ["m6", "m7", "m8", "m9"])
+
+
+class SQLiteSummaryTest(SummaryTest):
+    backend = "sqlite"
+
+
+class SQLiteHistoryTest(HistoryTest):
+    backend = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""Режим webhook (bot_engine.BotEngine.handle_webhook): записанные update POST-запросами на встроенный сервер.
+
+    python -m unittest test_webhook
+"""
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+import bot_engine
+from fake_bot_api import SECRET_HEADER, FakeBotAPI, post_update, text_update
+
+SECRET = "test-secret"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def post_raw(url, body, secret_token=SECRET):
+    request = urllib.request.Request(url, data=body, method='POST', headers={'Content-Type': 'application/json'})
+    request.add_header(SECRET_HEADER, secret_token)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeBotAPI().start()
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.db = bot_engine.open_database(db_path=self.data_dir.name)
+        options = {'host': '127.0.0.1', 'port': 0, 'secret': SECRET}
+        self.engine = bot_engine.BotEngine("TEST", self.db, api_url=self.server.url, webhook=options)
+        self.thread = threading.Thread(target=self.engine.run, daemon=True)
+        self.thread.start()
+        self.assertTrue(wait_for(lambda: self.engine.webhook['port'] != 0))
+        self.url = f"http://127.0.0.1:{self.engine.webhook['port']}{bot_engine.WEBHOOK_PATH}"
+
+    def tearDown(self):
+        self.engine.stop()
+        self.thread.join(10)
+        self.server.stop()
+        self.db.close()
+        self.data_dir.cleanup()
+
+    def stored(self, chat_id):
+        # Смотрим в само хранилище, а не в кэш записи
+        return [msg['text'] for msg in self.db.backend.get_messages(str(chat_id))]
+
+    def test_secret_token_is_required(self):
+        update = dict(text_update(1, 10, "hi"), update_id=1)
+        self.assertEqual(post_update(self.url, update), 401)
+        self.assertEqual(post_update(self.url, update, secret_token="wrong"), 401)
+        self.assertEqual(self.stored(10), [])
+
+    def test_malformed_update_is_rejected(self):
+        self.assertEqual(post_raw(self.url, b"not json"), 400)
+        self.assertEqual(post_raw(self.url, b"[1, 2]"), 400)
+        self.assertEqual(post_update(self.url, text_update(1, 10, "hi"), SECRET), 400)
+        self.assertEqual(post_update(self.url, dict(text_update(1, 10, "hi"), update_id="1"), SECRET), 400)
+        self.assertEqual(self.stored(10), [])
+
+    def test_ok_only_after_update_is_stored(self):
+        for update_id in range(1, 6):
+            update = dict(text_update(update_id, 10, f"hi {update_id}"), update_id=update_id)
+            self.assertEqual(post_update(self.url, update, SECRET), 200)
+            self.assertIn(f"hi {update_id}", self.stored(10))
+        self.assertTrue(self.db.processed.is_processed(5))
+
+    def test_duplicate_update_is_stored_once(self):
+        update = dict(text_update(7, 10, "once"), update_id=3)
+        self.assertEqual(post_update(self.url, update, SECRET), 200)
+        self.assertEqual(post_update(self.url, update, SECRET), 200)
+        self.assertEqual(self.stored(10), ["once"])
+
+    def test_concurrent_posts(self):
+        updates = [dict(text_update(i, 10 + i % 3, f"m{i}"), update_id=i) for i in range(1, 31)]
+        statuses = []
+        threads = [threading.Thread(target=lambda u=u: statuses.append(post_update(self.url, u, SECRET)))
+                   for u in updates + updates[:10]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(statuses, [200] * 40)
+        self.assertEqual(sorted(sum((self.stored(chat) for chat in (10, 11, 12)), [])), sorted(f"m{i}" for i in range(1, 31)))
+
+    def test_unavailable_while_stopping(self):
+        self.engine.running = False
+        update = dict(text_update(1, 10, "late"), update_id=1)
+        self.assertEqual(post_update(self.url, update, SECRET), 503)
+        self.assertEqual(self.stored(10), [])
+
+
+class RegisteredWebhookTest(unittest.TestCase):
+    def test_updates_arrive_through_registered_webhook(self):
+        server = FakeBotAPI().start()
+        with tempfile.TemporaryDirectory() as data_dir:
+            db = bot_engine.open_database(db_path=data_dir)
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+            options = {'url': f"http://127.0.0.1:{port}{bot_engine.WEBHOOK_PATH}", 'host': '127.0.0.1',
+                       'port': port, 'secret': SECRET}
+            engine = bot_engine.BotEngine("TEST", db, api_url=server.url, webhook=options)
+            thread = threading.Thread(target=engine.run, daemon=True)
+            thread.start()
+            try:
+                self.assertTrue(wait_for(lambda: server.webhook is not None))
+                self.assertEqual(server.webhook['secret_token'], SECRET)
+                server.push_text(20, "via webhook")
+                self.assertTrue(wait_for(lambda: db.backend.get_messages("20")))
+            finally:
+                engine.stop()
+                thread.join(10)
+                server.stop()
+                db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()